@@ -10,9 +10,12 @@ import socket
 import sys
 import web
 import web.wsgiserver
+import pstats
 import urllib
 import cloudscheduler.utilities as utilities
 import cloudscheduler.config as config
+import cloudscheduler.profiler as profiler
+import cloudscheduler.snapshot as snapshot
 from proxy_refreshers import MyProxyProxyRefresher
 
 log = None
@@ -57,6 +60,8 @@ class AdminServer(threading.Thread,):
             r'/cloud-aliases',                    views.cloud_aliases,
             r'/users/([\w\%-]+)',                 views.users,
             r'/user-limits',                      views.user_limits,
+            r'/threads',                          views.threads,
+            r'/threads/([\w\%-]+)/profile',        views.profile,
         )
 
     def run(self):
@@ -94,6 +99,7 @@ class views:
                     return ''
                 elif action == 'reconfig':
                     web.cloud_resources.setup()
+                    snapshot.publisher.publish_resources(web.cloud_resources)
                     return ''
 
             raise web.notfound()
@@ -105,15 +111,18 @@ class views:
             if 'action' in web.input():
                 action = web.input().action
                 if action == 'enable':
-                    return web.cloud_resources.enable_cluster(cloudname)
+                    output = web.cloud_resources.enable_cluster(cloudname)
                 elif action == 'disable':
-                    return web.cloud_resources.disable_cluster(cloudname)
+                    output = web.cloud_resources.disable_cluster(cloudname)
                 else:
                     raise web.notfound()
-
-                return web.input().action + "_cloud(" + cloudname + ")"
+                # So cloud_status shows the change straight away
+                snapshot.publisher.publish_resources(web.cloud_resources)
+                return output
             elif 'allocations' in web.input():
-                return web.cloud_resources.adjust_cloud_allocation(cloudname, web.input().allocations)
+                output = web.cloud_resources.adjust_cloud_allocation(cloudname, web.input().allocations)
+                snapshot.publisher.publish_resources(web.cloud_resources)
+                return output
 
             raise web.notfound()
 
@@ -124,10 +133,43 @@ class views:
         def POST(self):
             if config.target_cloud_alias_file:
                 web.cloud_resources.target_cloud_aliases = web.cloud_resources.load_cloud_aliases(config.target_cloud_alias_file)
+                web.cloud_resources.invalidate_fit_cache()
                 return True if len(web.cloud_resources.target_cloud_aliases) > 0 else False
             else:
                 return False
 
+    class profile:
+        def POST(self, thread_name):
+            thread_name = urllib.unquote(thread_name)
+            params = web.input(seconds='10', mode='sample', sort='cumulative', limit='50')
+            thread = profiler.find_thread(thread_name)
+            if thread is None:
+                raise web.notfound("No thread named %s\n" % thread_name)
+            try:
+                seconds = float(params.seconds)
+                limit = int(params.limit)
+            except ValueError:
+                raise web.badrequest("seconds must be a number and limit an integer\n")
+            if not 0 < seconds <= profiler.CAPTURE_SECONDS_MAX:
+                raise web.badrequest("seconds must be more than 0 and at most %d\n" % profiler.CAPTURE_SECONDS_MAX)
+            if params.mode not in ('sample', 'cprofile'):
+                raise web.badrequest("mode must be sample or cprofile\n")
+            if params.sort not in pstats.Stats.sort_arg_dict_default:
+                raise web.badrequest("Can't sort by %s\n" % params.sort)
+            log.info("Profiling thread %s for %ss with %s" % (thread_name, seconds, params.mode))
+            web.header('Content-Type', 'text/plain')
+            try:
+                if params.mode == 'sample':
+                    return profiler.format_collapsed(profiler.sample_stacks(thread, seconds))
+                return profiler.profile_cycles(thread, seconds, params.sort, limit)
+            except profiler.CaptureBusy:
+                raise web.HTTPError("409 Conflict", {}, "Another profile is being captured\n")
+
+    class threads:
+        def GET(self):
+            web.header('Content-Type', 'text/plain')
+            return profiler.format_stacks()
+
     class users:
         def POST(self, user):
             user = urllib.unquote(user)
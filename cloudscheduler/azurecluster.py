@@ -20,6 +20,7 @@ except:
 log = utilities.get_cloudscheduler_logger()
 
 
+@cluster_tools.timed_cloud_api
 class AzureCluster(cluster_tools.ICluster):
     ERROR = 1
     DEFAULT_INSTANCE_TYPE = config.default_VMInstanceType if config.default_VMInstanceType else "m1.small"
@@ -22,6 +22,7 @@ from cStringIO import StringIO
 
 log = utilities.get_cloudscheduler_logger()
 
+@cluster_tools.timed_cloud_api
 class BotoCluster(cluster_tools.ICluster):
 
     VM_STATES = {
@@ -291,6 +292,21 @@ class BotoCluster(cluster_tools.ICluster):
             log.debug("Problem Polling vm: %s" % e.__dict__)
         return vm.status
 
+    def vm_list_states(self):
+        """List the state of every instance on the cloud, a page at a time."""
+        client = self._get_connection()
+        states = {}
+        arguments = {}
+        while True:
+            response = client.describe_instances(**arguments)
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    states[instance['InstanceId']] = instance['State']['Name']
+            if not response.get('NextToken'):
+                break
+            arguments['NextToken'] = response['NextToken']
+        return states
+
     def vm_destroy(self, vm, return_resources=True, reason=""):
         """
         Shutdown, destroy and return resources of a VM to it's cluster
@@ -3,15 +3,48 @@ Created on Jun 23, 2014
 
 @author: mhp
 '''
-import os
 import logging
-import urllib2
 import cloudscheduler.config as config
+import cloudscheduler.metrics as metrics
+import cloudscheduler.utilities as utilities
+import cloudscheduler.content_cache as content_cache
 
 log = logging.getLogger("cloudscheduler")
 
+# The parts of user data that are the same from VM to VM are rendered once
+# and kept here, keyed by their content, so a boot only renders what's new
+# to it: its cloud's name and type, its owner, its job's user data.
+RENDER_CACHE_SIZE = 256
+# (pre_init scripts) -> where the write_files go in them
+_split_scripts = utilities.LRUCache(RENDER_CACHE_SIZE)
+# A customization tuple -> its write_files entry
+_write_files = utilities.LRUCache(RENDER_CACHE_SIZE * 4)
+# (content_type_pairs, file contents) -> the MIME message
+_mime_messages = utilities.LRUCache(RENDER_CACHE_SIZE)
+# yaml -> what validate_yaml found wrong with it
+_validated_yaml = utilities.LRUCache(RENDER_CACHE_SIZE)
+
 def inject_customizations(pre_init, cloud_init):
     """ Inject cloud init style customizations into an ami/cloud init script given by user. """
+    key = tuple(pre_init)
+    split = _split_scripts.get(key)
+    if split is None:
+        split = _split_pre_init(pre_init)
+        _split_scripts.put(key, split)
+    (head, tail, found_write_files) = split
+    if not found_write_files:
+        # no writes_files found - inject one at end and do customizations
+        cloud_init.insert(0, 'write_files:')
+    parts = [head, '\n'.join(cloud_init)]
+    if tail is not None:
+        parts.append(tail)
+    return '\n'.join(parts)
+
+def _split_pre_init(pre_init):
+    """
+    The pre_init scripts as the text before and after where the write_files
+    go, and whether they have a write_files section of their own.
+    """
     # cloud init should be a list of file contents
     # Need to see if the write_files preamble exists
     found_write_files = False
@@ -30,17 +63,17 @@ def inject_customizations(pre_init, cloud_init):
                 break
             if found_write_files:
                 break
-    if not found_write_files:
-        # no writes_files found - inject one at end and do customizations
-        cloud_init.insert(0, 'write_files:')
-        splitscript.append('\n'.join(cloud_init))
-    else:
-        # need to insert at the index
-        splitscript.insert(index_of_write_files+1, '\n'.join(cloud_init))
     if not found_cloud_init:
         splitscript.insert(0, '#cloud-config')
-    return '\n'.join(splitscript)
-    
+        index_of_write_files += 1
+    if not found_write_files:
+        # the write_files go at the end
+        return ('\n'.join(splitscript), None, False)
+    # the write_files go after the index
+    head = splitscript[:index_of_write_files+1]
+    tail = splitscript[index_of_write_files+1:]
+    return ('\n'.join(head), '\n'.join(tail) if tail else None, True)
+
 def build_write_files_cloud_init(custom_tasks):
     """
     Argument:
@@ -53,34 +86,66 @@ def build_write_files_cloud_init(custom_tasks):
     for task in custom_tasks:
         if not task[1][0] or task[1][0] != '/':
             continue
-        cloud_init.append('-   content: |')
-        formatted_task = []
-        lines = task[0].split('\n')
-        for line in lines:
-            formatted_task.append(''.join(['        ', line]))
-        
-        cloud_init.append('\n'.join(formatted_task))
-        cloud_init.append('    path: %s' % task[1])
-        if len(task) > 2:
-            cloud_init.append('    permissions: %s' % task[2])
+        task = tuple(task)
+        entry = _write_files.get(task)
+        if entry is None:
+            entry = _write_file_entry(task)
+            _write_files.put(task, entry)
+        cloud_init.extend(entry)
     return cloud_init
 
+def _write_file_entry(task):
+    """The write_files lines for one custom task."""
+    entry = ['-   content: |']
+    formatted_task = []
+    lines = task[0].split('\n')
+    for line in lines:
+        formatted_task.append(''.join(['        ', line]))
+
+    entry.append('\n'.join(formatted_task))
+    entry.append('    path: %s' % task[1])
+    if len(task) > 2:
+        entry.append('    permissions: %s' % task[2])
+    return entry
+
 def build_multi_mime_message(content_type_pairs, file_type_pairs):
     """
     Argument:
     content_type_pairs - A list of tuples [(content, mime-type, filename)]
     file_type_pairs -- A list of strings formatted as file-path : mime-type
     """
+    if len(file_type_pairs) == 0:
+        return ""
+
+    files = []
+    for i in file_type_pairs:
+        (contents, format_type) = read_file_type_pairs(i)
+        if contents == None or format_type == None:
+            return None
+        files.append((i, contents, format_type))
+    key = (tuple(tuple(pair) for pair in content_type_pairs), tuple(files))
+    message = _mime_messages.get(key)
+    if message is not None:
+        metrics.user_data_renders.inc(result='hit')
+        return message
+    metrics.user_data_renders.inc(result='miss')
+    message = _build_multi_mime_message(content_type_pairs, files)
+    _mime_messages.put(key, message)
+    return message
+
+def _build_multi_mime_message(content_type_pairs, files):
+    """
+    Argument:
+    content_type_pairs - A list of tuples [(content, mime-type, filename)]
+    files -- A list of tuples [(file-path : mime-type, content, mime-type)]
+    """
     import sys
 
     from email.mime.multipart import MIMEMultipart
     from email.mime.text import MIMEText
-    
-    if len(file_type_pairs) == 0:
-        return ""
-    
+
     combined_message = MIMEMultipart()
-    for i in file_type_pairs:
+    for (i, contents, format_type) in files:
         #try:
         #    (filename, format_type) = i.split(":", 1)
         #    filename = filename.strip()
@@ -93,9 +158,6 @@ def build_multi_mime_message(content_type_pairs, file_type_pairs):
         #    continue
         #with open(filename) as fh:
         #    contents = fh.read()
-        (contents, format_type) = read_file_type_pairs(i)
-        if contents == None or format_type == None:
-            return None
         sub_message = MIMEText(contents, format_type, sys.getdefaultencoding())
         sub_message.add_header('Content-Disposition', 'attachment; filename="%s"' % (i))
         combined_message.attach(sub_message)
@@ -127,7 +189,7 @@ def read_file_type_pairs(file_type_pair):
                 http_loc = file_type_pair.strip()
                 format_type = "cloud-config"
         try:
-            content = urllib2.urlopen(http_loc).read()
+            content = content_cache.read(http_loc)
         except Exception as e:
             log.error("Unable to read url: %s" % http_loc)
             return (None, None)
@@ -139,11 +201,11 @@ def read_file_type_pairs(file_type_pair):
         except ValueError:
             filename = file_type_pair
             format_type = "cloud-config"
-        if not os.path.exists(filename):
+        try:
+            content = content_cache.read(filename)
+        except (IOError, OSError):
             log.error("Unable to find file: %s skipping" % filename)
             return (None, None)
-        with open(filename) as fh:
-            content = fh.read()
 
     if len(content) == 0:
         return (None, None)
@@ -152,6 +214,15 @@ def read_file_type_pairs(file_type_pair):
 
 def validate_yaml(content):
     """ Try to load yaml to see if it passes basic validation."""
+    if not isinstance(content, basestring):
+        return _validate_yaml(content)
+    problem = _validated_yaml.get(content, False)
+    if problem is False:
+        problem = _validate_yaml(content)
+        _validated_yaml.put(content, problem)
+    return problem
+
+def _validate_yaml(content):
     try:
         import yaml
         y = yaml.load(content)
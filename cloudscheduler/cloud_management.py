@@ -6,17 +6,19 @@ import os
 import re
 import sys
 import json
+import pipes
 import time
 import copy
 import shlex
 import string
 import logging
+import sqlite3
 import tempfile
 import threading
-import subprocess
 import ConfigParser
 
-from decimal import *
+from fractions import Fraction
+from collections import deque
 from collections import defaultdict
 
 try:
@@ -48,8 +50,15 @@ except:
     pass
 
 import cloudscheduler.config as config
+import cloudscheduler.command_runner as command_runner
+import cloudscheduler.events as events
+import cloudscheduler.fairshare as fairshare
+import cloudscheduler.metrics as metrics
 import cloudconfig
 
+from cloudscheduler.persistence import PersistenceJournal
+from cloudscheduler.state_store import StateStore
+from cloudscheduler.state_store import StoreJournal
 from cloudscheduler.utilities import determine_path
 from cloudscheduler.utilities import get_or_none
 from cloudscheduler.utilities import ErrTrackQueue
@@ -74,6 +83,68 @@ except ImportError:
 ##
 
 
+# Number of recent bans kept in ResourcePool.ban_events
+BAN_EVENT_HISTORY = 100
+# Where the shared ssh connection to the central manager is kept, see condor_command_args
+SSH_CONTROL_PATH = os.path.join(tempfile.gettempdir(), "cloudscheduler-ssh-%r@%h:%p")
+
+
+def condor_command_args(args):
+    """The command line running the condor command args, over ssh on the
+    central manager when a cloudscheduler_ssh_key is set.
+
+    The ssh runs share one connection to the central manager, kept open
+    ssh_control_persist seconds after the last one finishes.
+    """
+    if not config.cloudscheduler_ssh_key:
+        return list(args)
+    central_address = re.search('(?<=http://)(.*):', config.condor_webservice_url).group(1)
+    ssh_args = [config.ssh_path, '-i', config.cloudscheduler_ssh_key]
+    if config.ssh_control_persist > 0:
+        ssh_args.extend(['-o', 'ControlMaster=auto',
+                         '-o', 'ControlPath=%s' % SSH_CONTROL_PATH,
+                         '-o', 'ControlPersist=%d' % config.ssh_control_persist])
+    ssh_args.append(central_address)
+    ssh_args.append(' '.join(pipes.quote(arg) for arg in args))
+    return ssh_args
+
+
+def run_condor_command(args):
+    """Run the condor command args, see condor_command_args.
+
+    Returns (returncode, stdout, stderr), returncode -1 if the command
+    couldn't be run, timed out or wrote too much.
+    """
+    name = os.path.basename(args[0])
+    args = condor_command_args(args)
+    log.debug(" ".join(args))
+    result = command_runner.run(args, name=name)
+    if result.error:
+        log.error("Problem running %s: %s" % (' '.join(args), result.error))
+        return (-1, result.out, result.err)
+    return (result.returncode, result.out, result.err)
+
+
+def sent_to(returncode, out, targets):
+    """Which of targets the output of a condor daemon command says it was sent to.
+
+    Each target it was sent to gets a "Sent ..." line naming it. If every
+    target got a line but they don't name them, all were sent it.
+    """
+    sent_lines = [line for line in out.splitlines() if line.startswith("Sent")]
+    if returncode == 0 and len(sent_lines) == len(targets):
+        return [True] * len(targets)
+    return [any(target in line for line in sent_lines) for target in targets]
+
+
+def _image_for_cluster(ami, cluster):
+    """The image a job's VMAMI names for cluster. VMAMI is either a plain ami
+    or a dict of cloud name (or address) -> ami with an optional default."""
+    if isinstance(ami, dict):
+        return ami.get(cluster.name, ami.get(cluster.network_address, ami.get("default", "")))
+    return ami
+
+
 class ResourcePool:    
     
     """Stores and organises a list of Cluster resources."""
@@ -99,16 +170,44 @@ class ResourcePool:
         global log
         log = logging.getLogger("cloudscheduler")
 
-        log.verbose("New ResourcePool %s created" %name)
+        log.verbose("New ResourcePool %s created", name)
         self.name = name
 
         self.config_file = os.path.expanduser(config_file)
         self.ban_lock = threading.Lock()
         self.banned_job_resource = {}
+        self.fit_cache = {}
+        self.fit_cache_lock = threading.Lock()
+        self.fit_epoch = 0
         self.user_vm_limits = {}
+        # (image, cluster name) -> ErrTrackQueue of recent boots
         self.failures = {}
+        # failures keys with boots recorded since the last check_failures
+        self.failures_touched = set()
+        # (time, image, cluster name, failure rate) of each ban check_failures made
+        self.ban_events = deque(maxlen=BAN_EVENT_HISTORY)
+        # (image, cluster name) pairs in banned_job_resource, for quick lookups
+        self.banned_pairs = set()
         self.setup_lock = threading.Lock()
         self.setup_queued = False
+        self.persistence = PersistenceJournal()
+        # Set once the VMs from the last run have been checked against the clouds
+        self.state_ready = threading.Event()
+        # (cluster, vm, return_resources, reason) found during load_persistence,
+        # destroyed by reconcile_persisted_vms
+        self.startup_destroys = []
+        self.state_store = None
+        # Whether the ban file has been read into an empty state store
+        self.ban_file_imported = False
+        if config.state_store_file:
+            try:
+                self.state_store = StateStore(config.state_store_file)
+                self.persistence = StoreJournal(self.state_store)
+                self.failures = self.state_store.load_failures()
+            except sqlite3.Error, e:
+                log.error("Couldn't open state store %s, using the persistence file instead: %s" %
+                          (config.state_store_file, e))
+                self.state_store = None
         self.non_cs_condor_machines = set()
         self.missing_vm_condor_machines = set()
 
@@ -143,12 +242,13 @@ class ResourcePool:
             self.target_cloud_aliases = self.load_cloud_aliases(config.target_cloud_alias_file)
         else:
             self.target_cloud_aliases = {}
+        self.invalidate_fit_cache()
         self.load_persistence()
 
 
     def setup(self):
         """Read the cloud_resources.conf to determine the available clouds."""
-        log.debug("Loading cloud resource configuration file %s" % self.config_file)
+        log.debug("Loading cloud resource configuration file %s", self.config_file)
 
         if not self.setup_lock.acquire(False):
             log.warning("Reconfig already in progress, queuing the request")
@@ -171,86 +271,79 @@ class ResourcePool:
             if cloudconfig.verify_sections_base(cloud_config, cluster):
                 new_cluster = self._cluster_from_config(cloud_config, cluster)
                 if new_cluster:
+                    new_cluster.config_signature = tuple(sorted(cloud_config.items(cluster, raw=True)))
                     new_resources.append(new_cluster)
 
-        # Check to see if we are removing any clusters. If so,
-        # shut down all the VMs of the cluster we're removing
-        original_resource_names = [cluster.name for cluster in self.resources]
-        new_resource_names = [cluster.name for cluster in new_resources]
-
-        removed_names = set(original_resource_names) - set(new_resource_names)
-        added_names = set(new_resource_names) - set(original_resource_names)
-        updated_names = set(original_resource_names) & set(new_resource_names)
-
-        if removed_names:
-            log.debug("Removing clusters: %s" % removed_names)
+        # Only what changed is touched: unchanged clusters are kept as they
+        # are, changed ones are updated in place, and clusters are only
+        # added or taken out when they're added to or taken out of the file.
+        old_clusters = dict((cluster.name, cluster) for cluster in self.resources)
+        new_names = set(cluster.name for cluster in new_resources)
+        removed = [cluster for cluster in self.resources if cluster.name not in new_names]
+        resources = []
+        (added_names, updated_names, replaced_names) = ([], [], [])
+        for new_cluster in new_resources:
+            old_cluster = old_clusters.get(new_cluster.name)
+            if old_cluster is None:
+                added_names.append(new_cluster.name)
+                resources.append(new_cluster)
+            elif old_cluster.__class__ is not new_cluster.__class__:
+                replaced_names.append(new_cluster.name)
+                self._replace_cluster(old_cluster, new_cluster)
+                resources.append(new_cluster)
+            elif old_cluster.config_signature is not None and \
+                    old_cluster.config_signature == new_cluster.config_signature:
+                resources.append(old_cluster)
+            else:
+                updated_names.append(new_cluster.name)
+                over = old_cluster.reconfigure(new_cluster)
+                if over:
+                    log.warning("%s VMs now use more than its %s, no VMs will start on it "
+                                "until enough of them are gone" % (old_cluster.name, ", ".join(over)))
+                resources.append(old_cluster)
+
+        if removed:
+            log.debug("Removing clusters: %s", [cluster.name for cluster in removed])
         if added_names:
-            log.debug("Adding clusters: %s" % added_names)
+            log.debug("Adding clusters: %s", added_names)
         if updated_names:
-            log.debug("Updating clusters: %s" % updated_names)
-
-        # Set resources list to empty to make sure no VMs are started
-        # while we're shuffling things around.
-        old_resources = []
-        for cluster in reversed(self.resources):
-            with cluster.res_lock:
-                cluster.vm_slots = 0
-                cluster.memory = []
-            old_resources.append(cluster)
-            self.resources.remove(cluster)
-
-        # Update resources
-        # Do this by replacing each updated cluster object with the
-        # cluster object built by reading the config file, then copying
-        # over to the new object. Feel free to refactor me. I dare you.
-        for updated_name in updated_names:
-            for old_cluster in old_resources:
-                if old_cluster.name == updated_name:
-
-                    with old_cluster.res_lock:
-                        for new_cluster in new_resources:
-                            if new_cluster.name == updated_name:
-
-                                new_cluster.vms = sorted(old_cluster.vms, key=lambda vm: vm.id)
-                                new_cluster.vms = sorted(new_cluster.vms, key=lambda vm: vm.status)
-                                while 1:
-                                    if new_cluster.vms[0].status == "Error":
-                                        new_cluster.vms.append(new_cluster.vms.pop(0))
-                                    else:
-                                        break
-                                new_cluster.vms.reverse()
-                                
-                                for vm in reversed(new_cluster.vms):
-                                    try:
-                                        new_cluster.resource_checkout(vm)
-                                    except cluster_tools.NoResourcesError, e:
-                                        new_cluster.vm_destroy(vm, return_resources=False, reason="Not enough %s on %s." % (e.resource, new_cluster.name))
-                                    except:
-                                        new_cluster.vm_destroy(vm, return_resources=False, reason="Unexcepted error checking out resources.")
-                                self.resources.append(new_cluster)
-
-        # Add new resources
-        for new_cluster_name in added_names:
-            for new_cluster in new_resources:
-                if new_cluster.name == new_cluster_name:
-                    self.resources.append(new_cluster)
-
-        # Remove resources
-        for removed_cluster_name in removed_names:
-            for cluster in reversed(old_resources):
-                if cluster.name == removed_cluster_name:
-                    log.info("Removing %s from available resources" % 
-                                                          removed_cluster_name)
-                    self.retired_resources.append(cluster)
-                    for vm in cluster.vms:
-                            cluster.vm_destroy(vm, return_resources=False, reason="%s has been removed from system." % cluster.name)
-                    old_resources.remove(cluster)
+            log.debug("Updating clusters: %s", updated_names)
+        if replaced_names:
+            log.debug("Replacing clusters with a new cloud type: %s", replaced_names)
+
+        # Swapped in one go, so the other threads see the old list or the new one
+        self.resources = resources
+
+        # Shut down all the VMs of the clusters we're removing
+        for cluster in removed:
+            log.info("Removing %s from available resources" % cluster.name)
+            self.retired_resources.append(cluster)
+            for vm in list(cluster.vms):
+                cluster.vm_destroy(vm, return_resources=False, reason="%s has been removed from system." % cluster.name)
 
+        self.invalidate_fit_cache()
         self.setup_lock.release()
         if self.setup_queued:
             self.setup_queued = False
             self.setup()
 
+    def _replace_cluster(self, old_cluster, new_cluster):
+        """Move old_cluster's VMs onto new_cluster, a different kind of cluster
+        configured under the same name. VMs that don't fit on it are destroyed,
+        ones in Error first.
+        """
+        with old_cluster.vms_lock:
+            vms = sorted(old_cluster.vms, key=lambda vm: (vm.status == "Error", vm.status, vm.id))
+        new_cluster.enabled = old_cluster.enabled
+        new_cluster.vms = vms
+        for vm in list(vms):
+            try:
+                new_cluster.resource_checkout(vm)
+            except cluster_tools.NoResourcesError, e:
+                new_cluster.vm_destroy(vm, return_resources=False, reason="Not enough %s on %s." % (e.resource, new_cluster.name))
+            except:
+                new_cluster.vm_destroy(vm, return_resources=False, reason="Unexcepted error checking out resources.")
+
     @staticmethod
     def _cluster_from_config(cconfig, cluster):
         """Create a new cluster object from a config file's specification."""
@@ -439,6 +532,7 @@ class ResourcePool:
     def add_resource(self, cluster):
         """Add a cluster resource to the pool's resource list."""
         self.resources.append(cluster)
+        self.invalidate_fit_cache()
 
     def log_list(self, clusters):
         """Log a list of clusters.
@@ -535,58 +629,62 @@ class ResourcePool:
             log.debug("Pool is empty... Cannot return list of fitting resources")
             return []
 
+        signature = self._fit_signature('fit', network, memory, cpucores, storage, ami, imageloc, targets, blocked)
+        epoch = self.get_fit_epoch()
+        cached = self.get_cached_fit(signature, epoch)
+        if cached is not None:
+            return cached
+
         fitting_clusters = []
         if len(targets) > 0:
             clusters = self.filter_resources_by_names(targets)
         else:
             clusters = self.resources
         for cluster in clusters:
-            log.verbose("Trying with cluster %s (Name: %s)" % (str(cluster), cluster.name))
+            log.verbose("Trying with cluster %s (Name: %s)", cluster, cluster.name)
             if not cluster.enabled:
-                log.verbose("get_fitting_resources - %s is disabled - skipping" % cluster.name)
+                log.verbose("get_fitting_resources - %s is disabled - skipping", cluster.name)
                 continue
             if cluster.name in blocked:
-                log.verbose("get_fitting_resources - %s is blocked." % cluster.name)
+                log.verbose("get_fitting_resources - %s is blocked.", cluster.name)
                 continue
             if cluster.__class__.__name__ == "EC2Cluster":
                 # If no valid ami to boot from
                 if ami == "":
                     continue
                 # If ami banned from cluster
-                if ami in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[ami]:
-                        log.verbose("get_fitting_resources - %s ami banned on %s" % (ami, cluster.name))
-                        continue
+                if (_image_for_cluster(ami, cluster), cluster.name) in self.banned_pairs:
+                    log.verbose("get_fitting_resources - %s ami banned on %s", ami, cluster.name)
+                    continue
             
             elif cluster.__class__.__name__ == "StratusLabCluster" and stratuslab_support:
                 # If not valid image file
                 if imageloc == "":
                     continue
-                if imageloc in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[imageloc]:
-                        continue
+                if (imageloc, cluster.name) in self.banned_pairs:
+                    continue
                 if (not Image.isDiskId(imageloc)) and (not Image.isImageId(imageloc)):
                     continue
             
             # If the cluster has no open VM slots
             if (cluster.vm_slots <= 0):
-                log.verbose("get_fitting_resources - No free slots in %s" % cluster.name)
+                log.verbose("get_fitting_resources - No free slots in %s", cluster.name)
                 continue
             # If request exceeds the max vm memory on cluster
             if memory > cluster.max_vm_mem and cluster.max_vm_mem != -1:
-                log.verbose("get_fitting_resources - memory request exceeds max_vm_mem on %s" % cluster.name)
+                log.verbose("get_fitting_resources - memory request exceeds max_vm_mem on %s", cluster.name)
                 continue
             # If the cluster has no sufficient memory entries for the VM
             if (memory > cluster.memory):
-                log.verbose("get_fitting_resources - Not enough Memory  in %s" % cluster.name)
+                log.verbose("get_fitting_resources - Not enough Memory  in %s", cluster.name)
                 continue
             # If the cluster does not have sufficient CPU cores
             if (cpucores > cluster.cpu_cores):
-                log.verbose("get_fitting_resources - Not enough CPU Cores in %s" % cluster.name)
+                log.verbose("get_fitting_resources - Not enough CPU Cores in %s", cluster.name)
                 continue
             # If the cluster does not have sufficient storage capacity
             if (storage > cluster.storageGB):
-                log.verbose("get_fitting_resources - Not enough storage in %s" % cluster.name)
+                log.verbose("get_fitting_resources - Not enough storage in %s", cluster.name)
                 continue
             # Add cluster to the list to be returned (meets all job reqs)
             fitting_clusters.append(cluster)
@@ -595,6 +693,7 @@ class ResourcePool:
         if fitting_clusters:
             log.verbose("List of fitting clusters: ")
             self.log_list(fitting_clusters)
+        self.store_cached_fit(signature, epoch, fitting_clusters)
         return fitting_clusters
 
 
@@ -628,6 +727,12 @@ class ResourcePool:
                 If no fitting clusters are found, (None, None) is returned.
 
         """
+        signature = self._fit_signature('bf', network, memory, cpucores, storage, ami, imageloc, targets, blocked)
+        epoch = self.get_fit_epoch()
+        cached = self.get_cached_fit(signature, epoch)
+        if cached is not None:
+            return cached
+
         # Get a list of fitting clusters
         fitting_clusters = self.get_fitting_resources(network, memory, cpucores, storage, ami, imageloc, targets, blocked)
 
@@ -644,8 +749,53 @@ class ResourcePool:
         # sort them based on how full and return the list
         fitting_clusters.sort(key=lambda cluster: cluster.slot_fill_ratio())
         fitting_clusters.sort(key=lambda cluster: cluster.priority)
+        self.store_cached_fit(signature, epoch, fitting_clusters)
         return fitting_clusters
 
+    @staticmethod
+    def _fit_signature(*requirements):
+        """Turn a set of VM requirements into a hashable fit cache key."""
+        def hashable(value):
+            if isinstance(value, dict):
+                return tuple(sorted((k, hashable(v)) for k, v in value.iteritems()))
+            if isinstance(value, (list, tuple, set)):
+                return tuple(hashable(v) for v in value)
+            return value
+        return hashable(requirements)
+
+    def get_fit_epoch(self):
+        """Current capacity epoch used to key the fit cache.
+
+        Combines the cluster capacity epoch (bumped whenever a cluster's
+        enabled flag, slots, memory, cores, storage or priority is set) with
+        the pool's own epoch (bumped on ban, alias and resource list changes).
+        """
+        return (cluster_tools.ICluster.capacity_epoch, self.fit_epoch)
+
+    def get_cached_fit(self, signature, epoch):
+        """Return a copy of the cached cluster list for signature, or None if stale."""
+        with self.fit_cache_lock:
+            entry = self.fit_cache.get(signature)
+        if entry is None or entry[0] != epoch:
+            return None
+        return list(entry[1])
+
+    def store_cached_fit(self, signature, epoch, clusters):
+        """Cache a fitting cluster list computed at the given epoch."""
+        with self.fit_cache_lock:
+            if epoch != self.get_fit_epoch():
+                # Something changed while computing, don't keep it
+                return
+            if len(self.fit_cache) >= 10000:
+                self.fit_cache.clear()
+            self.fit_cache[signature] = (epoch, list(clusters))
+
+    def invalidate_fit_cache(self):
+        """Throw away cached fitting cluster lists after a ban, alias or resource change."""
+        with self.fit_cache_lock:
+            self.fit_epoch += 1
+            self.fit_cache.clear()
+
     def resourcePF(self, network, memory=0, disk=0):
         """
         Check that a cluster will be able to meet the static requirements.
@@ -724,7 +874,7 @@ class ResourcePool:
             if cluster != None:
                 clusters.append(cluster)
             else:
-                log.debug("No Cluster with name %s in system" % name)
+                log.debug("No Cluster with name %s in system", name)
         return clusters
 
     def get_cluster(self, cluster_name, retired=False):
@@ -773,21 +923,21 @@ class ResourcePool:
         Returns a list of dictionaries with information about the machines
         registered with condor.
         """
-        log.verbose("Querying Condor Collector with %s" % config.condor_status_command)
-        condor_status=condor_out=condor_err=""
-        try:
-            condor_status = shlex.split(config.condor_status_command)
-            sp = subprocess.Popen(condor_status, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sp.communicate(input=None)
-        except OSError:
-            log.error("OSError occured while doing condor_status - will try again next cycle.")
-            return []
-        except:
-            log.exception("Problem running %s, unexpected error: %s" % (string.join(condor_status, " "), condor_err))
+        log.verbose("Querying Condor Collector with %s", config.condor_status_command)
+        condor_status = shlex.split(config.condor_status_command)
+        result = command_runner.run(condor_status, timeout=config.condor_query_timeout, name="condor_status")
+        if result.error:
+            metrics.condor_query_errors.inc(command="condor_status")
+            log.error("Problem running %s: %s - will try again next cycle." % (string.join(condor_status, " "), result.error))
             return []
+        condor_out = result.out
+        metrics.condor_query_seconds.observe(result.duration, command="condor_status")
+        metrics.condor_query_bytes.set(len(condor_out), command="condor_status")
 
-        return self._condor_status_to_machine_list(condor_out)
+        start = time.time()
+        machines = self._condor_status_to_machine_list(condor_out)
+        metrics.condor_parse_seconds.observe(time.time() - start, command="condor_status")
+        return machines
 
     def master_resource_query_local(self):
         """
@@ -796,21 +946,21 @@ class ResourcePool:
         Returns a list of dictionaries with information about the machines masters
         registered with condor.
         """
-        log.verbose("Querying Condor Collector with %s" % config.condor_status_master_command)
-        condor_status=condor_out=condor_err=""
-        try:
-            condor_status = shlex.split(config.condor_status_master_command)
-            sp = subprocess.Popen(condor_status, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sp.communicate(input=None)
-        except OSError:
-            log.error("OSError occured while doing condor_status -master - will try again next cycle.")
-            return []
-        except:
-            log.exception("Problem running %s, unexpected error: %s" % (string.join(condor_status, " "), condor_err))
+        log.verbose("Querying Condor Collector with %s", config.condor_status_master_command)
+        condor_status = shlex.split(config.condor_status_master_command)
+        result = command_runner.run(condor_status, timeout=config.condor_query_timeout, name="condor_status_master")
+        if result.error:
+            metrics.condor_query_errors.inc(command="condor_status_master")
+            log.error("Problem running %s: %s - will try again next cycle." % (string.join(condor_status, " "), result.error))
             return []
+        condor_out = result.out
+        metrics.condor_query_seconds.observe(result.duration, command="condor_status_master")
+        metrics.condor_query_bytes.set(len(condor_out), command="condor_status_master")
 
-        return self._condor_status_to_machine_list(condor_out)
+        start = time.time()
+        machines = self._condor_status_to_machine_list(condor_out)
+        metrics.condor_parse_seconds.observe(time.time() - start, command="condor_status_master")
+        return machines
 
     @staticmethod
     def _condor_status_to_machine_list(condor_status_output):
@@ -887,7 +1037,7 @@ class ResourcePool:
                     log.warning("VM Missing a Start attrib on %s." % vm.machine_name)
                 if not vm.vmtype:
                     log.warning("This VM %s has no VMType key, It should not be used with cloudscheduler." % vm.machine_name)
-        log.verbose("VMs in machinelist: %s" % str(count))
+        log.verbose("VMs in machinelist: %s", count)
         return count
 
     def match_criteria(self, base, criteria):
@@ -951,6 +1101,14 @@ class ResourcePool:
                     count += 1
         return count
 
+    def get_vm_count_by_user(self):
+        """Get a dictionary of users and how many VMs each has."""
+        counts = defaultdict(int)
+        for cluster in self.resources:
+            for vm in cluster.vms:
+                counts[vm.user] += 1
+        return counts
+
     def vm_count(self):
         """Count of VMs in the system."""
         count = 0
@@ -962,13 +1120,7 @@ class ResourcePool:
         """VM Type Distribution."""
         if types is None:
             types = self.get_vmtypes_count_internal()
-        count = Decimal(self.vm_count())
-        if count == 0:
-            return {}
-        count = 1 / count
-        for vmtype in types.keys():
-            types[vmtype] *= count
-        return types
+        return fairshare.shares(types, self.vm_count())
 
     def vmtype_mem_distribution(self, vmcount=None):
         """VM Type Memory Distribution."""
@@ -976,18 +1128,7 @@ class ResourcePool:
             usage = self.vmtype_resource_usage_sim(vmcount)
         else:
             usage = self.vmtype_resource_usage()
-        types = {}
-        mem_total = 0
-        for vmtype in usage:
-            types[vmtype] = usage[vmtype][0]
-            mem_total += usage[vmtype][0]
-        del usage
-        if mem_total == 0:
-            return {}
-        mem_total = 1 / Decimal(mem_total)
-        for vmtype in types.keys():
-            types[vmtype] *= mem_total
-        return types
+        return fairshare.shares(dict((vmtype, res[0]) for vmtype, res in usage.iteritems()))
 
     def vmtype_mem_cpu_distribution(self, vmcount=None):
         """VM Type Memory & CPU Distribution."""
@@ -995,19 +1136,7 @@ class ResourcePool:
             usage = self.vmtype_resource_usage_sim(vmcount)
         else:
             usage = self.vmtype_resource_usage()
-        types = {}
-        mem_cpu_total = 0
-        for vmtype in usage:
-            mem_cpu_area = usage[vmtype][0] * usage[vmtype][1]
-            types[vmtype] = mem_cpu_area
-            mem_cpu_total += mem_cpu_area
-        del usage
-        if mem_cpu_total == 0:
-            return {}
-        mem_cpu_total = 1 / Decimal(mem_cpu_total)
-        for vmtype in types.keys():
-            types[vmtype] *= mem_cpu_total
-        return types
+        return fairshare.shares(dict((vmtype, res[0] * res[1]) for vmtype, res in usage.iteritems()))
 
     def vmtype_mem_cpu_storage_distribution(self, vmcount=None):
         """VM Type Memory & CPU & Storage Distribution."""
@@ -1023,19 +1152,15 @@ class ResourcePool:
             vol = 0
             if usage[vmtype][2] != 0:
                 vol = usage[vmtype][0] * usage[vmtype][1] * usage[vmtype][2] * weight_all
-                types[vmtype] = Decimal(str(vol))
             else:
                 vol = usage[vmtype][0] * usage[vmtype][1] * weight_cm
-                types[vmtype] = Decimal(str(vol))
+            # weights are floats, take them at their printed precision
+            types[vmtype] = Fraction(str(vol))
             vol_total += vol
         del usage
         if vol_total == 0:
             return {}
-        if vol_total != 0:
-            mem_cpu_storage_total = 1 / Decimal(str(vol_total))
-        for vmtype in types.keys():
-            types[vmtype] *= mem_cpu_storage_total
-        return types
+        return fairshare.shares(types, Fraction(str(vol_total)))
 
 
     def vmtype_resource_usage(self):
@@ -1057,17 +1182,12 @@ class ResourcePool:
         Will not be able to handle cases where VMs of the same type but different resource usages exist."""
         # Locate a VM for each type in vmcount
         types = {}
+        for cluster in self.resources:
+            for vm in cluster.vms:
+                if vm.uservmtype in vmcount and vm.uservmtype not in types:
+                    types[vm.uservmtype] = vm
         for vmusertype in vmcount.keys():
-            foundIt = False
-            for cluster in self.resources:
-                for vm in cluster.vms:
-                    if vm.uservmtype == vmusertype:
-                        foundIt = True
-                        types[vmusertype] = vm
-                        break
-                if foundIt:
-                    break
-            if not foundIt:
+            if vmusertype not in types:
                 log.warning("Unable to find VM with type %s" % vmusertype)
         results = {}
         # Compute the resource usage based on given counts instead of checking every VM.
@@ -1116,17 +1236,17 @@ class ResourcePool:
             changed[n] = changed[n].split('.')[0]
         return changed
 
-    def save_persistence(self):
+    def save_persistence(self, compact=False):
         """
-        save_persistence - pickle the resources list to the persistence file
+        save_persistence - journal the changes to the resources lists since
+                           the last save, or write a new snapshot of them to
+                           the persistence file if compact is set or the
+                           journal is full
         """
         with self.setup_lock:
             try:
-                persistence_file = open(config.persistence_file, "wb")
-                pickle.dump([self.resources,self.retired_resources], persistence_file)
-                persistence_file.close()
-            except IOError, e:
-    
+                self.persistence.save(self.resources, self.retired_resources, compact)
+            except (IOError, OSError), e:
                 log.error("Couldn't write persistence file to %s! \"%s\"" % 
                           (config.persistence_file, e.strerror))
             except:
@@ -1134,36 +1254,23 @@ class ResourcePool:
 
     def load_persistence(self):
         """
-        load_persistence - if a pickled persistence file exists, load it and 
-                           check to see if the resources described in it are
+        load_persistence - load the VMs saved by the last run, from the state
+                           store if it has them or the persistence file, and
+                           check to see if the resources described are
                            valid. If so, add them to the list of resources.
         """
-
-        try:
-            log.info("Loading persistence file from last run.")
-            persistence_file = open(config.persistence_file, "rb")
-        except IOError, e:
-            log.debug("No persistence file to load. Exited normally last time.")
-            return
-        except:
-            log.exception("Unknown problem opening persistence file!")
-            return
-
-        try:
-            all_resources = pickle.load(persistence_file)
-            old_resources = all_resources[0]
-            old_retired_resources = all_resources[1]
-        except:
-            log.exception("Unknown problem unpickling persistence file!")
+        if self.state_store and self.state_store.has_resources():
+            log.info("Loading VMs from state store %s." % config.state_store_file)
             try:
-                pbak = open('/tmp/cloudscheduler.persistence.bak', 'wb')
-                persistence_file = open(config.persistence_file, "rb")
-                pcontents = persistence_file.read()
-                pbak.write(pcontents)
-            except Exception as e:
-                log.error("Problem trying to create backup pickle: %s" % e)
-            return
-        persistence_file.close()
+                (old_resources, old_retired_resources) = self.state_store.load_resources()
+            except:
+                log.exception("Unknown problem loading VMs from the state store!")
+                return
+        else:
+            all_resources = self.read_persistence_file()
+            if not all_resources:
+                return
+            (old_resources, old_retired_resources) = all_resources
 
         self.retired_resources = old_retired_resources
 
@@ -1179,7 +1286,7 @@ class ResourcePool:
                     new_cluster.count = old_cluster.count
 
             for vm in old_cluster.vms:
-                log.debug("Found VM %s on %s" % (vm.id, old_cluster.name))
+                log.debug("Found VM %s on %s", vm.id, old_cluster.name)
                 if new_cluster:
                     try:
                         new_cluster.resource_checkout(vm)
@@ -1206,16 +1313,108 @@ class ResourcePool:
                             vm.return_resources = False
                             self.force_retire_vm(vm)
                         else:
-                            new_cluster.vm_destroy(vm, return_resources=False, reason="Not enough %s left on %s" %(e.resource, new_cluster.name))
+                            self.startup_destroys.append((new_cluster, vm, False, "Not enough %s left on %s" %(e.resource, new_cluster.name)))
                     except:
                         if config.retire_reallocate:
                             self.force_retire_vm(vm)
                         else:
-                            new_cluster.vm_destroy(vm, return_resources=False, reason="Unexpected error checking out resources.")
+                            self.startup_destroys.append((new_cluster, vm, False, "Unexpected error checking out resources."))
                 else:
                     log.info("%s doesn't seem to exist, so destroying vm %s." %
                              (old_cluster.name, vm.id))
-                    old_cluster.vm_destroy(vm, reason="cloud %s no longer exists." % old_cluster.name)
+                    self.startup_destroys.append((old_cluster, vm, True, "cloud %s no longer exists." % old_cluster.name))
+
+    def start_reconciliation(self):
+        """Run reconcile_persisted_vms in the background."""
+        thread = threading.Thread(target=self.reconcile_persisted_vms, name="Reconciliation")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def reconcile_persisted_vms(self):
+        """
+        reconcile_persisted_vms - check the VMs loaded from the last run against
+                    what the clouds actually have, every cloud at once, then
+                    set state_ready.
+
+        Each cloud's instances are listed in a single query where the cloud
+        type supports it (ICluster.vm_list_states) and matched to the VMs by
+        id. VMs the cloud no longer has are marked for the VMPoller to clean
+        up. The VMs load_persistence couldn't place are destroyed here too.
+        """
+        start = time.time()
+        destroys = defaultdict(list)
+        clusters = list(self.resources) + list(self.retired_resources)
+        for (cluster, vm, return_resources, reason) in self.startup_destroys:
+            if cluster not in clusters:
+                clusters.append(cluster)
+            destroys[id(cluster)].append((vm, return_resources, reason))
+        self.startup_destroys = []
+
+        threads = []
+        for cluster in clusters:
+            if not cluster.vms and not destroys[id(cluster)]:
+                continue
+            thread = ClusterReconciler(cluster, destroys[id(cluster)])
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        log.info("Reconciled %d VMs on %d clouds with the last run's state in %.1fs, %d missing" %
+                 (sum(thread.checked for thread in threads), len(threads), time.time() - start,
+                  sum(thread.missing for thread in threads)))
+        self.state_ready.set()
+
+    def wait_for_state_ready(self, timeout, stop=None):
+        """
+        wait_for_state_ready - block until reconciliation is done, timeout
+                    seconds have passed or stop() returns True. Returns
+                    True if the state is ready.
+        """
+        waited = 0
+        while not self.state_ready.is_set() and waited < timeout:
+            if stop and stop():
+                break
+            self.state_ready.wait(1)
+            waited += 1
+        return self.state_ready.is_set()
+
+    def read_persistence_file(self):
+        """
+        read_persistence_file - unpickle the persistence file and replay its
+                                journal. Returns [resources, retired_resources]
+                                or None if there is nothing to load.
+        """
+        try:
+            log.info("Loading persistence file from last run.")
+            persistence_file = open(config.persistence_file, "rb")
+        except IOError, e:
+            log.debug("No persistence file to load. Exited normally last time.")
+            return None
+        except:
+            log.exception("Unknown problem opening persistence file!")
+            return None
+
+        try:
+            all_resources = pickle.load(persistence_file)
+            old_resources = all_resources[0]
+            old_retired_resources = all_resources[1]
+            # Files written before snapshots had generations hold only the two lists
+            generation = all_resources[2] if len(all_resources) > 2 else None
+        except:
+            log.exception("Unknown problem unpickling persistence file!")
+            try:
+                pbak = open('/tmp/cloudscheduler.persistence.bak', 'wb')
+                persistence_file = open(config.persistence_file, "rb")
+                pcontents = persistence_file.read()
+                pbak.write(pcontents)
+            except Exception as e:
+                log.error("Problem trying to create backup pickle: %s" % e)
+            return None
+        persistence_file.close()
+        PersistenceJournal().replay(old_resources, old_retired_resources, generation)
+        return [old_resources, old_retired_resources]
 
     def track_failures(self, job, resources,  value):
         """Error Tracking to be used to ban / filter resources."""
@@ -1226,52 +1425,56 @@ class ResourcePool:
                     continue
                 if (not Image.isDiskId(job.req_imageloc)) and (not Image.isImageId(job.req_imageloc)):
                     continue
-                for resource in self.failures[job.req_imageloc]:
-                    if resource.name == cluster.name:
-                        resource.append(value)
+                image = job.req_imageloc
             else:
-                if job.req_ami in self.failures.keys():
-                    foundIt = False
-                    for resource in self.failures[job.req_ami]:
-                        if resource.name == cluster.name:
-                            resource.append(value)
-                            foundIt = True
-                        if foundIt:
-                            break
-                        else:
-                            queue = ErrTrackQueue(cluster.name)
-                            queue.append(value)
-                            self.failures[job.req_ami].append(queue)
-                else:
-                    self.failures[job.req_ami] = []
-                    queue = ErrTrackQueue(cluster.name)
-                    queue.append(value)
-                    self.failures[job.req_ami].append(queue)
-
+                image = _image_for_cluster(job.req_ami, cluster)
+            if self.state_store:
+                self.state_store.add_failure(image, cluster.name, value)
+            key = (image, cluster.name)
+            if key not in self.failures:
+                self.failures[key] = ErrTrackQueue(cluster.name)
+            self.failures[key].append(value)
+            self.failures_touched.add(key)
 
     def check_failures(self):
-        """Check if failures have crossed the threshold and ban job from resources."""
+        """Check if the failures recorded since the last check have crossed
+        the threshold and ban job from resources."""
         with self.ban_lock:
+            touched = self.failures_touched
+            self.failures_touched = set()
             banned_changed = False
-            for img in self.failures.keys():
-                for cq in self.failures[img]:
-                    if cq.min_use() and cq.dist_false() == config.ban_failrate_threshold:
-                        # add this img / cluster entry to banned jobs
-                        if img in self.banned_job_resource.keys():
-                            if cq.name not in self.banned_job_resource[img]:
-                                self.banned_job_resource[img].append(cq.name)
-                                banned_changed = True
-                        else:
-                            self.banned_job_resource[img] = []
-                            self.banned_job_resource[img].append(cq.name)
-                            banned_changed = True
+            for key in touched:
+                cq = self.failures.get(key)
+                if not cq or key in self.banned_pairs:
+                    continue
+                if cq.min_use() and cq.dist_false() >= config.ban_failrate_threshold:
+                    # add this img / cluster entry to banned jobs
+                    (img, cluster_name) = key
+                    self.banned_job_resource.setdefault(img, []).append(cluster_name)
+                    self.banned_pairs.add(key)
+                    self.ban_events.append((time.time(), img, cluster_name, cq.dist_false()))
+                    events.feed.emit('ban', image=img, cloud=cluster_name, failure_rate=cq.dist_false())
+                    log.info("Banning %s on %s, %d of its last %d boots failed" %
+                             (img, cluster_name, cq.failures, len(cq.data)))
+                    banned_changed = True
             if banned_changed:
+                self.invalidate_fit_cache()
                 self.save_banned_job_resource()
                 log.verbose("Updating Banned job file")
 
+    @staticmethod
+    def _ban_pairs(banned_job_resource):
+        """The (image, cluster name) pairs in a banned_job_resource dict."""
+        return set((img, cluster_name) for (img, cluster_names) in banned_job_resource.iteritems()
+                   for cluster_name in cluster_names)
+
     def save_banned_job_resource(self):
         """
-        save_banned_job_resource - pickle the banned jobs list to file """
+        save_banned_job_resource - write the banned jobs list to the state
+                    store if there is one, otherwise to the ban file """
+        if self.state_store:
+            self.state_store.save_bans(self.banned_job_resource)
+            return
         try:
             ban_file = open(config.ban_file, "w")
             ban_file.write(json.dumps(self.banned_job_resource, encoding='ascii'))
@@ -1283,56 +1486,71 @@ class ResourcePool:
         except:
             log.exception("Unknown problem saving ban file!")
 
+    def read_ban_file(self):
+        """
+        read_ban_file - the bans in the ban file, {} if there isn't one or
+                    None if it can't be read.
+        """
+        no_bans = False
+        ban_file = None
+        updated_ban = {}
+        try:
+            log.info("Loading ban file.")
+            ban_file = open(config.ban_file, "r")
+        except IOError, e:
+            log.debug("No ban file to load. No images banned.")
+            no_bans = True
+        except:
+            log.exception("Unknown problem opening ban file!")
+            return None
+        try:
+            if not no_bans:
+                updated_ban = json.loads(ban_file.read(), encoding='ascii')
+                ban_file.close()
+        except:
+            log.exception("Unknown problem opening ban file!")
+            return None
+        return updated_ban
+
     def load_banned_job_resource(self):
         """
-        load_banned_job_resource - reload the file to update which images
-                    have been banned from clusters.
+        load_banned_job_resource - reload the file (or the state store's bans)
+                    to update which images have been banned from clusters.
         """
         with self.ban_lock:
-            no_bans = False
-            ban_file = None
-            try:
-                log.info("Loading ban file.")
-                ban_file = open(config.ban_file, "r")
-            except IOError, e:
-                log.debug("No ban file to load. No images banned.")
-                no_bans = True
-            except:
-                log.exception("Unknown problem opening ban file!")
-                return
-            updated_ban = {}
-            try:
-                if not no_bans:
-                    updated_ban = json.loads(ban_file.read(), encoding='ascii')
-                    ban_file.close()
-            except:
-                log.exception("Unknown problem opening ban file!")
-                return
+            if self.state_store:
+                log.info("Loading bans from state store.")
+                try:
+                    updated_ban = self.state_store.load_bans()
+                except sqlite3.Error, e:
+                    log.error("Couldn't load bans from state store %s: %s" % (config.state_store_file, e))
+                    return
+                if not updated_ban and not self.ban_file_imported:
+                    # A store that was just turned on starts from the ban file,
+                    # the way load_persistence starts from the persistence file
+                    updated_ban = self.read_ban_file()
+                    if updated_ban is None:
+                        return
+                    self.ban_file_imported = True
+                    if updated_ban:
+                        log.info("Importing the bans in %s into the state store." % config.ban_file)
+                        self.state_store.save_bans(updated_ban)
+            else:
+                updated_ban = self.read_ban_file()
+                if updated_ban is None:
+                    return
             # Need to go through the failures and 'reset' any of the 
             # bans that have been removed
-            if len(updated_ban) == 0:
-                for img in self.banned_job_resource.keys():
-                    for res in self.banned_job_resource[img]:
-                        foundit = False
-                        for cl in self.failures[img]:
-                            if cl.name == res:
-                                foundit = True
-                                cl.clear()
-                            if foundit:
-                                break
-            else:
-                for img in updated_ban.keys():
-                    if img in self.banned_job_resource.keys():
-                        diff = set(self.banned_job_resource[img]) - set(updated_ban[img])
-                        for res in diff:
-                            foundit = False
-                            for cl in self.failures[img]:
-                                if cl.name == res:
-                                    foundit = True
-                                    cl.clear()
-                                if foundit:
-                                    break
+            updated_pairs = self._ban_pairs(updated_ban)
+            for key in self.banned_pairs - updated_pairs:
+                if key in self.failures:
+                    self.failures[key].clear()
+                events.feed.emit('unban', image=key[0], cloud=key[1])
+            for key in updated_pairs - self.banned_pairs:
+                events.feed.emit('ban', image=key[0], cloud=key[1], failure_rate=None)
             self.banned_job_resource = updated_ban
+            self.banned_pairs = updated_pairs
+            self.invalidate_fit_cache()
 
     def load_user_limits(self, path=None):
             limit_file = None
@@ -1379,113 +1597,74 @@ class ResourcePool:
     def do_condor_off(self, machine_name, machine_addr, master_addr):
         """Perform a condor_off on an execute node.
 
-        Executes multiple commands to condor in order to peacefully stop the start deamon
-        on a VM so that it will finish its current job but accept no new jobs.
-        
+        Peacefully stops the start deamon and master on a VM so that it will
+        finish its current job but accept no new jobs, see do_condor_off_batch.
+
         Keywords:
             machine_name - the condor machine name to condor_off
             machine_addr - the condor machine addr to condor_off
+            master_addr  - the condor master addr to condor_off
         Return:
-            a 3 tuple of the returncodes from the 2 commands used and a return code
+            a 4 tuple of return codes, all 0 if both the startd and master were sent the condor_off
         """
-        log.debug("cloud_management.py::do_condor_off: %s, addr: %s, master_addr: %s"%(machine_name,machine_addr,master_addr))
-        #cmd = '%s -peaceful -name "%s" -subsystem startd' % (config.condor_off_command, machine_name)
-        cmd2 = '%s -peaceful -addr "%s" -subsystem startd' % (config.condor_off_command, machine_addr)
-        cmd3 = '%s -peaceful -addr "%s" -subsystem master' % (config.condor_off_command, master_addr)
-        #args = []
-        args2 = []
-        args3 = []
-        if machine_name == None:
-            machine_name = 'NoneType'
-        if machine_addr == None:
-            machine_addr = 'NoneType'
-            log.debug("Start Addr is None for Machine: %s cannot do condor_off." % machine_name)
-            return (-1,-1,-1,-1)
-        if master_addr == None:
-            master_addr = 'NoneType'
-            log.debug("Master Addr is None for Machine: %s cannot do condor_off." % machine_name)
-            return (-1,-1,-1,-1)
-        if config.cloudscheduler_ssh_key:
-            #args.append(config.ssh_path)
-            #args.append('-i')
-            #args.append(config.cloudscheduler_ssh_key)
-            central_address = re.search('(?<=http://)(.*):', config.condor_webservice_url).group(1)
-            #args.append(central_address)
-            #args.append(cmd)
-            
-            args2.append(config.ssh_path)
-            args2.append('-i')
-            args2.append(config.cloudscheduler_ssh_key)
-            args2.append(central_address)
-            args2.append(cmd2)
-            
-            args3.append(config.ssh_path)
-            args3.append('-i')
-            args3.append(config.cloudscheduler_ssh_key)
-            args3.append(central_address)
-            args3.append(cmd3)
-        else:
-            #args.append(config.condor_off_command)
-            #args.append('-peaceful')
-            #args.append('-name')
-            #args.append(machine_name)
-            #args.append('-subsystem')
-            #args.append('startd')
-            
-            args2.append(config.condor_off_command)
-            args2.append('-peaceful')
-            args2.append('-addr')
-            args2.append(machine_addr)
-            args2.append('-subsystem')
-            args2.append('startd')
-            
-            args3.append(config.condor_off_command)
-            args3.append('-peaceful')
-            args3.append('-addr')
-            args3.append(master_addr)
-            args3.append('-subsystem')
-            args3.append('master')
-        # Send condor_off to startd first
-        try:
-            log.debug(" ".join(args2))
-            sp1 = subprocess.Popen(args2, shell=False,
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp1):
-                (out, err) = sp1.communicate(input=None)
-            ret1 = -1
-            if out.startswith("Sent"):
-                ret1 = 0
-            if sp1.returncode == 0 and ret1 == 0:
-                log.debug("Successfuly sent condor_off startd to %s" % (machine_name))
+        if self.do_condor_off_batch([(machine_name, machine_addr, master_addr)])[0]:
+            return (0, 0, 0, 0)
+        return (-1, -1, -1, -1)
+
+    def do_condor_off_batch(self, machines):
+        """Perform a condor_off on many execute nodes.
+
+        Each condor_off run is given up to condor_control_batch_size machines,
+        and up to condor_control_threads runs are done at once. The startds of
+        a batch are sent the condor_off first, then their masters.
+
+        Keywords:
+            machines - list of (machine_name, machine_addr, master_addr)
+        Return:
+            a list of booleans in the order of machines, True where both the
+            startd and master were sent the condor_off
+        """
+        results = [False] * len(machines)
+        batch = []
+        for (index, (machine_name, machine_addr, master_addr)) in enumerate(machines):
+            if machine_addr == None:
+                log.debug("Start Addr is None for Machine: %s cannot do condor_off.", machine_name)
+            elif master_addr == None:
+                log.debug("Master Addr is None for Machine: %s cannot do condor_off.", machine_name)
             else:
-                log.debug("Failed to send condor_off startd to %s: Reason: %s. Err: %s" % (machine_name, out, err))
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"" % (' '.join(args2), e.errno, e.strerror))
-            return (-1, -1, -1, -1)
-        except:
-            log.error("Problem running %s, unexpected error" % ' '.join(args2))
-            return (-1, -1, -1, -1)
-        # Now send the master off
-        try:
-            log.debug(" ".join(args3))
-            sp2 = subprocess.Popen(args3, shell=False,
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp2):
-                (out, err) = sp2.communicate(input=None)
-            ret2 = -1
-            if out.startswith("Sent"):
-                ret2 = 0
-            if sp2.returncode == 0 and ret2 == 0:
-                log.debug("Successfuly sent condor_off master to %s" % (machine_name))
+                batch.append((index, machine_name, machine_addr, master_addr))
+        for done in utilities.parallel_map(self._condor_off_chunk,
+                                           utilities.chunks(batch, config.condor_control_batch_size),
+                                           config.condor_control_threads):
+            for index in done or ():
+                results[index] = True
+        return results
+
+    def _condor_off_chunk(self, batch):
+        """condor_off the startds, then the masters, of one batch. Returns the indexes of the machines done."""
+        startds_sent = self._condor_off_subsystem('startd', [entry[2] for entry in batch])
+        masters_sent = self._condor_off_subsystem('master', [entry[3] for entry in batch])
+        done = []
+        for ((index, machine_name, _, _), startd_sent, master_sent) in zip(batch, startds_sent, masters_sent):
+            if startd_sent and master_sent:
+                log.debug("Successfuly sent condor_off to %s", machine_name)
+                done.append(index)
             else:
-                log.debug("Failed to send condor_off master to %s : Reason: %s : Error: %s" % (machine_name, out, err))
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"" % (' '.join(args3), e.errno, e.strerror))
-            return (-1, -1, -1, -1)
-        except:
-            log.error("Problem running %s, unexpected error" % ' '.join(args3))
-            return (-1, -1, -1, -1)
-        return (sp1.returncode, ret1, sp2.returncode, ret2)
+                log.debug("Failed to send condor_off to %s, startd sent: %s, master sent: %s",
+                          machine_name, startd_sent, master_sent)
+        return done
+
+    def _condor_off_subsystem(self, subsystem, addresses):
+        """Peaceful condor_off of subsystem at each of addresses in one run. Returns which were sent it."""
+        args = [config.condor_off_command, '-peaceful', '-subsystem', subsystem]
+        for address in addresses:
+            args.extend(['-addr', address])
+        (returncode, out, err) = run_condor_command(args)
+        sent = sent_to(returncode, out, addresses)
+        if not all(sent):
+            log.debug("condor_off %s was not sent to %d of %d: Reason: %s. Err: %s",
+                      subsystem, sent.count(False), len(addresses), out, err)
+        return sent
 
     def do_condor_advertise_master(self, target_file):
         """Perform a condor_advertise INVALIDATE_MASTER_ADS on condor pool.
@@ -1497,46 +1676,7 @@ class ResourcePool:
         Return:
             a tuple of the returncodes from the command used and a return code
         """
-        log.debug("cloud_management.py::do_advertise_master - target_file: %s" % (target_file))
-
-        cmd = '%s INVALIDATE_MASTER_ADS "%s"' % (config.condor_advertise_command, target_file)
-        args = []
-
-        if target_file == None:
-            log.error("No target_file specified, cannot perform condor_advertise INVALIDATE_MASTER_ADS")
-            return (-1,-1)
-        if config.cloudscheduler_ssh_key:
-            central_address = re.search('(?<=http://)(.*):', config.condor_webservice_url).group(1)
-            args.append(config.ssh_path)
-            args.append('-i')
-            args.append(config.cloudscheduler_ssh_key)
-            args.append(central_address)
-            args.append(cmd)
-        else:
-            args.append(config.condor_advertise_command)
-            args.append('INVALIDATE_MASTER_ADS')
-            args.append(target_file)
-        try:
-            log.debug(" ".join(args))
-            sp1 = subprocess.Popen(args, shell=False,
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp1):
-                (out, err) = sp1.communicate(input=None)
-            ret1 = -1
-            if out.startswith("Sent"):
-                ret1 = 0
-            if sp1.returncode == 0:
-                log.verbose("Successfuly sent condor_advertise invalidate_master_ads %s" % (target_file))
-            else:
-                log.debug("Failed to send condor_advertise invalidate_master_ads %s: Reason: %s. Err: %s" % (target_file, out, err))
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"" % (' '.join(args), e.errno, e.strerror))
-            return (-1, -1)
-        except:
-            log.error("Problem running %s, unexpected error" % ' '.join(args))
-            return (-1, -1)
-
-        return (sp1.returncode, ret1)
+        return self._condor_advertise('INVALIDATE_MASTER_ADS', target_file)
 
     def do_condor_advertise_startd(self, target_file):
         """Perform a condor_advertise INVALIDATE_STARTD_ADS on condor pool.
@@ -1548,46 +1688,57 @@ class ResourcePool:
         Return:
             a tuple of the returncodes from the command used and a return code
         """
-        log.debug("cloud_management.py::do_advertise_startd - target_file: %s" % (target_file))
-
-        cmd = '%s INVALIDATE_STARTD_ADS "%s"' % (config.condor_advertise_command, target_file)
-        args = []
+        return self._condor_advertise('INVALIDATE_STARTD_ADS', target_file)
 
+    def _condor_advertise(self, command, target_file):
+        log.debug("cloud_management.py::condor_advertise %s - target_file: %s", command, target_file)
         if target_file == None:
-            log.error("No target_file specified, cannot perform condor_advertise INVALIDATE_STARTD_ADS")
-            return (-1,-1)
-        if config.cloudscheduler_ssh_key:
-            central_address = re.search('(?<=http://)(.*):', config.condor_webservice_url).group(1)
-            args.append(config.ssh_path)
-            args.append('-i')
-            args.append(config.cloudscheduler_ssh_key)
-            args.append(central_address)
-            args.append(cmd)
-        else:
-            args.append(config.condor_advertise_command)
-            args.append('INVALIDATE_STARTD_ADS')
-            args.append(target_file)
-        try:
-            log.debug(" ".join(args))
-            sp1 = subprocess.Popen(args, shell=False,
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if not utilities.check_popen_timeout(sp1):
-                (out, err) = sp1.communicate(input=None)
-            ret1 = -1
-            if out.startswith("Sent"):
-                ret1 = 0
-            if sp1.returncode == 0:
-                log.verbose("Successfuly sent condor_advertise invalidate_startd_ads %s" % (target_file))
-            else:
-                log.debug("Failed to send condor_advertise invalidate_startd_ads %s: Reason: %s. Err: %s" % (target_file, out, err))
-        except OSError, e:
-            log.error("Problem running %s, got errno %d \"%s\"" % (' '.join(args), e.errno, e.strerror))
-            return (-1, -1)
-        except:
-            log.error("Problem running %s, unexpected error" % ' '.join(args))
+            log.error("No target_file specified, cannot perform condor_advertise %s" % command)
             return (-1, -1)
+        (returncode, out, err) = run_condor_command([config.condor_advertise_command, command, target_file])
+        ret1 = -1
+        if out.startswith("Sent"):
+            ret1 = 0
+        if returncode == 0:
+            log.verbose("Successfuly sent condor_advertise %s %s", command.lower(), target_file)
+        else:
+            log.debug("Failed to send condor_advertise %s %s: Reason: %s. Err: %s", command.lower(), target_file, out, err)
+        return (returncode, ret1)
 
-        return (sp1.returncode, ret1)
+    def do_condor_advertise_invalidate(self, machines):
+        """Remove the master and startd classads of machines from the condor pool.
+
+        One master and one startd target file are written, and condor_advertise
+        run on each, for every condor_control_batch_size machines. Up to
+        condor_control_threads batches are done at once.
+
+        Keywords:
+            machines - dict of machine name -> the names of its slots
+        Return:
+            the number of condor_advertise runs that failed
+        """
+        batches = [[(name, machines[name]) for name in names] for names
+                   in utilities.chunks(sorted(machines), config.condor_control_batch_size)]
+        failed = utilities.parallel_map(self._condor_advertise_chunk, batches, config.condor_control_threads)
+        return sum(2 if failures is None else failures for failures in failed)
+
+    def _condor_advertise_chunk(self, batch):
+        master_target_file = self.create_condor_advertise_target_file([name for (name, slots) in batch])
+        startd_target_file = self.create_condor_advertise_target_file([slot for (name, slots) in batch for slot in slots])
+        try:
+            (retm1, retm2) = self.do_condor_advertise_master(master_target_file)
+            (rets1, rets2) = self.do_condor_advertise_startd(startd_target_file)
+        finally:
+            os.remove(master_target_file)
+            os.remove(startd_target_file)
+        failures = 0
+        if retm1 != 0 or retm2 != 0:
+            log.error("Problem sending condor_advertise to master: %i %i" % (retm1, retm2))
+            failures += 1
+        if rets1 != 0 or rets2 != 0:
+            log.error("Problem sending condor_advertise to startd: %i %i" % (rets1, rets2))
+            failures += 1
+        return failures
 
     def create_condor_advertise_target_file(self, names=[]):
         """Creates a file with the correct format for condor_advertise to remove classads
@@ -1629,7 +1780,7 @@ class ResourcePool:
             if foundIt:
                 break
         if not foundIt:
-            log.verbose("Could not find a VM with name: %s, checking retired_resources." % condor_name)
+            log.verbose("Could not find a VM with name: %s, checking retired_resources.", condor_name)
             for cluster in self.retired_resources:
                 for vm in cluster.vms:
                     if utilities.match_host_with_condor_host(vm.condorname, condor_name) or utilities.match_host_with_condor_host(vm.hostname, condor_name) or \
@@ -1717,7 +1868,7 @@ class ResourcePool:
             for vm in cluster.vms:
                 if vm.status == "Starting" or vm.status == "Unpropagated":
                     num_starting += 1
-        log.verbose("There are %i Starting VMs, the max_starting_vm is %i." % (num_starting, config.max_starting_vm))
+        log.verbose("There are %i Starting VMs, the max_starting_vm is %i.", num_starting, config.max_starting_vm)
         return num_starting
 
     def get_starting_of_usertype(self, vmtype):
@@ -1886,14 +2037,14 @@ class ResourcePool:
             if vm:
                 with cluster.vms_lock:
                     cluster.vms.remove(vm)
-                    log.debug("VM: %s, on %s removed from list." % (vm.id, vm.clusteraddr))
+                    log.debug("VM: %s, on %s removed from list.", vm.id, vm.clusteraddr)
                 cluster.resource_return(vm)
                 output = "Removed %s's VM %s from CloudScheduler." % (clustername, vmid)
                 log.debug(output)
             elif cluster_retired and vm_retired:
                 with cluster_retired.vms_lock:
                     cluster_retired.vms.remove(vm)
-                    log.debug("VM: %s, on %s removed from list." % (vm.id, vm.clusteraddr))
+                    log.debug("VM: %s, on %s removed from list.", vm.id, vm.clusteraddr)
                 output = "Removed %s's VM %s from CloudScheduler retired resources." % (clustername, vmid)
                 log.debug(output)
             else:
@@ -1910,7 +2061,7 @@ class ResourcePool:
             for vm in reversed(cluster.vms):
                 with cluster.vms_lock:
                     cluster.vms.remove(vm)
-                    log.debug("VM: %s, on %s removed from list." % (vm.id, vm.clusteraddr))
+                    log.debug("VM: %s, on %s removed from list.", vm.id, vm.clusteraddr)
                 cluster.resource_return(vm)
             output = "Removed all VMs from %s." % clustername
             log.debug(output)
@@ -2235,6 +2386,59 @@ class VMDestroyCmd(threading.Thread):
     def get_vm(self):
         return self.vm
 
+class ClusterReconciler(threading.Thread):
+    """
+    ClusterReconciler - bring one cluster's persisted VMs up to date at startup
+    """
+
+    def __init__(self, cluster, destroys=None):
+        """
+        cluster  - the cluster to check
+        destroys - (vm, return_resources, reason) to destroy on the cluster first
+        """
+        threading.Thread.__init__(self, name="%s-%s" % (self.__class__.__name__, cluster.name))
+        self.daemon = True
+        self.cluster = cluster
+        self.destroys = destroys if destroys else []
+        self.checked = 0
+        self.missing = 0
+
+    def run(self):
+        for (vm, return_resources, reason) in self.destroys:
+            try:
+                self.cluster.vm_destroy(vm, return_resources=return_resources, reason=reason)
+            except:
+                log.exception("Problem destroying VM %s on %s at startup" % (vm.id, self.cluster.name))
+
+        states = None
+        try:
+            states = self.cluster.vm_list_states()
+        except:
+            log.exception("Couldn't list the VMs on %s, polling them one at a time" % self.cluster.name)
+
+        now = int(time.time())
+        for vm in list(self.cluster.vms):
+            self.checked += 1
+            if states is None or not vm.id:
+                try:
+                    self.cluster.vm_poll(vm)
+                except:
+                    log.exception("Problem polling VM %s on %s at startup" % (vm.id, self.cluster.name))
+                continue
+            with self.cluster.vms_lock:
+                if vm.id in states:
+                    if vm.status != states[vm.id]:
+                        vm.last_state_change = now
+                        vm.status = states[vm.id]
+                    vm.lastpoll = now
+                else:
+                    # Gone from the cloud, let the VMPoller clean it up on its first pass
+                    log.info("VM %s is no longer on %s, marking it for cleanup" % (vm.id, self.cluster.name))
+                    self.missing += 1
+                    vm.status = "Error"
+                    vm.errorcount = config.polling_error_threshold
+                    vm.last_state_change = now
+
 #class VMDestroyCmd(multiprocessing.Process):
     """
     VMCmd - passing shutdown and destroy requests to a separate thread 
@@ -21,8 +21,10 @@ import string
 import shutil
 import logging
 import datetime
+import functools
 import requests
 import tempfile
+import itertools
 import subprocess
 import threading
 
@@ -30,11 +32,25 @@ from subprocess import Popen
 from urlparse import urlparse
 
 import config
+import cloudscheduler.events as events
+import cloudscheduler.metrics as metrics
 import cloudscheduler.utilities as utilities
 from cloudscheduler.utilities import get_cert_expiry_time
 
 log = utilities.get_cloudscheduler_logger()
 
+# VM attributes that don't flag the VM for the persistence journal: lastpoll
+# moves on every poll and isn't worth a journal record by itself.
+UNJOURNALED_VM_ATTRIBUTES = frozenset(['lastpoll', 'state_changed'])
+# VM attributes that only record the other changes and don't count as one
+CHANGE_FLAG_ATTRIBUTES = frozenset(['state_changed', 'change_count'])
+# VM attributes whose changes go on the event feed
+EVENT_VM_ATTRIBUTES = frozenset(['status', 'override_status'])
+_unset = object()
+# Every attribute change gives the VM a new change_count from here, which is
+# what info_server uses to tell if its cached JSON for the VM is still good.
+_vm_changes = itertools.count(1)
+
 
 class VM:
     """
@@ -52,6 +68,9 @@ class VM:
     maps specific cloud software state to these global states.
     """
 
+    # VMs unpickled from before change counting start at 0
+    change_count = 0
+
     def __init__(self, name="", id="", vmtype="", user="",
             hostname="", ipaddress="", clusteraddr="", clusterport="",
             cloudtype="", network="public",
@@ -133,6 +152,8 @@ class VM:
         
         # Set a status variable on new creation
         self.status = "Starting"
+        # Not yet written to the persistence journal
+        self.state_changed = True
 
         global log
         log = logging.getLogger("cloudscheduler")
@@ -140,12 +161,30 @@ class VM:
           % (name, id, clusteraddr, image, memory))
         log.info("Created VM cloud: %s id: %s"%(clusteraddr,self.id))
 
+    def __setattr__(self, name, value):
+        """Count the change and flag the VM for the persistence journal."""
+        old = self.__dict__.get(name, _unset)
+        if name not in CHANGE_FLAG_ATTRIBUTES and old != value:
+            self.__dict__['change_count'] = _vm_changes.next()
+            if name not in UNJOURNALED_VM_ATTRIBUTES:
+                self.__dict__['state_changed'] = True
+            if name in EVENT_VM_ATTRIBUTES and (old is not _unset or name == 'status'):
+                events.feed.emit('vm', vm=self.id, hostname=self.hostname, uservmtype=self.uservmtype,
+                                 clusteraddr=self.clusteraddr, attribute=name,
+                                 old=None if old is _unset else old, new=value)
+        self.__dict__[name] = value
+
+    def mark_changed(self):
+        """Flag a change made in place, like an append to job_run_times."""
+        self.__dict__['change_count'] = _vm_changes.next()
+        self.__dict__['state_changed'] = True
+
     def log(self):
         """Log the VM to the info level."""
-        log.info("VM Name: %s, ID: %s, Type: %s, User: %s, Status: %s on %s" % (self.name, self.id, self.vmtype,  self.user, self.status, self.clusteraddr))
+        log.info("VM Name: %s, ID: %s, Type: %s, User: %s, Status: %s on %s", self.name, self.id, self.vmtype, self.user, self.status, self.clusteraddr)
     def log_dbg(self):
         """Log the VM to the debug level."""
-        log.debug("VM Name: %s, ID: %s, Type: %s, User: %s, Status: %s on %s" % (self.name, self.id, self.vmtype, self.user, self.status, self.clusteraddr))
+        log.debug("VM Name: %s, ID: %s, Type: %s, User: %s, Status: %s on %s", self.name, self.id, self.vmtype, self.user, self.status, self.clusteraddr)
 
     def get_vm_info(self):
         """Formatted VM information for use with cloud_status."""
@@ -250,7 +289,7 @@ class VM:
             return False
         td = expiry_time - datetime.datetime.utcnow()
         td_in_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6
-        log.verbose("needs_proxy_renewal td: %d, threshold: %d" % (td_in_seconds, config.vm_proxy_renewal_threshold))
+        log.verbose("needs_proxy_renewal td: %d, threshold: %d", td_in_seconds, config.vm_proxy_renewal_threshold)
         return td_in_seconds < config.vm_proxy_renewal_threshold
 
     def needs_proxy_shutdown(self):
@@ -265,7 +304,7 @@ class VM:
             return False
         td = expiry_time - datetime.datetime.utcnow()
         td_in_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6
-        log.verbose("needs_proxy_renewal td: %d, threshold: %d" % (td_in_seconds, config.vm_proxy_shutdown_threshold))
+        log.verbose("needs_proxy_renewal td: %d, threshold: %d", td_in_seconds, config.vm_proxy_shutdown_threshold)
         return td_in_seconds < config.vm_proxy_shutdown_threshold
 
     def get_env(self):
@@ -290,6 +329,51 @@ class NoResourcesError(Exception):
         self.resource = resource
 
 
+# Cluster attributes that decide whether a VM fits. Setting any of them on
+# any cluster moves ICluster.capacity_epoch on, which is what ResourcePool
+# uses to tell if its cached fitting cluster lists are still good.
+CAPACITY_ATTRIBUTES = frozenset(['enabled', 'vm_slots', 'max_slots', 'memory', 'max_mem',
+                                 'max_vm_mem', 'cpu_cores', 'storageGB', 'priority'])
+_capacity_epochs = itertools.count(1)
+# Cluster attributes that are its running state rather than its configuration,
+# kept when a reconfig updates the cluster in place
+RUNTIME_ATTRIBUTES = frozenset(['vms', 'vms_lock', 'res_lock', 'failed_image_set', 'enabled',
+                                'connection_problem', 'errorconnect', 'count'])
+# The free capacity counters of a cluster, and the attribute with each one's total
+CAPACITY_COUNTERS = (('vm_slots', 'max_slots'), ('memory', 'max_mem'), ('storageGB', 'max_storageGB'))
+# The cloud API methods timed for the metrics, and the operation each is
+# counted as. create and destroy return 0 when they work.
+CLOUD_API_OPERATIONS = {'vm_create': 'create', 'vm_poll': 'poll',
+                        'vm_destroy': 'destroy', 'vm_list_states': 'list'}
+RETURN_CODE_OPERATIONS = frozenset(['create', 'destroy'])
+
+
+def timed_cloud_api(cls):
+    """Class decorator for ICluster subclasses: time the cloud API methods
+    the class defines and count their errors in the cloud_api metrics."""
+    for (name, operation) in CLOUD_API_OPERATIONS.iteritems():
+        method = cls.__dict__.get(name)
+        if method is not None:
+            setattr(cls, name, _timed_cloud_call(method, operation))
+    return cls
+
+def _timed_cloud_call(method, operation):
+    @functools.wraps(method)
+    def call(self, *args, **kwargs):
+        start = time.time()
+        try:
+            result = method(self, *args, **kwargs)
+        except:
+            metrics.cloud_api_errors.inc(cloud=self.name, operation=operation)
+            raise
+        finally:
+            metrics.cloud_api_seconds.observe(time.time() - start, cloud=self.name, operation=operation)
+        if operation in RETURN_CODE_OPERATIONS and result != 0:
+            metrics.cloud_api_errors.inc(cloud=self.name, operation=operation)
+        return result
+    return call
+
+
 class ICluster:
     """
     The ICluster interface is the framework for implementing support for
@@ -298,6 +382,10 @@ class ICluster:
     and vm_destroy
     """
 
+    capacity_epoch = 0
+    # The options of its cloud_resources.conf section, set by ResourcePool.setup
+    config_signature = None
+
     def __init__(self, name="Dummy Cluster", host="localhost",
                  cloud_type="Dummy", memory=0, max_vm_mem= -1, networks=[],
                  vm_slots=0, cpu_cores=0, storage=0, boot_timeout=None, enabled=True, priority=0,
@@ -328,7 +416,13 @@ class ICluster:
         self.keep_alive = keep_alive
 
         self.setup_logging()
-        log.debug("New cluster %s created" % self.name)
+        log.debug("New cluster %s created", self.name)
+
+    def __setattr__(self, name, value):
+        """Bump the capacity epoch when a fit deciding attribute changes."""
+        self.__dict__[name] = value
+        if name in CAPACITY_ATTRIBUTES:
+            ICluster.capacity_epoch = _capacity_epochs.next()
 
     def __getstate__(self):
         """Override to work with pickle module."""
@@ -341,6 +435,7 @@ class ICluster:
     def __setstate__(self, state):
         """Override to work with pickle module."""
         self.__dict__ = state
+        ICluster.capacity_epoch = _capacity_epochs.next()
         self.vms_lock = threading.RLock()
         self.res_lock = threading.RLock()
         self.failed_image_set = set()
@@ -369,9 +464,8 @@ class ICluster:
 
     def log(self):
         """Print a short form of cluster information to the log."""
-        log.debug("CLUSTER Name: %s, Address: %s, Type: %s, VM slots: %d, Mem: %s" \
-          % (self.name, self.network_address, self.cloud_type, self.vm_slots, \
-          self.memory))
+        log.debug("CLUSTER Name: %s, Address: %s, Type: %s, VM slots: %d, Mem: %s",
+                  self.name, self.network_address, self.cloud_type, self.vm_slots, self.memory)
 
     def log_vms(self):
         """Print the cluster 'vms' list (via VM print)."""
@@ -447,6 +541,13 @@ class ICluster:
         log.debug('This method should be defined by all subclasses of Cluster\n')
         assert 0, 'Must define workspace_poll'
 
+    def vm_list_states(self):
+        """Return a dict of VM id -> status for every instance on the cloud,
+        or None if this cloud type can't list all of its instances (its VMs
+        are then polled one at a time). A VM missing from the dict is taken
+        to be gone, so a partial listing must return None."""
+        return None
+
 
     ## Private VM methods
 
@@ -457,6 +558,31 @@ class ICluster:
         """
         return self.max_mem >= memory
 
+    def reconfigure(self, new_cluster):
+        """Take on the configuration of new_cluster, a cluster of the same class
+        built from a changed cloud_resources.conf section, keeping this
+        cluster's VMs and running state.
+
+        The free vm_slots, memory and storage are the new totals less what the
+        VMs use now. All the attributes change at once, so the other threads
+        see either the old configuration or the new one.
+
+        Returns the names of the counters the VMs now use more than all of.
+        """
+        with self.vms_lock:
+            with self.res_lock:
+                changes = dict((name, value) for (name, value) in new_cluster.__dict__.items()
+                               if name not in RUNTIME_ATTRIBUTES)
+                over = []
+                for (free, total) in CAPACITY_COUNTERS:
+                    used = getattr(self, total) - getattr(self, free)
+                    changes[free] = changes[total] - used
+                    if changes[free] < 0:
+                        over.append(free)
+                self.__dict__.update(changes)
+                ICluster.capacity_epoch = _capacity_epochs.next()
+        return over
+
     def resource_checkout(self, vm):
         """
         Checks out resources taken by a VM in creation from the internal rep-
@@ -515,9 +641,9 @@ class ICluster:
         try:
             r = requests.get(config.monitor_url, params={'cs_vm_fqdn':vm.hostname, 'boot_time':vm.initialize_time})
             if r.status_code == requests.codes.ok:
-                log.debug("Sent update to report monitor: %s: hostname: %s" % (config.monitor_url, vm.hostname))
+                log.debug("Sent update to report monitor: %s: hostname: %s", config.monitor_url, vm.hostname)
             else:
-                log.debug("problem sending update to report monitor at: %s: code: %s" % (config.monitor_url, r.status_code))
+                log.debug("problem sending update to report monitor at: %s: code: %s", config.monitor_url, r.status_code)
         except Exception as e:
             log.error("Problem trying to send monitor update: %s" % e)
 
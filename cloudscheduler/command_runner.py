@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## COMMAND RUNNER
+##
+## Runs the commands Cloud Scheduler shells out to (condor_q, condor_status,
+## condor_off, condor_hold, openssl, myproxy-logon, dig) and waits for all of
+## them from one thread.
+##
+## submit() starts a command and returns a CommandFuture straight away, run()
+## starts one and waits for its CommandResult. The CommandRunner thread reads
+## the output of every running command as it arrives, with poll() on their
+## pipes, so a command is done as soon as it exits instead of at the next
+## tick of a sleep loop, and no thread is tied up per command.
+##
+## A command still running at its timeout gets SIGTERM, then SIGKILL
+## KILL_WAIT seconds later. A command writing more than its output limit is
+## killed the same way. Every run is timed in the command_seconds metric
+## under the command's name, and failed runs are counted by reason.
+##
+
+from __future__ import with_statement
+
+import os
+import time
+import errno
+import fcntl
+import select
+import threading
+import subprocess
+
+from collections import deque
+
+import cloudscheduler.config as config
+import cloudscheduler.metrics as metrics
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# Seconds between SIGTERM and SIGKILL for a command past its timeout
+KILL_WAIT = 2
+# Seconds a command that exited gets to close its output. A background
+# process it started, like an ssh ControlMaster, can hold the pipes open.
+EXIT_DRAIN_WAIT = 0.5
+# Longest the runner sleeps before checking whether running commands exited
+EXIT_CHECK_INTERVAL = 0.25
+# Seconds between checks for the exit of a command that closed its output
+CLOSED_CHECK_INTERVAL = 0.01
+# Bytes read from a pipe at a time
+READ_SIZE = 65536
+
+
+class CommandResult:
+    """How a command run went."""
+
+    def __init__(self, args, returncode=-1, out="", err="", duration=0, error=None):
+        self.args = args
+        self.returncode = returncode
+        self.out = out
+        self.err = err
+        self.duration = duration
+        # Why the command didn't run to its end: None, 'start', 'timeout' or 'output_limit'
+        self.error = error
+
+    def ok(self):
+        return self.error is None and self.returncode == 0
+
+    def __repr__(self):
+        return "CommandResult(%r, returncode=%r, error=%r, duration=%.3f)" % (
+                " ".join(self.args), self.returncode, self.error, self.duration)
+
+
+class CommandFuture:
+    """A submitted command, to wait on for its CommandResult."""
+
+    def __init__(self, args, name):
+        self.args = args
+        self.name = name
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.command_result = None
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """The CommandResult, waiting up to timeout seconds for it, forever if None.
+
+        Returns None if the command isn't done by then.
+        """
+        self.finished.wait(timeout)
+        return self.command_result
+
+    def add_done_callback(self, callback):
+        """Call callback(future) when the command is done, right away if it already is.
+
+        The callback runs on the CommandRunner thread, so it should be quick.
+        """
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        metrics.command_seconds.observe(result.duration, command=self.name)
+        if not result.ok():
+            metrics.command_failures.inc(command=self.name, reason=result.error or 'exit')
+        with self.lock:
+            self.command_result = result
+            self.finished.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception("Problem in a callback for %s" % " ".join(self.args))
+
+
+class RunningCommand:
+    """A started command the CommandRunner is waiting on."""
+
+    def __init__(self, future, process, timeout, output_limit):
+        self.future = future
+        self.process = process
+        self.start = time.time()
+        self.deadline = self.start + timeout if timeout > 0 else None
+        self.kill_time = None
+        self.exited = None
+        self.output_limit = output_limit
+        self.size = 0
+        self.error = None
+        self.stdout = process.stdout.fileno()
+        self.stderr = process.stderr.fileno()
+        self.output = {self.stdout: [], self.stderr: []}
+        # The pipes not yet at end of file
+        self.open = set(self.output)
+
+    def wake_time(self, now):
+        """When this command next needs looking at."""
+        if self.exited is not None:
+            return self.exited + EXIT_DRAIN_WAIT
+        if not self.open:
+            return now + CLOSED_CHECK_INTERVAL
+        wake = now + EXIT_CHECK_INTERVAL
+        if self.kill_time is not None:
+            wake = min(wake, self.kill_time)
+        elif self.deadline is not None:
+            wake = min(wake, self.deadline)
+        return wake
+
+    def signal(self, kill=False):
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.process.terminate()
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def stop(self, error, now):
+        """Terminate the command, and kill it if it doesn't exit."""
+        self.error = error
+        self.signal()
+        self.kill_time = now + KILL_WAIT
+
+
+class CommandRunner(threading.Thread):
+    """
+    CommandRunner - Starts commands and collects their output and exit
+                    status, started the first time a command is submitted
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.begun = False
+        self.new_commands = deque()
+        self.running = set()
+        # Pipe file descriptor -> the RunningCommand it is from
+        self.commands = {}
+        (self.wake_read, self.wake_write) = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.poller = select.poll()
+        self.poller.register(self.wake_read, select.POLLIN)
+
+    def submit(self, args, timeout=None, env=None, name=None, output_limit=None):
+        """Start the command args. Returns its CommandFuture.
+
+        Keywords:
+            args         - the command and its arguments, run without a shell
+            timeout      - seconds it can run for, config.command_timeout if
+                           None; 0 for no limit
+            env          - its environment, ours if None
+            name         - what it is called in the metrics, the base name of
+                           the command if None
+            output_limit - most bytes of output it can write,
+                           config.command_output_limit MB if None; 0 for no limit
+        """
+        args = list(args)
+        if name is None:
+            name = os.path.basename(args[0])
+        if timeout is None:
+            timeout = config.command_timeout
+        if output_limit is None:
+            output_limit = config.command_output_limit * 1024 * 1024
+        future = CommandFuture(args, name)
+        try:
+            process = subprocess.Popen(args, shell=False, close_fds=True, env=env,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError, e:
+            log.error("Problem running %s, got errno %d \"%s\"" % (" ".join(args), e.errno, e.strerror))
+            future.set_result(CommandResult(args, error='start'))
+            return future
+        command = RunningCommand(future, process, timeout, output_limit)
+        with self.lock:
+            self.new_commands.append(command)
+            if not self.begun:
+                self.begun = True
+                self.start()
+        self.wake()
+        return future
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, "x")
+        except OSError, e:
+            # Full, the runner is awake already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+        while True:
+            try:
+                self.cycle()
+            except Exception:
+                log.exception("Unexpected error in the command runner")
+                time.sleep(EXIT_CHECK_INTERVAL)
+
+    def cycle(self):
+        """Wait for output, an exit, a timeout or a new command, and deal with it."""
+        try:
+            events = self.poller.poll(self.poll_timeout())
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for (fd, event) in events:
+            if fd == self.wake_read:
+                self.drain_wake()
+            elif fd in self.commands:
+                self.read(self.commands[fd], fd)
+        self.add_new_commands()
+        now = time.time()
+        for command in list(self.running):
+            self.check(command, now)
+
+    def poll_timeout(self):
+        """Milliseconds until a running command needs looking at, None to wait for a new one."""
+        if self.new_commands:
+            return 0
+        if not self.running:
+            return None
+        now = time.time()
+        wake = min(command.wake_time(now) for command in self.running)
+        return max(0, int((wake - now) * 1000))
+
+    def drain_wake(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def add_new_commands(self):
+        with self.lock:
+            new_commands = list(self.new_commands)
+            self.new_commands.clear()
+        for command in new_commands:
+            for fd in command.open:
+                self.commands[fd] = command
+                self.poller.register(fd, select.POLLIN | select.POLLPRI)
+            self.running.add(command)
+
+    def read(self, command, fd):
+        try:
+            data = os.read(fd, READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            self.close(command, fd)
+            return
+        if command.error is not None:
+            return
+        command.size += len(data)
+        if command.output_limit and command.size > command.output_limit:
+            log.warning("%s wrote over %d bytes, stopping it" % (" ".join(command.future.args), command.output_limit))
+            command.stop('output_limit', time.time())
+            return
+        command.output[fd].append(data)
+
+    def close(self, command, fd):
+        self.poller.unregister(fd)
+        del self.commands[fd]
+        command.open.discard(fd)
+
+    def check(self, command, now):
+        """Finish command if it exited, stop it if it ran over its time."""
+        if command.process.poll() is not None:
+            if command.exited is None:
+                command.exited = now
+            if not command.open or now - command.exited >= EXIT_DRAIN_WAIT:
+                self.finish(command, now)
+        elif command.kill_time is not None:
+            if now >= command.kill_time:
+                log.warning("%s didn't exit when terminated, killing it" % " ".join(command.future.args))
+                command.signal(kill=True)
+                command.kill_time = now + KILL_WAIT
+        elif command.deadline is not None and now >= command.deadline:
+            log.warning("%s ran for over %ds, stopping it" % (" ".join(command.future.args),
+                                                              command.deadline - command.start))
+            command.stop('timeout', now)
+
+    def finish(self, command, now):
+        for fd in list(command.open):
+            self.close(command, fd)
+        command.process.stdout.close()
+        command.process.stderr.close()
+        self.running.discard(command)
+        result = CommandResult(command.future.args, command.process.returncode,
+                               "".join(command.output[command.stdout]),
+                               "".join(command.output[command.stderr]),
+                               now - command.start, command.error)
+        command.future.set_result(result)
+
+runner = CommandRunner()
+
+
+def submit(args, **kwargs):
+    """Start args on the shared CommandRunner, see CommandRunner.submit. Returns its CommandFuture."""
+    return runner.submit(args, **kwargs)
+
+
+def run(args, **kwargs):
+    """Run args on the shared CommandRunner, see CommandRunner.submit, and return its CommandResult."""
+    return runner.submit(args, **kwargs).result()
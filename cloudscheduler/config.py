@@ -23,6 +23,13 @@ condor_off_command = "/usr/sbin/condor_off"
 condor_on_command = "/usr/sbin/condor_on"
 condor_advertise_command = "/usr/sbin/condor_advertise"
 ssh_path = "/usr/bin/ssh"
+ssh_control_persist = 300
+condor_control_batch_size = 50
+condor_control_threads = 4
+condor_job_batch_size = 500
+command_timeout = 180
+condor_query_timeout = 600
+command_output_limit = 256
 openssl_path = "/usr/bin/openssl"
 condor_host = "localhost"
 condor_host_on_vm = ""
@@ -38,7 +45,14 @@ cloudscheduler_ssh_key = ""
 cloud_resource_config = None
 info_server_port = 8111
 admin_server_port = 8112
+event_feed_size = 10000
+trace_history = 20
+watchdog_stall_time = 1800
+watchdog_restart = False
 persistence_file = "/var/lib/cloudscheduler.persistence"
+persistence_compact_records = 1000
+state_store_file = None
+startup_reconcile_timeout = 600
 user_limit_file = None
 target_cloud_alias_file = None
 job_ban_timeout = 60*60 # 1 hour default
@@ -57,6 +71,7 @@ clean_shutdown_idle = False
 getclouds = False
 scheduling_metric = "slot"
 scheduling_algorithm = "fairshare"
+scheduling_placement = "greedy"
 job_distribution_type = "normal"
 high_priority_job_support = False
 high_priority_job_weight = 1
@@ -73,6 +88,8 @@ job_proxy_renewal_threshold = 15 * 60 # 15 minutes default
 vm_proxy_refresher_interval = -1 # The current default is not to refresh the VM proxies. (until code is thouroughly tested -- Andre C.)
 vm_proxy_renewal_threshold = 60 * 60 # 60 minutes default
 vm_proxy_shutdown_threshold = 30 * 60 # 30 minutes default
+proxy_refresh_threads = 4
+spot_price_refresh_interval = 0
 vm_connection_fail_threshold = 60 * 60 # 60 minutes default
 vm_start_running_timeout = -1 # Unlimited time
 vm_idle_threshold = 5 * 60 # 5 minute default
@@ -88,6 +105,7 @@ connection_fail_disable_time = 60 * 60 * 2 # 2 hour default
 use_cloud_init = True
 default_yaml = "/usr/local/share/cloud-scheduler/default.yaml" if os.path.exists('/usr/local/share/cloud-scheduler/default.yaml') else '/usr/share/cloud-scheduler/default.yaml'
 validate_yaml = False
+content_cache_ttl = 60
 retire_reallocate = True
 
 default_VMType= "default"
@@ -114,6 +132,7 @@ admin_log_comments = False
 log_stdout = False
 log_syslog = False
 log_max_size = None
+log_queue_size = 10000
 log_format = "%(asctime)s - %(levelname)s - %(threadName)s - %(message)s"
 
 monitor_url = None
@@ -139,6 +158,13 @@ def setup(path=None):
     global condor_on_command
     global condor_advertise_command
     global ssh_path
+    global ssh_control_persist
+    global condor_control_batch_size
+    global condor_control_threads
+    global condor_job_batch_size
+    global command_timeout
+    global condor_query_timeout
+    global command_output_limit
     global openssl_path
     global condor_context_file
     global condor_host
@@ -154,7 +180,14 @@ def setup(path=None):
     global cloud_resource_config
     global info_server_port
     global admin_server_port
+    global event_feed_size
+    global trace_history
+    global watchdog_stall_time
+    global watchdog_restart
     global persistence_file
+    global persistence_compact_records
+    global state_store_file
+    global startup_reconcile_timeout
     global user_limit_file
     global target_cloud_alias_file
     global job_ban_timeout
@@ -173,6 +206,7 @@ def setup(path=None):
     global getclouds
     global scheduling_metric
     global scheduling_algorithm
+    global scheduling_placement
     global job_distribution_type
     global high_priority_job_support
     global high_priority_job_weight
@@ -189,6 +223,8 @@ def setup(path=None):
     global vm_proxy_refresher_interval
     global vm_proxy_renewal_threshold
     global vm_proxy_shutdown_threshold
+    global proxy_refresh_threads
+    global spot_price_refresh_interval
     global vm_connection_fail_threshold
     global vm_start_running_timeout
     global vm_idle_threshold
@@ -202,6 +238,7 @@ def setup(path=None):
     global use_cloud_init
     global default_yaml
     global validate_yaml
+    global content_cache_ttl
     global retire_reallocate
 
     global default_VMType
@@ -229,6 +266,7 @@ def setup(path=None):
     global log_stdout
     global log_syslog
     global log_max_size
+    global log_queue_size
     global log_format
 
     global monitor_url
@@ -290,6 +328,68 @@ def setup(path=None):
     if config_file.has_option("global", "ssh_path"):
         ssh_path = config_file.get("global", "ssh_path")
 
+    if config_file.has_option("global", "ssh_control_persist"):
+        try:
+            ssh_control_persist = config_file.getint("global", "ssh_control_persist")
+        except ValueError:
+            print "Configuration file problem: ssh_control_persist must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "condor_control_batch_size"):
+        try:
+            condor_control_batch_size = config_file.getint("global", "condor_control_batch_size")
+            if condor_control_batch_size <= 0:
+                condor_control_batch_size = 1
+        except ValueError:
+            print "Configuration file problem: condor_control_batch_size must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "condor_control_threads"):
+        try:
+            condor_control_threads = config_file.getint("global", "condor_control_threads")
+            if condor_control_threads <= 0:
+                condor_control_threads = 1
+        except ValueError:
+            print "Configuration file problem: condor_control_threads must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "condor_job_batch_size"):
+        try:
+            condor_job_batch_size = config_file.getint("global", "condor_job_batch_size")
+            if condor_job_batch_size <= 0:
+                condor_job_batch_size = 1
+        except ValueError:
+            print "Configuration file problem: condor_job_batch_size must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "command_timeout"):
+        try:
+            command_timeout = config_file.getint("global", "command_timeout")
+        except ValueError:
+            print "Configuration file problem: command_timeout must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "condor_query_timeout"):
+        try:
+            condor_query_timeout = config_file.getint("global", "condor_query_timeout")
+        except ValueError:
+            print "Configuration file problem: condor_query_timeout must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "command_output_limit"):
+        try:
+            command_output_limit = config_file.getint("global", "command_output_limit")
+        except ValueError:
+            print "Configuration file problem: command_output_limit must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "openssl_path"):
         openssl_path = config_file.get("global", "openssl_path")
 
@@ -377,9 +477,60 @@ def setup(path=None):
                   "integer value."
             sys.exit(1)
 
+    if config_file.has_option("global", "event_feed_size"):
+        try:
+            event_feed_size = config_file.getint("global", "event_feed_size")
+        except ValueError:
+            print "Configuration file problem: event_feed_size must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "trace_history"):
+        try:
+            trace_history = config_file.getint("global", "trace_history")
+        except ValueError:
+            print "Configuration file problem: trace_history must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "watchdog_stall_time"):
+        try:
+            watchdog_stall_time = config_file.getint("global", "watchdog_stall_time")
+        except ValueError:
+            print "Configuration file problem: watchdog_stall_time must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "watchdog_restart"):
+        try:
+            watchdog_restart = config_file.getboolean("global", "watchdog_restart")
+        except ValueError:
+            print "Configuration file problem: watchdog_restart must be an " \
+                  "boolean value."
+            sys.exit(1)
+
     if config_file.has_option("global", "persistence_file"):
         persistence_file = config_file.get("global", "persistence_file")
 
+    if config_file.has_option("global", "persistence_compact_records"):
+        try:
+            persistence_compact_records = config_file.getint("global", "persistence_compact_records")
+        except ValueError:
+            print "Configuration file problem: persistence_compact_records must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "state_store_file"):
+        state_store_file = config_file.get("global", "state_store_file")
+
+    if config_file.has_option("global", "startup_reconcile_timeout"):
+        try:
+            startup_reconcile_timeout = config_file.getint("global", "startup_reconcile_timeout")
+        except ValueError:
+            print "Configuration file problem: startup_reconcile_timeout must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "user_limit_file"):
         user_limit_file = config_file.get("global", "user_limit_file")
 
@@ -423,6 +574,10 @@ def setup(path=None):
             print "Configuration file problem: ban_min_track must be an " \
                   "integer value."
             sys.exit(1)
+        if ban_min_track < 1:
+            print "Configuration file problem: ban_min_track must be at " \
+                  "least 1."
+            sys.exit(1)
 
     if config_file.has_option("global", "condor_register_time_limit"):
         try:
@@ -536,6 +691,9 @@ def setup(path=None):
     if config_file.has_option("global", "scheduling_algorithm"):
         scheduling_algorithm = config_file.get("global", "scheduling_algorithm")
 
+    if config_file.has_option("global", "scheduling_placement"):
+        scheduling_placement = config_file.get("global", "scheduling_placement")
+
     if config_file.has_option("global", "high_priority_job_support"):
         try:
             high_priority_job_support = config_file.getboolean("global", "high_priority_job_support")
@@ -632,6 +790,24 @@ def setup(path=None):
                   "integer value."
             sys.exit(1)
 
+    if config_file.has_option("global", "proxy_refresh_threads"):
+        try:
+            proxy_refresh_threads = config_file.getint("global", "proxy_refresh_threads")
+            if proxy_refresh_threads <= 0:
+                proxy_refresh_threads = 1
+        except ValueError:
+            print "Configuration file problem: proxy_refresh_threads must be an " \
+                  "integer value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "spot_price_refresh_interval"):
+        try:
+            spot_price_refresh_interval = config_file.getint("global", "spot_price_refresh_interval")
+        except ValueError:
+            print "Configuration file problem: spot_price_refresh_interval must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "vm_connection_fail_threshold"):
         try:
             vm_connection_fail_threshold = config_file.getint("global", "vm_connection_fail_threshold")
@@ -738,6 +914,14 @@ def setup(path=None):
             print "Configuration file problem: validate_yaml must be a" \
                   " Boolean value."
 
+    if config_file.has_option("global", "content_cache_ttl"):
+        try:
+            content_cache_ttl = config_file.getint("global", "content_cache_ttl")
+        except ValueError:
+            print "Configuration file problem: content_cache_ttl must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "retire_reallocate"):
         try:
             retire_reallocate = config_file.getboolean("global", "retire_reallocate")
@@ -785,6 +969,14 @@ def setup(path=None):
                   "integer value in bytes."
             sys.exit(1)
 
+    if config_file.has_option("logging", "log_queue_size"):
+        try:
+            log_queue_size = config_file.getint("logging", "log_queue_size")
+        except ValueError:
+            print "Configuration file problem: log_queue_size must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("logging", "log_format"):
         log_format = config_file.get("logging", "log_format", raw=True)
 
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## CONTENT CACHE
+##
+## Keeps the files and URLs that go into VM user data (default_yaml, the
+## cert and key files, CA roots and signing policies, default_VMUserData,
+## and the amiconfig and user_data URLs of jobs) so booting a VM doesn't
+## read them all again.
+##
+## A local file is read again only when its modification time, size or
+## inode change, which costs a stat() per read. A URL is used as fetched
+## for config.content_cache_ttl seconds, then fetched again with the ETag
+## and Last-Modified it came with, so a server that supports them answers
+## 304 Not Modified instead of sending it again.
+##
+## read() hands back the same string object for as long as the content is
+## unchanged, which keeps the user data rendering in cloud_init_util cheap
+## to look up by content. Jobs can name their own user data URLs, so only
+## the CACHE_SIZE most recently read locations are kept.
+##
+
+from __future__ import with_statement
+
+import os
+import time
+import urllib2
+
+import cloudscheduler.config as config
+import cloudscheduler.metrics as metrics
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# Seconds to wait for a URL to answer
+FETCH_TIMEOUT = 60
+# Most files and URLs kept
+CACHE_SIZE = 256
+
+
+def is_url(location):
+    """Whether location is an http(s) URL rather than a local file."""
+    return location.lower().startswith(('http://', 'https://'))
+
+
+class Entry:
+    """The cached content of one file or URL."""
+
+    def __init__(self, content):
+        self.content = content
+        # Files: (mtime, size, inode) when read
+        self.stat = None
+        # URLs: when last fetched or revalidated, and the validators it came with
+        self.fetched = 0
+        self.etag = None
+        self.last_modified = None
+
+
+class ContentCache:
+    """Files and URLs by location, revalidated before they are used."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.entries = utilities.LRUCache(size)
+
+    def read(self, location):
+        """The content of the file or http(s) URL location.
+
+        Raises what open() or urllib2.urlopen() would if it can't be read.
+        """
+        entry = self.entries.get(location)
+        if is_url(location):
+            entry = self.read_url(location, entry)
+        else:
+            entry = self.read_file(location, entry)
+        return entry.content
+
+    def read_file(self, path, entry):
+        info = os.stat(path)
+        stat = (info.st_mtime, info.st_size, info.st_ino)
+        if entry is not None and entry.stat == stat:
+            metrics.content_cache_reads.inc(result='hit')
+            return entry
+        with open(path) as fh:
+            entry = Entry(fh.read())
+        entry.stat = stat
+        metrics.content_cache_reads.inc(result='miss')
+        return self.store(path, entry)
+
+    def read_url(self, url, entry):
+        now = time.time()
+        if entry is not None and now - entry.fetched < config.content_cache_ttl:
+            metrics.content_cache_reads.inc(result='hit')
+            return entry
+        request = urllib2.Request(url)
+        if entry is not None:
+            if entry.etag:
+                request.add_header('If-None-Match', entry.etag)
+            if entry.last_modified:
+                request.add_header('If-Modified-Since', entry.last_modified)
+        try:
+            response = urllib2.urlopen(request, timeout=FETCH_TIMEOUT)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or entry is None:
+                raise
+            entry.fetched = now
+            metrics.content_cache_reads.inc(result='revalidated')
+            return entry
+        try:
+            content = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+        if entry is None or entry.content != content:
+            entry = Entry(content)
+        entry.fetched = now
+        entry.etag = headers.getheader('ETag')
+        entry.last_modified = headers.getheader('Last-Modified')
+        metrics.content_cache_reads.inc(result='miss')
+        return self.store(url, entry)
+
+    def store(self, location, entry):
+        self.entries.put(location, entry)
+        return entry
+
+    def forget(self, location=None):
+        """Drop location from the cache, or everything if None."""
+        if location is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(location)
+
+contents = ContentCache()
+
+
+def read(location):
+    """The content of the file or URL location, from the shared ContentCache."""
+    return contents.read(location)
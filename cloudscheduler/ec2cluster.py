@@ -2,15 +2,14 @@ import os
 import sys
 import time
 import string
-import json
 import shutil
 import logging
-import subprocess
 import cluster_tools
 import cloud_init_util
+import cloudscheduler.command_runner as command_runner
 import cloudscheduler.config as config
+import cloudscheduler.spot_prices as spot_prices
 import cloudscheduler.utilities as utilities
-import datetime as dt
 from cloudscheduler.job_management import _attr_list_to_dict
 log = utilities.get_cloudscheduler_logger()
 try:
@@ -22,12 +21,12 @@ except ImportError:
             "or get it from http://code.google.com/p/boto/")
     
 from httplib import BadStatusLine
-from subprocess import Popen
 from urlparse import urlparse
 from cStringIO import StringIO
 import gzip
 
 
+@cluster_tools.timed_cloud_api
 class EC2Cluster(cluster_tools.ICluster):
 
     VM_STATES = {
@@ -450,6 +449,15 @@ class EC2Cluster(cluster_tools.ICluster):
         return vm.status
 
 
+    def vm_list_states(self):
+        """List the state of every instance on the cloud with one request."""
+        connection = self._get_connection()
+        states = {}
+        for reservation in connection.get_all_instances():
+            for instance in reservation.instances:
+                states[instance.id] = self.VM_STATES.get(instance.state, "Starting")
+        return states
+
     def vm_destroy(self, vm, return_resources=True, reason=""):
         """
         Shutdown, destroy and return resources of a VM to it's cluster
@@ -524,7 +532,7 @@ class EC2Cluster(cluster_tools.ICluster):
         return hostname
 
     def vm_execwait(self, cmd, env=None):
-        """As above, a function to encapsulate command execution via Popen.
+        """As above, a function to encapsulate command execution via the command runner.
         vm_execwait executes the given cmd list, waits for the process to finish,
         and returns the return code of the process. STDOUT and STDERR are stored
         in given parameters.
@@ -536,203 +544,23 @@ class EC2Cluster(cluster_tools.ICluster):
         err - The STDERR of the executed command
         The return of this function is a 3-tuple
         """
-        out = ""
-        err = ""
         try:
-            sp = Popen(cmd, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-            if not utilities.check_popen_timeout(sp):
-                (out, err) = sp.communicate(input=None)
-            else:
-                log.warning("Process %s timed out! cmd was %s" % (sp.pid, " ".join(cmd)))
-            return (sp.returncode, out, err)
-        except OSError, e:
-            try:
-                log.error("Problem running %s, got errno %d \"%s\"" % (string.join(cmd, " "), e.errno, e.strerror))
-            except:
-                log.error("Problem running command, OSError.")
-            return (-1, "", "")
+            result = command_runner.run(cmd, env=env)
         except:
-            try:
-                log.error("Problem running %s, unexpected error: %s" % (string.join(cmd, " "), err))
-            except:
-                log.error("Problem running command, unexpected error.")
+            log.exception("Problem running %s, unexpected error" % string.join(cmd, " "))
             return (-1, "", "")
+        if result.error == 'start':
+            return (-1, "", "")
+        return (result.returncode, result.out, result.err)
 
         
     """ These methods relate to inquiring on EC2 spot pricing methods """
     
     """ img_type examples 't1.micro','m3.medium','c3.2xlarge','m3.large','cc2.8xlarge','m1.medium' """
-    def get_current_us_west_2_spot_price(self,img_type,connection):
-        result=self._get_current_spot_price(["Linux/UNIX"], [img_type], [self.regions], [], "none", "json",connection)
-        lowest_price = result[0]['price']
-        for idx,price in enumerate(result):
-            if lowest_price>result[idx]['price']:
-                lowest_price=result[idx]['price']
+    def get_current_us_west_2_spot_price(self,img_type,connection=None):
+        """The lowest spot price of img_type in this cloud's region, plus 10%,
+        from the prices the SpotPriceRefresher keeps. None if it has none."""
+        lowest_price = spot_prices.prices.lowest(spot_prices.region_of(self), img_type)
+        if lowest_price is None:
+            return None
         return lowest_price*1.1
-
-    """ Support Methods for spot pricing methods described above - methods can be used to answer spot pricing questions"""
-    
-    def _get_current_spot_price(self,image_type,instance_type,regions,zones,filter_type,response_type,connection):
-        """API function
-        image_type $string see help -h 
-        instance_type $string see help -h 
-        regions @array of strings see help -h 
-        zones @array of strings see help -h 
-        filter_type $string see help -h 
-        response_type $string see help -h 
-        """
-        args = []
-        args.append( {"ImageTypes":image_type} )  
-        args.append({"InstanceTypes":  instance_type })
-        args.append({"Regions": regions})
-        args.append({"ZONES": zones })
-        json_req = self._create_request('current_spot_price',filter_type,response_type,{},args)
-        json_req['start_time'] = dt.datetime.now().isoformat()
-        json_req['end_time'] = dt.datetime.now().isoformat()
-        json_response_data = self.__get_current_spot_price(json_req,connection)
-        json_response_data = self.filter_response(json_response_data, json_req['filter_type'])
-        return json_response_data
-    
-    def _create_request(self,req_type,filter_type,response_type,other_args,args):
-        if req_type == 'current_spot_price' or req_type == 'list_all_spot_price' or req_type == 'periodic_spot_price':
-            msg = {}
-            msg['filter_type']=filter_type
-            msg['response_type']=response_type
-            msg['request']=req_type
-            msg['other_args']=other_args
-            msg['request_args']=args
-            return msg
-        
-    def __get_current_spot_price(self,json_req,connection):
-        req_args_array = json_req['request_args']
-        regions=[]
-        inst_types=[]
-        image_types=[]
-        zones = []
-        
-        json_response_data = []
-        
-        for obj in req_args_array:
-            for obj_key in obj.keys():
-                if obj_key == 'Regions':
-                    regions = obj[obj_key];
-                if obj_key == 'ZONES':
-                    zones = obj[obj_key];
-                if obj_key == 'InstanceTypes':
-                    inst_types = obj[obj_key];
-                if obj_key == 'ImageTypes':
-                    image_types = obj[obj_key];
-        
-        for region in regions:
-            #check zones 
-            #conn = boto.ec2.connect_to_region(self.access_key_id,self.secret_access_key,region)
-            region = boto.ec2.regioninfo.RegionInfo(name=self.regions,
-                                                 endpoint='ec2.us-west-2.amazonaws.com')
-            conn = boto.connect_ec2(
-                                   aws_access_key_id=self.access_key_id,
-                                   aws_secret_access_key=self.secret_access_key,
-                                   region=region)
-            
-            #conn = connection
-            if len(zones) > 0:
-                #for each zone do calls for each image and eash instance type   
-                for zone in zones:
-                    for inst in inst_types:
-                        for img in image_types:
-                            
-                            start_time = json_req['start_time']
-                            end_time = json_req['end_time']
-                            
-                            instance_type=inst
-                            product_description = img
-                            availability_zone = zone
-                            dry_run = False
-                            max_results = 100
-                            next_token = None
-                            filters = None
-                            price = conn.get_spot_price_history(start_time, end_time, instance_type, product_description, availability_zone, dry_run, max_results, next_token, filters)
-                            #price_obj = price.pop()
-                            for price_obj in price:
-                                #pprint("%s : %s "%(price_obj,price_obj.price))
-                                json_data = {}
-                                json_data['region']=region
-                                json_data['instance_type']=inst
-                                json_data['image_type']=img
-                                json_data['zone']=zone
-                                json_data['price']=price_obj.price
-                                json_data['timestamp']=price_obj.timestamp
-                                json_response_data.append(json_data)
-                                #price_obj = price.pop()
-                            
-            else:
-                #for each region get their zones and do calles for each instance type and image type
-                #conn = boto.ec2.connect_to_region(region)
-                reg_zones = conn.get_all_zones()
-                for zone in reg_zones:
-                    for inst in inst_types:
-                        for img in image_types:
-                            start_time = json_req['start_time']
-                            end_time = json_req['end_time']
-                            instance_type=inst
-                            product_description = img
-                            availability_zone = zone.name
-                            dry_run = False
-                            max_results = 100
-                            next_token = None
-                            filters = None
-                            price = conn.get_spot_price_history(start_time, end_time, instance_type, product_description, availability_zone, dry_run, max_results, next_token, filters)
-                            
-                            for price_obj in price:
-                                json_data = {}
-                                json_data['region']=region
-                                json_data['instance_type']=inst
-                                json_data['image_type']=img
-                                json_data['zone']=zone.name
-                                json_data['price']=price_obj.price
-                                json_data['timestamp']=price_obj.timestamp
-                                json_response_data.append(json_data)
-        
-        return json_response_data
-    
-    def filter_response(self,json_resp, filter_type):
-        if filter_type == "none":
-            return json_resp
-        elif filter_type == "highest":
-            highest=0.0
-            highest_idx=-1;
-            remove_idx=[]
-            
-            for idx,entry in enumerate(json_resp):
-                if entry['price'] <= highest:
-                    remove_idx.append(idx)
-                else:
-                    remove_idx.append(idx)
-                    highest_idx=idx
-                    highest=entry['price']
-            
-            if highest_idx != -1:
-                del remove_idx[highest_idx]
-            while len(remove_idx)>0:
-                idx = remove_idx.pop()
-                del json_resp[idx]
-                
-            return json_resp
-        elif filter_type == "average":
-            total=0.0
-            idx=0
-            remove_idx=[]
-           
-            for idx,entry in enumerate(json_resp):
-                total=total+entry['price']
-                remove_idx.append(idx)
-            average=total/(1+idx)
-            while len(remove_idx)>0:
-                idx = remove_idx.pop()
-                del json_resp[idx]
-            json_str = '{"zone":"","image_type":"","timestamp":"","region":"","instance_type":"","price":%s}'%average
-            
-            json_obj = json.loads(json_str)
-            json_resp.append(json_obj)   
-                
-            return json_resp
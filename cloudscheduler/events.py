@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## EVENT FEED
+##
+## A ring buffer of the last config.event_feed_size things that happened, for
+## info_server's /events change feed and cloud_status --follow:
+##   vm        - a VM was created ('old' is None), changed status or
+##               override_status, or left its cluster ('new' is 'Removed')
+##   job       - a job was scheduled or unscheduled, or its condor status changed
+##   ban       - an image was banned from a cluster
+##   unban     - a ban was lifted
+##   heartbeat - one of the scheduler threads finished a cycle
+##   stall     - the watchdog found a thread that stopped finishing cycles
+##   recover   - a stalled thread finished a cycle again
+##
+## Every event gets the next id. Readers pass the last id they saw and get
+## what came after it, waiting for it if asked to. If a reader falls so far
+## behind that the events it wanted have left the buffer, or passes an id
+## from before a restart, it is told it missed some.
+##
+
+from __future__ import with_statement
+
+import time
+import itertools
+import threading
+
+from collections import deque
+
+import cloudscheduler.config as config
+import cloudscheduler.metrics as metrics
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+EVENT_TYPES = ('vm', 'job', 'ban', 'unban', 'heartbeat', 'stall', 'recover')
+
+
+class EventFeed:
+    """The buffered events and the readers waiting for new ones."""
+
+    def __init__(self, size=None):
+        """Constructor.
+
+        Keywords:
+            size - events to keep, defaults to config.event_feed_size when the
+                   first event arrives; 0 turns the feed off
+        """
+        self.size = size
+        self.condition = threading.Condition(threading.Lock())
+        self.events = None
+        self.last = 0
+
+    def enabled(self):
+        if self.size is None:
+            return config.event_feed_size > 0
+        return self.size > 0
+
+    def emit(self, kind, **fields):
+        """Add an event of type kind with the given fields."""
+        if not self.enabled():
+            return
+        fields['type'] = kind
+        fields['time'] = time.time()
+        with self.condition:
+            if self.events is None:
+                self.events = deque(maxlen=self.size if self.size is not None else config.event_feed_size)
+            self.last += 1
+            fields['id'] = self.last
+            self.events.append(fields)
+            self.condition.notify_all()
+
+    def since(self, last_id, types=None):
+        """The events after last_id.
+
+        Keywords:
+            last_id - the last event id the reader saw, None for only new events
+            types   - event types to return, None for all of them
+        Returns (events, last, missed): last is the id to pass next time and
+        missed is True if events after last_id are no longer in the buffer.
+        """
+        with self.condition:
+            return self._since(last_id, types)
+
+    def _since(self, last_id, types):
+        if last_id is None or self.events is None:
+            return ([], self.last, False)
+        missed = False
+        if last_id > self.last:
+            # An id from before a restart
+            last_id = 0
+            missed = True
+        start = 0
+        if self.events:
+            first = self.events[0]['id']
+            missed = missed or last_id < first - 1
+            start = max(last_id - first + 1, 0)
+        events = itertools.islice(self.events, start, None)
+        if types:
+            events = (event for event in events if event['type'] in types)
+        return (list(events), self.last, missed)
+
+    def wait(self, last_id, timeout, types=None):
+        """Like since(), but wait up to timeout seconds for an event if there aren't any."""
+        deadline = time.time() + timeout
+        with self.condition:
+            if last_id is None:
+                last_id = self.last
+            while True:
+                (events, last, missed) = self._since(last_id, types)
+                remaining = deadline - time.time()
+                if events or missed or remaining <= 0:
+                    return (events, last, missed)
+                # Skipped events of other types don't need looking at again
+                last_id = last
+                self.condition.wait(remaining)
+
+feed = EventFeed()
+
+
+def heart_beat(thread, loop_time=None):
+    """Record that thread finished a cycle, taking loop_time seconds."""
+    thread.heart_beat = time.time()
+    if loop_time is not None:
+        metrics.thread_loop_seconds.observe(loop_time, thread=thread.name)
+        loop_time = round(loop_time, 3)
+    feed.emit('heartbeat', thread=thread.name, loop_time=loop_time)
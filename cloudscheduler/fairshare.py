@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## FAIR SHARE ARITHMETIC
+##
+## Exact share arithmetic used by the fair share scheduler and the VM
+## balancer. Every share is a fractions.Fraction built from integer counts
+## (or resource totals), so the current, desired and diff distributions for
+## all uservmtypes can be produced in a single pass without the cost and
+## rounding of decimal.Decimal contexts.
+##
+
+from fractions import Fraction
+
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+def shares(weights, total=None):
+    """Convert a dict of uservmtype -> weight into exact fractional shares.
+
+    Keywords:
+        weights - (dict) uservmtype -> int, long or Fraction weight
+        total   - the value to divide by, defaults to the sum of weights
+    Returns {} if the total is zero.
+    """
+    if total is None:
+        total = sum(weights.itervalues())
+    if total == 0:
+        return {}
+    total = Fraction(total)
+    return dict((vmtype, weight / total) for vmtype, weight in weights.iteritems())
+
+
+def diff_shares(current, desired):
+    """Difference between the current (VM) and desired (job) distributions.
+
+    A negative difference means more VMs of that type need to be created.
+    Types with VMs but no jobs get a diff of 1, types with jobs but no VMs
+    get the negated desired share.
+    """
+    diff = {}
+    for vmtype, share in current.iteritems():
+        if vmtype in desired:
+            diff[vmtype] = share - desired[vmtype]
+        else:
+            diff[vmtype] = 1
+    for vmtype, share in desired.iteritems():
+        if vmtype not in current:
+            diff[vmtype] = -share
+    return diff
+
+
+def limited_usertypes(usertypes, user_vm_counts, user_vm_limits, type_counts, usertype_limits):
+    """Find the uservmtypes whose user or uservmtype is at its VM limit.
+
+    Keywords:
+        usertypes       - iterable of 'user:vmtype' strings to check
+        user_vm_counts  - (dict) user -> number of VMs
+        user_vm_limits  - (dict) user -> max VMs
+        type_counts     - (dict) uservmtype -> number of VMs
+        usertype_limits - (dict) uservmtype -> max VMs (-1 for unlimited)
+    """
+    limited = set()
+    for usertype in usertypes:
+        user = usertype.split(':')[0]
+        if user in user_vm_limits and not (user_vm_counts.get(user, 0) < user_vm_limits[user]):
+            limited.add(usertype)
+        elif usertype in usertype_limits:
+            limit = usertype_limits[usertype]
+            if limit != -1 and usertype in type_counts and not (type_counts[usertype] < limit):
+                limited.add(usertype)
+    return limited
+
+
+def spread_limited(diff, limited):
+    """Hand the negative diff of limited uservmtypes to everyone else.
+
+    Users at their limit should not hold up scheduling, so their deficit is
+    split evenly across the remaining uservmtypes. diff is updated in place
+    and returned.
+    """
+    neg_total = 0
+    for usertype in limited:
+        if diff[usertype] < 0:
+            neg_total += diff[usertype]
+    splitby = len(diff) - len(limited)
+    adjustby = 0
+    if splitby > 0:
+        adjustby = neg_total / splitby
+    elif splitby == 0:
+        log.verbose("All users are limited.")
+    else:
+        log.error("More user vmtypes limited than what's in diff types, something weird here.")
+
+    if adjustby:
+        for usertype in diff:
+            if usertype not in limited:
+                diff[usertype] += adjustby # the 'extra' will be negative so add it
+    return diff
+
+
+def fair_share(resource_pool, job_pool):
+    """Compute the current, desired and limit adjusted diff distributions.
+
+    Returns a (current_types, desired_types, diff_types) tuple of dicts.
+    """
+    current_types = resource_pool.vmtype_distribution()
+    desired_types = job_pool.job_type_distribution()
+    diff_types = diff_shares(current_types, desired_types)
+    usertype_limits = job_pool.get_usertype_limits()
+    if resource_pool.user_vm_limits or usertype_limits:
+        # With user limiting will need to reset any users that are at their limits
+        # so they will not interfere with scheduling
+        limited = limited_usertypes(diff_types, resource_pool.get_vm_count_by_user(),
+                                    resource_pool.user_vm_limits,
+                                    resource_pool.get_vmtypes_count_internal(),
+                                    usertype_limits)
+        spread_limited(diff_types, limited)
+    return (current_types, desired_types, diff_types)
@@ -23,6 +23,7 @@ except Exception as e:
 log = utilities.get_cloudscheduler_logger()
 
 
+@cluster_tools.timed_cloud_api
 class GoogleComputeEngineCluster(cluster_tools.ICluster):
     VM_STATES = {
             "RUNNING" : "Running",
@@ -3,6 +3,8 @@
 """ REST Server for cloud_status.
 """
 
+from __future__ import with_statement
+
 import logging
 import threading
 import time
@@ -11,9 +13,21 @@ import sys
 import re
 import web
 import web.wsgiserver
+import zlib
+import heapq
+import base64
 import urllib
+import weakref
+import operator
 import cloudscheduler.config as config
 import cloudscheduler.__version__ as version
+import cloudscheduler.events as events
+import cloudscheduler.fairshare as fairshare
+import cloudscheduler.metrics as metrics
+import cloudscheduler.snapshot as snapshot
+import cloudscheduler.spot_prices as spot_prices
+import cloudscheduler.tracing as tracing
+import cloudscheduler.watchdog as watchdog
 from cluster_tools import ICluster
 from cluster_tools import VM
 from job_management import Job
@@ -75,15 +89,22 @@ class InfoServer(threading.Thread,):
             r'/clusters/([\w\%-]+)/vms/([\w\%-]+)(\.json)', views.vms,
             r'/developer-info',                             views.developer_info,
             r'/diff-types',                                 views.diff_types,
-            r'/failures/(boot|image)',                      views.failures,
+            r'/events(\.json)?',                            views.events,
+            r'/failures/(boot|image|ban)',                  views.failures,
             r'/ips',                                        views.ips,
             r'/jobs',                                       views.jobs,
+            r'/jobs()(\.json)',                              views.jobs,
             r'/jobs/([\w\%-]+)',                            views.jobs,
             r'/jobs/([\w\%-]+)(\.json)',                    views.jobs,
             r'/job-pool.json',                              views.job_pool,
+            r'/metrics',                                    views.metrics,
             r'/shared-objs',                                views.shared_objs,
+            r'/spot-prices(\.json)?',                       views.spot_prices,
+            r'/stored-vms.json',                            views.stored_vms,
             r'/thread-heart-beats',                         views.thread_heart_beats,
+            r'/traces(\.json|/chrome\.json)?',                views.traces,
             r'/vms',                                        views.vms,
+            r'/vms()()(\.json)',                             views.vms,
         )
 
     def run(self):
@@ -103,17 +124,36 @@ class InfoServer(threading.Thread,):
         self.server.stop()
         self.done = True
 
+class SnapshotView:
+    """A view rendered from the latest info snapshots rather than the live pools.
+
+    Subclasses implement render() instead of GET, using self.resources and
+    self.jobs, the frozen ResourcePool and JobPool.
+    """
+    uses_resources = True
+    uses_jobs = False
+
+    def GET(self, *args):
+        snapshots = []
+        if self.uses_resources:
+            snapshots.append(snapshot.publisher.current_resources(web.cloud_resources))
+            self.resources = snapshots[-1].pool
+        if self.uses_jobs:
+            snapshots.append(snapshot.publisher.current_jobs(web.job_pool))
+            self.jobs = snapshots[-1].pool
+        return respond(lambda: self.render(*args), snapshots)
+
 class views:
-    class cloud:
-        def GET(self):
-            return web.cloud_resources.get_pool_info()
+    class cloud(SnapshotView):
+        def render(self):
+            return self.resources.get_pool_info()
 
     class cloud_config:
         def GET(self):
             return web.cloud_resources.get_cloud_config_output()
 
-    class clusters:
-        def GET(self, cluster_name=None, json=None):
+    class clusters(SnapshotView):
+        def render(self, cluster_name=None, json=None):
 
             if cluster_name:
                 cluster_name = urllib.unquote(cluster_name)
@@ -124,14 +164,14 @@ class views:
                     return self.view_cluster(cluster_name)
             else:
                 if json:
-                    return ResourcePoolJSONEncoder().encode(web.cloud_resources)
+                    return iter_resource_pool_json(self.resources)
                 else:
                     return self.view_resources()
 
         def view_cluster(self, cluster_name):
             output = []
             output.append("Cluster Info: %s\n" % cluster_name)
-            cluster = web.cloud_resources.get_cluster(cluster_name)
+            cluster = self.resources.get_cluster(cluster_name)
             if cluster:
                 output.append(cluster.get_cluster_info_short())
             else:
@@ -140,15 +180,15 @@ class views:
 
         def view_cluster_json(self, cluster_name):
             output = "{}"
-            cluster = web.cloud_resources.get_cluster(cluster_name)
+            cluster = self.resources.get_cluster(cluster_name)
             if cluster:
-                output = ClusterJSONEncoder().encode(cluster)
+                output = ''.join(iter_cluster_json(cluster))
             return output
 
         def view_resources(self):
             output = []
             output.append("Clusters in resource pool:\n")
-            for cluster in web.cloud_resources.resources:
+            for cluster in self.resources.resources:
                 output.append(cluster.get_cluster_info_short())
                 output.append("\n")
             return ''.join(output)
@@ -165,61 +205,12 @@ class views:
                 return "You need to have Guppy installed to get developer " \
                        "information" 
 
-    class diff_types:
-        def GET(self):
+    class diff_types(SnapshotView):
+        uses_jobs = True
+
+        def render(self):
             output = []
-            current_types = web.cloud_resources.vmtype_distribution()
-            desired_types = web.job_pool.job_type_distribution()
-            # Negative difference means will need to create that type
-            diff_types = {}
-            for vmtype in current_types.keys():
-                if vmtype in desired_types.keys():
-                    diff_types[vmtype] = current_types[vmtype] - desired_types[vmtype]
-                else:
-                    diff_types[vmtype] = 1 # changed from 0 to handle users with multiple job types, back to 0 from 1.
-            for vmtype in desired_types.keys():
-                if vmtype not in current_types.keys():
-                    diff_types[vmtype] = -desired_types[vmtype]
-    
-            # With user limiting will need to reset any users that are at their limits
-            # so they will not interfere with scheduling
-            # will need to redistribute negatives to the non-limited users
-            limited_users = []
-            userjoblimits = web.job_pool.get_usertype_limits()
-            for vmusertype in diff_types.keys():
-                user = vmusertype.split(':')[0]
-                if web.cloud_resources.user_at_limit(user):
-                    if vmusertype not in limited_users:
-                        limited_users.append(vmusertype)
-                if vmusertype in userjoblimits.keys():
-                    if web.cloud_resources.uservmtype_at_limit(vmusertype, userjoblimits[vmusertype]):
-                        if vmusertype not in limited_users:
-                            limited_users.append(vmusertype)
-            neg_total = 0
-            for usertype in limited_users:
-                if diff_types[usertype] < 0:
-                    neg_total += diff_types[usertype]
-            splitby = len(diff_types) - len(limited_users)
-            adjustby = 0
-            if splitby > 0:
-                adjustby = neg_total / splitby
-            elif splitby == 0:
-                log.verbose("All users are limited.")
-            else:
-                log.error("More user vmtypes limited than what's in diff types, something weird here.")
-    
-            for usertype in diff_types.keys():
-                if usertype not in limited_users:
-                    diff_types[usertype] += adjustby # the 'extra' will be negative so add it
-                    
-            #for type in current_types.keys():
-                #if type in desired_types.keys():
-                    #diff_types[type] = current_types[type] - desired_types[type]
-                #else:
-                    #diff_types[type] = 1 # changed from 0 to handle users with multiple job types
-            #for type in desired_types.keys():
-                #if type not in current_types.keys():
-                    #diff_types[type] = -desired_types[type]
+            (current_types, desired_types, diff_types) = fairshare.fair_share(self.resources, self.jobs)
             output.append("Diff Types dictionary\n")
             for key, value in diff_types.iteritems():
                 output.append("type: %s, dist: %f\n" % (key, value))
@@ -231,19 +222,62 @@ class views:
                 output.append("type: %s, dist: %f\n" % (key, value))
             return ''.join(output)
 
-    class failures:
-        def GET(self, failure_type):
+    class events:
+        def GET(self, extension=None):
+            params = web.input(since=None, timeout=None, types=None)
+            since = params.since
+            if not extension:
+                # EventSource sends the last id it saw when it reconnects
+                since = web.ctx.env.get('HTTP_LAST_EVENT_ID', since)
+            try:
+                if since is not None:
+                    since = int(since)
+                timeout = min(float(params.timeout or EVENT_WAIT), EVENT_WAIT_MAX)
+            except ValueError:
+                raise web.badrequest("since must be an integer and timeout a number\n")
+            types = None
+            if params.types:
+                types = frozenset(params.types.split(','))
+                if not types.issubset(events.EVENT_TYPES):
+                    raise web.badrequest("Unknown event types, use some of: %s\n" % ', '.join(events.EVENT_TYPES))
+
+            if extension:
+                # Long poll, but answer straight away rather than tie up a
+                # server thread if too many are waiting already
+                if timeout > 0 and feed_waiters.acquire(False):
+                    try:
+                        (found, last, missed) = events.feed.wait(since, timeout, types)
+                    finally:
+                        feed_waiters.release()
+                else:
+                    (found, last, missed) = events.feed.since(since, types)
+                web.header('Content-Type', 'application/json')
+                return json.dumps({'events': found, 'last': last, 'missed': missed})
+
+            if not feed_waiters.acquire(False):
+                raise web.HTTPError("503 Service Unavailable", {'Retry-After': str(EVENT_WAIT)},
+                                    "Too many event followers, try again later\n")
+            web.header('Content-Type', 'text/event-stream')
+            web.header('Cache-Control', 'no-cache')
+            return stream_events(since, types)
+
+    class failures(SnapshotView):
+        uses_jobs = True
+
+        def render(self, failure_type):
             if failure_type == 'boot':
                 return self.view_boot_failures()
             elif failure_type == 'image':
                 return self.view_image_failures()
+            elif failure_type == 'ban':
+                return self.view_ban_events()
 
             raise web.notfound()
 
         def view_boot_failures(self):
             output = []
             output.append("Job Failure Reasons:\n")
-            reasons = web.job_pool.fetch_job_failure_reasons()
+            reasons = self.jobs.fetch_job_failure_reasons()
             for job in reasons:
                 output.append("   Job ID: %s\n" % job.id)
                 for reason in job.failed_boot_reason:
@@ -253,17 +287,26 @@ class views:
         def view_image_failures(self):
             output = []
             output.append("Image Failure List\n")
-            for cloud in web.cloud_resources.resources:
+            for cloud in self.resources.resources:
                 if len(cloud.failed_image_set) > 0:
                     output.append("   Cloud: %s\n" % cloud.name)
                     for image in cloud.failed_image_set:
                         output.append("      Image: %s\n" % image)
             return ''.join(output)
 
-    class ips:
-        def GET(self):
+        def view_ban_events(self):
+            output = []
+            output.append("Recent Image Bans\n")
+            for (ban_time, image, cluster_name, failrate) in list(self.resources.ban_events):
+                output.append("   %s  Cloud: %s  Image: %s  Failure rate: %.2f\n" %
+                              (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ban_time)),
+                               cluster_name, image, failrate))
+            return ''.join(output)
+
+    class ips(SnapshotView):
+        def render(self):
             output = []
-            for cluster in web.cloud_resources.resources:
+            for cluster in self.resources.resources:
                 for vm in cluster.vms:
                     if re.search("(10|192\.168|172\.(1[6-9]|2[0-9]|3[01]))\.", vm.ipaddress):
                         continue
@@ -271,8 +314,11 @@ class views:
                         output.append("[%s]\n\taddress %s\n" % (vm.hostname, vm.ipaddress))
             return ''.join(output)
 
-    class jobs:
-        def GET(self, jobid=None, json=None):
+    class jobs(SnapshotView):
+        uses_resources = False
+        uses_jobs = True
+
+        def render(self, jobid=None, json=None):
             if jobid:
                 jobid = urllib.unquote(jobid)
 
@@ -281,51 +327,59 @@ class views:
                 else:
                     return self.view_job(jobid)
 
+            elif json:
+                return self.view_job_query()
+
             elif 'state' in web.input():
                 return self.view_jobs(web.input().state)
 
             raise web.notfound()
 
         def view_jobs(self, state):
-            output = []
-
-            state = web.input().state
-            if state == 'complete':
-                jobs = web.job_pool.job_container.get_complete_jobs()
-            elif state == 'held':
-                jobs = web.job_pool.job_container.get_held_jobs()
-            elif state == 'high':
-                jobs = web.job_pool.job_container.get_high_priority_jobs()
-            elif state == 'idle':
-                jobs = web.job_pool.job_container.get_idle_jobs()
-            elif state == 'new':
-                jobs = web.job_pool.job_container.get_unscheduled_jobs()
-            elif state == 'running':
-                jobs = web.job_pool.job_container.get_running_jobs()
-            elif state == 'sched':
-                jobs = web.job_pool.job_container.get_scheduled_jobs()
-            else:
+            if state not in JOB_STATES:
                 return ''
-
+            params = web.input(user=None, uservmtype=None, cloud=None)
+            output = []
             output.append(Job.get_job_info_header())
-            for job in jobs:
+            for job in select_jobs(self.jobs.job_container, state, params.user, params.uservmtype, params.cloud):
                 output.append(job.get_job_info())
             return ''.join(output)
 
+        def view_job_query(self):
+            params = web.input(state=None, user=None, uservmtype=None, cloud=None)
+            if params.state and params.state not in JOB_STATES:
+                raise web.badrequest("Unknown job state %s, use one of: %s\n" % (params.state, ', '.join(JOB_STATES)))
+            jobs = select_jobs(self.jobs.job_container, params.state, params.user, params.uservmtype, params.cloud)
+            (page, fields, next_cursor) = query_page(jobs, JOB_SORT_FIELDS,
+                                                     lambda job, sort: (getattr(job, sort), job.id))
+            return JobJSONEncoder().encode({'jobs': [project(job_to_dict(job), fields) for job in page],
+                                            'next': next_cursor})
+
         def view_job(self, jobid):
             output = "Job not found."
-            job = web.job_pool.job_container.get_job_by_id(jobid)
+            job = self.jobs.job_container.get_job_by_id(jobid)
             if job != None:
                 output = job.get_job_info_pretty()
             return output
 
         def view_job_json(self, jobid):
-            job_match = web.job_pool.job_container.get_job_by_id(jobid)
-            return JobJSONEncoder().encode(job_match)
+            job_match = self.jobs.job_container.get_job_by_id(jobid)
+            if job_match is None:
+                return "null"
+            return json_cache.job_json(job_match)
         
-    class job_pool:
+    class job_pool(SnapshotView):
+        uses_resources = False
+        uses_jobs = True
+
+        def render(self):
+            return iter_job_pool_json(self.jobs)
+
+    class metrics:
         def GET(self):
-            return JobPoolJSONEncoder().encode(web.job_pool)
+            collect_metrics()
+            web.header('Content-Type', 'text/plain; version=0.0.4')
+            return metrics.registry.render()
 
     class shared_objs:
         def GET(self):
@@ -342,24 +396,64 @@ class views:
             output.append("\n")
             return ''.join(output)
 
+    class spot_prices:
+        def GET(self, extension=None):
+            if extension:
+                web.header('Content-Type', 'application/json')
+                return json.dumps({'prices': spot_prices.prices.rows(),
+                                   'regions': spot_prices.prices.status()})
+            return format_spot_prices(spot_prices.prices)
+
+    class stored_vms:
+        def GET(self):
+            # Straight from the state store, without walking the live clusters
+            if not web.cloud_resources.state_store:
+                raise web.notfound()
+            return json.dumps(web.cloud_resources.state_store.vm_rows())
+
     class thread_heart_beats:
         def GET(self):
             now = time.time()
             output = []
             output.append("Thread Heart beat times:\n")
-            output.append("   Scheduler Thread(%s): %s\n" % (web.scheduler.scheduling_interval, str(int(now - web.scheduler.heart_beat))))
-            output.append("   Cleanup Thread(%s): %s\n" % (web.cleaner.polling_interval, str(int(now - web.cleaner.heart_beat))))
-            output.append("   VMPoller Thread(%s): %s\n" % (web.vm_poller.run_interval, str(int(now - web.vm_poller.heart_beat))))
-            output.append("   JobPoller Thread(%s): %s\n" % (web.job_poller.polling_interval, str(int(now - web.job_poller.heart_beat))))
-            output.append("   MachinePoller Thread(%s): %s\n" % (web.machine_poller.polling_interval, str(int(now - web.machine_poller.heart_beat))))
+            for (label, thread) in (("Scheduler", web.scheduler), ("Cleanup", web.cleaner), ("VMPoller", web.vm_poller),
+                                    ("JobPoller", web.job_poller), ("MachinePoller", web.machine_poller)):
+                stalled = ""
+                if thread.name in watchdog.stalls:
+                    stalled = " STALLED, expected within %d" % watchdog.stalls[thread.name].bound
+                output.append("   %s Thread(%s): %s%s\n" % (label, watchdog.cycle_interval(thread),
+                                                          str(int(now - thread.heart_beat)), stalled))
+            for stall in watchdog.stalls.values():
+                output.append("\n%s stalled at %s:\n%s" % (stall.thread, time.ctime(stall.time), stall.diagnostics))
+            if watchdog.recent_stalls:
+                output.append("\nRecent stalls:\n")
+                for stall in list(watchdog.recent_stalls):
+                    output.append("   %s %s after %ds%s\n" % (time.ctime(stall.time), stall.thread, stall.age,
+                                                           ", restarted" if stall.restarted else ""))
             return ''.join(output)
 
+    class traces:
+        def GET(self, extension=None):
+            params = web.input(thread=None, count=None)
+            try:
+                count = int(params.count) if params.count else None
+            except ValueError:
+                raise web.badrequest("count must be an integer\n")
+            trace_list = tracing.traces.recent(params.thread, count)
+            if extension == '.json':
+                web.header('Content-Type', 'application/json')
+                return json.dumps({'traces': [trace.to_dict() for trace in trace_list]})
+            elif extension:
+                web.header('Content-Type', 'application/json')
+                return json.dumps(tracing.chrome_trace(trace_list))
+            return format_traces(trace_list, tracing.traces.active.values())
+
     class version:
         def GET(self):
             return "Cloud Scheduler version: %s" % version.version
 
-    class vms:
-        def GET(self, cluster_name=None, vm_id=None, json=None):
+    class vms(SnapshotView):
+        def render(self, cluster_name=None, vm_id=None, json=None):
             if cluster_name: cluster_name = urllib.unquote(cluster_name)
             if vm_id: vm_id = urllib.unquote(vm_id)
 
@@ -369,16 +463,31 @@ class views:
                 else:
                     return self.view_vm(cluster_name, vm_id)
 
+            elif json:
+                return self.view_vm_query()
+
             elif 'metric' in web.input():
                 return self.view_vm_metric(cluster_name, web.input().metric)
                 
             else:
                 return self.view_vm_resources()
 
+        def view_vm_query(self):
+            params = web.input(status=None, user=None, uservmtype=None, cloud=None)
+            vms = select_vms(self.resources, params.status, params.user, params.uservmtype, params.cloud)
+            (page, fields, next_cursor) = query_page(vms, VM_SORT_FIELDS,
+                                                     lambda (cluster, vm), sort: (getattr(vm, sort), cluster.name, vm.id))
+            items = []
+            for (cluster, vm) in page:
+                vm_dict = vm_to_dict(vm)
+                vm_dict['cloud'] = cluster.name
+                items.append(project(vm_dict, fields))
+            return VMJSONEncoder().encode({'vms': items, 'next': next_cursor})
+
         def view_vm(self, cluster_name, vm_id):
             output = []
             output.append("VM Info for VM id: %s\n" % vm_id)
-            cluster = web.cloud_resources.get_cluster(cluster_name)
+            cluster = self.resources.get_cluster(cluster_name)
             vm = None
             if cluster:
                 vm = cluster.get_vm(vm_id)
@@ -392,24 +501,24 @@ class views:
 
         def view_vm_json(self, cluster_name, vm_id):
             output = "{}"
-            cluster = web.cloud_resources.get_cluster(cluster_name)
+            cluster = self.resources.get_cluster(cluster_name)
             vm = None
             if cluster:
                 vm = cluster.get_vm(vm_id)
                 if vm:
-                    output = VMJSONEncoder().encode(vm)
+                    output = json_cache.vm_json(vm)
             return output
 
         def view_vm_metric(self, cluster_name, metric):
             if metric == 'all':
                 vms = []
                 if cluster_name:
-                    cluster = web.cloud_resources.get_cluster(cluster_name)
+                    cluster = self.resources.get_cluster(cluster_name)
                     if not cluster:
                         return "Could not find cloud: %s - check cloud_status for list of available clouds" % cluster_name
                     vms.extend(cluster.vms)
                 else:
-                    for cluster in web.cloud_resources.resources:
+                    for cluster in self.resources.resources:
                         vms.extend(cluster.vms)
                 state_count = {'Running':0, 'Starting':0, 'Error':0, 'Retiring':0, 'ExpiredProxy':0, 'NoProxy':0, 'ConnectionRefused':0}
                 for vm in vms:
@@ -426,17 +535,17 @@ class views:
             elif metric == 'job_run_times':
                 output = []
                 output.append("Run Times of Jobs on VMs\n")
-                for cluster in web.cloud_resources.resources:
+                for cluster in self.resources.resources:
                     for vm in cluster.vms:
                         output.append("%s : avg %f\n" % (vm.hostname, vm.job_run_times.average()))
                 return ''.join(output)
 
             elif metric == 'missing':
-                return web.cloud_resources.fetch_missing_vm_list()
+                return self.resources.fetch_missing_vm_list()
 
             elif metric == 'startup_time':
                 output = []
-                for cluster in web.cloud_resources.resources:
+                for cluster in self.resources.resources:
                     output.append("Cluster: %s " % cluster.name)
                     total_time = 0
                     for vm in cluster.vms:
@@ -452,7 +561,7 @@ class views:
                     metric = web.input().metric
                     if metric == 'total':
                         output = []
-                        cluster = web.cloud_resources.get_cluster(cluster_name)
+                        cluster = self.resources.get_cluster(cluster_name)
                         if cluster:
                             output.append(str(cluster.num_vms()))
                         else:
@@ -461,7 +570,7 @@ class views:
                     else:
                         return ''
                 else:
-                    return str(web.cloud_resources.vm_count())
+                    return str(self.resources.vm_count())
 
             raise web.notfound()
 
@@ -470,134 +579,586 @@ class views:
             output.append(VM.get_vm_info_header())
             clusters = 0
             vm_count = 0
-            for cluster in web.cloud_resources.resources:
+            for cluster in self.resources.resources:
                 clusters += 1
                 vm_count += len(cluster.vms)
                 output.append(cluster.get_cluster_vms_info())
             output.append('\nTotal VMs: %i. Total Clouds: %i' % (vm_count, clusters))
             extra_output = []
-            for cluster in web.cloud_resources.retired_resources:
+            for cluster in self.resources.retired_resources:
                 extra_output.append(cluster.get_cluster_vms_info())
             if len(extra_output) > 0:
                 output.append('\n\nRetiring VMs from removing resources:\n')
                 output.extend(extra_output)
             return ''.join(output)
 
+# Default and largest number of items on a page of /jobs.json or /vms.json
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 5000
+# The job states /jobs can select, as used by cloud_status -q
+JOB_STATES = ('all', 'new', 'sched', 'high', 'running', 'idle', 'held', 'complete')
+CONDOR_JOB_STATUS = {'idle': 1, 'running': 2, 'complete': 4, 'held': 5}
+# Fields /jobs.json and /vms.json can sort by
+JOB_SORT_FIELDS = frozenset(['id', 'user', 'priority', 'job_status', 'status', 'uservmtype',
+                             'running_cloud', 'remote_host', 'servertime', 'jobstarttime',
+                             'req_memory', 'req_cpucores', 'req_storage', 'ban_time', 'block_time'])
+VM_SORT_FIELDS = frozenset(['id', 'name', 'hostname', 'status', 'override_status', 'user', 'uservmtype',
+                            'vmtype', 'clusteraddr', 'cloudtype', 'memory', 'cpucores', 'storage',
+                            'errorcount', 'lastpoll', 'last_state_change', 'initialize_time',
+                            'startup_time', 'idle_start'])
+
+# The service threads InfoServer is given, by their web attribute
+SERVICE_THREADS = ('scheduler', 'cleaner', 'vm_poller', 'job_poller', 'machine_poller')
+
+# Output is written to the client in pieces of about this many bytes
+STREAM_CHUNK_SIZE = 65536
+# Smaller responses aren't worth compressing
+GZIP_MIN_SIZE = 1024
+# Most rendered responses to keep, one per path and encoding
+RESPONSE_CACHE_SIZE = 256
+
+# Default and longest time, in seconds, a /events.json long poll waits for an event
+EVENT_WAIT = 30
+EVENT_WAIT_MAX = 300
+# A /events stream sends a comment this often when nothing happens, which is
+# also when a client that has gone away is noticed
+EVENT_KEEPALIVE = 15
+# and ends after this long, EventSource clients reconnect where they left off
+EVENT_STREAM_SECONDS = 600
+# Requests that may wait on the event feed at once. The server has ten
+# threads; the rest are kept for everything else.
+FEED_WAITERS = 4
+
+feed_waiters = threading.Semaphore(FEED_WAITERS)
+
+# Rendered snapshot views: (path, gzip) -> (etag, gzipped, chunks)
+response_cache = {}
+response_cache_lock = threading.Lock()
+
+
+def select_jobs(job_container, state=None, user=None, uservmtype=None, cloud=None):
+    """Yield the jobs in job_container matching all the given filters.
+
+    The container narrows the jobs down by user and scheduled state first,
+    the other filters are checked job by job.
+    """
+    scheduled = {'new': False, 'sched': True}.get(state)
+    job_status = CONDOR_JOB_STATUS.get(state)
+    for job in job_container.iter_jobs(user=user, scheduled=scheduled):
+        if job_status is not None and job.job_status != job_status:
+            continue
+        if state == 'high' and not job.high_priority:
+            continue
+        if uservmtype and job.uservmtype != uservmtype:
+            continue
+        if cloud and job.running_cloud != cloud:
+            continue
+        yield job
+
+def select_vms(resource_pool, status=None, user=None, uservmtype=None, cloud=None):
+    """Yield (cluster, vm) for the VMs matching all the given filters.
+
+    status matches a VM's override_status if it has one, like cloud_status -u.
+    """
+    if cloud:
+        clusters = [cluster for cluster in [resource_pool.get_cluster(cloud)] if cluster]
+    else:
+        clusters = resource_pool.resources
+    for cluster in clusters:
+        for vm in cluster.vms:
+            if status and (vm.override_status or vm.status) != status:
+                continue
+            if user and vm.user != user:
+                continue
+            if uservmtype and vm.uservmtype != uservmtype:
+                continue
+            yield (cluster, vm)
+
+def query_page(items, sort_fields, sort_key):
+    """Apply the fields, sort, limit and cursor query parameters to items.
+
+    sort_key(item, field) gives the key to order an item by, ending in
+    something unique to the item. Returns the items on the page, the fields
+    asked for (None for all of them) and the cursor for the next page (None
+    if this is the last). items are gone through once and no more than a
+    page of them is kept.
+    """
+    params = web.input(fields=None, sort='id', limit=None, cursor=None)
+    fields = None
+    if params.fields:
+        fields = [field.strip() for field in params.fields.split(',') if field.strip()]
+    descending = params.sort.startswith('-')
+    sort = params.sort.lstrip('-')
+    if sort not in sort_fields:
+        raise web.badrequest("Can't sort by %s, use one of: %s\n" % (sort, ', '.join(sorted(sort_fields))))
+    try:
+        limit = min(max(int(params.limit or PAGE_SIZE), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        raise web.badrequest("limit must be an integer\n")
+    key = lambda item: sort_key(item, sort)
+
+    if params.cursor:
+        try:
+            after = tuple(json.loads(base64.urlsafe_b64decode(str(params.cursor))))
+        except (TypeError, ValueError):
+            raise web.badrequest("Bad cursor %s\n" % params.cursor)
+        if descending:
+            items = (item for item in items if key(item) < after)
+        else:
+            items = (item for item in items if key(item) > after)
+
+    if descending:
+        page = heapq.nlargest(limit + 1, items, key=key)
+    else:
+        page = heapq.nsmallest(limit + 1, items, key=key)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = base64.urlsafe_b64encode(json.dumps(key(page[-1])))
+    return (page, fields, next_cursor)
+
+def project(item, fields):
+    """Just the given fields of an item's dict, all of them if fields is None."""
+    if fields is None:
+        return item
+    try:
+        return dict((field, item[field]) for field in fields)
+    except KeyError, e:
+        raise web.badrequest("Unknown field %s\n" % e)
+
+def replace_thread(old, new):
+    """Show new instead of old, a service thread the watchdog replaced."""
+    for name in SERVICE_THREADS:
+        if getattr(web, name, None) is old:
+            setattr(web, name, new)
+
+def collect_metrics():
+    """Fill in the gauges describing the threads and pools, from the latest snapshots."""
+    now = time.time()
+    threads = [thread for thread in (getattr(web, name, None) for name in SERVICE_THREADS) if thread]
+    metrics.thread_heart_beat_age_seconds.replace(dict(((thread.name,), now - thread.heart_beat)
+                                                       for thread in threads))
+    metrics.destroy_queue_depth.replace(dict(((thread.name,), len(thread.destroy_threads))
+                                             for thread in threads if hasattr(thread, 'destroy_threads')))
+
+    resources = snapshot.publisher.current_resources(web.cloud_resources).pool
+    vm_counts = {}
+    for cluster in resources.resources:
+        for vm in cluster.vms:
+            key = (cluster.name, vm.override_status or vm.status)
+            vm_counts[key] = vm_counts.get(key, 0) + 1
+    metrics.vms.replace(vm_counts)
+
+    job_container = snapshot.publisher.current_jobs(web.job_pool).pool.job_container
+    metrics.jobs.replace({('new',): sum(1 for job in job_container.iter_jobs(scheduled=False)),
+                          ('sched',): sum(1 for job in job_container.iter_jobs(scheduled=True))})
+
+def step_times(trace):
+    """The seconds and calls of each step in trace, by the names of the
+    spans down to it, and those paths in the order the steps first started."""
+    times = {}
+    order = []
+    path = []
+    for (name, start, duration, depth) in sorted(trace.spans, key=lambda span: (span[1], span[3])):
+        del path[depth - 1:]
+        path.append(name)
+        key = tuple(path)
+        if key not in times:
+            times[key] = [0.0, 0]
+            order.append(key)
+        times[key][0] += duration
+        times[key][1] += 1
+    return (times, order)
+
+def format_traces(trace_list, running=()):
+    """Per thread, the time each step took in the last of trace_list's cycles
+    with the mean and most over all of them, and where running cycles are up to."""
+    by_thread = {}
+    for trace in trace_list:
+        by_thread.setdefault(trace.thread, []).append(trace)
+    output = []
+    for thread in sorted(by_thread):
+        cycles = by_thread[thread]
+        last = cycles[-1]
+        durations = [trace.duration for trace in cycles]
+        output.append("%s: last %s at %s took %.3fs, mean %.3fs, max %.3fs over %d cycles\n"
+                      % (thread, last.name, time.strftime("%H:%M:%S", time.localtime(last.start)),
+                         last.duration, sum(durations) / len(durations), max(durations), len(cycles)))
+        if last.error:
+            output.append("   failed with %s\n" % last.error)
+        cycle_times = [step_times(trace) for trace in cycles]
+        order = list(cycle_times[-1][1])
+        for (times, steps) in reversed(cycle_times[:-1]):
+            order.extend(key for key in steps if key not in cycle_times[-1][0] and key not in order)
+        output.append("   %-50s %9s %6s %9s %9s\n" % ("step", "last", "calls", "mean", "max"))
+        for key in order:
+            seen = [times[key][0] for (times, steps) in cycle_times if key in times]
+            (seconds, calls) = cycle_times[-1][0].get(key, (0.0, 0))
+            output.append("   %-50s %8.3fs %6d %8.3fs %8.3fs\n"
+                          % (("  " * (len(key) - 1) + key[-1])[:50], seconds, calls,
+                             sum(seen) / len(seen), max(seen)))
+        if last.dropped:
+            output.append("   (%d more spans not kept)\n" % last.dropped)
+        output.append("\n")
+    now = time.time()
+    for trace in sorted(running, key=lambda trace: trace.thread):
+        output.append("%s: %s running for %.3fs, in %s\n"
+                      % (trace.thread, trace.name, now - trace.start, " > ".join(trace.current()) or "-"))
+    if not output:
+        output.append("No cycles traced yet.\n")
+    return ''.join(output)
+
+def format_spot_prices(table):
+    """table's prices as text, a section per region."""
+    output = []
+    rows = table.rows()
+    for (region, (fetched, error)) in sorted(table.status().items()):
+        output.append("Region %s, fetched %s%s\n" % (region, time.ctime(fetched) if fetched else "never",
+                                                   ", last fetch failed: %s" % error if error else ""))
+        output.append("%-15s %-30s %-15s %10s  %s\n" % ("INSTANCE TYPE", "PRODUCT", "ZONE", "PRICE", "AS OF"))
+        for row in rows:
+            if row['region'] == region:
+                output.append("%-15s %-30s %-15s %10.4f  %s\n" % (row['instance_type'], row['product'],
+                                                                  row['zone'], row['price'], row['timestamp']))
+        output.append("\n")
+    if not output:
+        return "No spot prices, is spot_price_refresh_interval set?\n"
+    return ''.join(output)
+
+
+def stream_events(since, types, seconds=EVENT_STREAM_SECONDS):
+    """Yield the event feed after since as server-sent events for seconds.
+
+    Releases the feed_waiters slot the request took when it's done.
+    """
+    try:
+        deadline = time.time() + seconds
+        if since is None:
+            since = events.feed.since(None)[1]
+        # Reconnect quickly once the stream ends
+        yield "retry: 1000\n\n"
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            (found, since, missed) = events.feed.wait(since, min(remaining, EVENT_KEEPALIVE), types)
+            pieces = []
+            if missed:
+                pieces.append("event: missed\ndata: %s\n\n" % json.dumps({'last': since}))
+            for event in found:
+                pieces.append("id: %d\nevent: %s\ndata: %s\n\n" % (event['id'], event['type'], json.dumps(event)))
+            if not pieces:
+                pieces.append(": keepalive\n\n")
+            yield ''.join(pieces)
+    finally:
+        feed_waiters.release()
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches etag (weak comparison)."""
+    if not if_none_match:
+        return False
+    bare = etag.replace('W/', '', 1)
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.replace('W/', '', 1) == bare:
+            return True
+    return False
+
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header value allows gzip."""
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            (name, sep, value) = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = [compressor.compress(chunk) for chunk in chunks]
+    compressed.append(compressor.flush())
+    return [chunk for chunk in compressed if chunk]
+
+def respond(render, snapshots):
+    """Serve the output of render() for the given snapshots.
+
+    The ETag is made from the snapshot versions, so a request with a
+    matching If-None-Match gets 304 Not Modified without rendering anything,
+    and the rendered output is kept and served again until a newer snapshot
+    is published. Output is gzipped for clients that accept it.
+    """
+    etag = 'W/"%s"' % '+'.join(snapshot.tag for snapshot in snapshots)
+    if etag_matches(web.ctx.env.get('HTTP_IF_NONE_MATCH'), etag):
+        raise web.notmodified()
+
+    gzipped = accepts_gzip(web.ctx.env.get('HTTP_ACCEPT_ENCODING', ''))
+    key = (web.ctx.fullpath, gzipped)
+    with response_cache_lock:
+        entry = response_cache.get(key)
+    if entry is None or entry[0] != etag:
+        output = render()
+        if output is None:
+            chunks = []
+        elif isinstance(output, basestring):
+            chunks = [output]
+        else:
+            chunks = list(buffered(output))
+        compress = gzipped and sum(len(chunk) for chunk in chunks) >= GZIP_MIN_SIZE
+        if compress:
+            chunks = gzip_chunks(chunks)
+        entry = (etag, compress, chunks)
+        with response_cache_lock:
+            if len(response_cache) >= RESPONSE_CACHE_SIZE:
+                response_cache.clear()
+            response_cache[key] = entry
+
+    web.header('ETag', etag)
+    web.header('Vary', 'Accept-Encoding')
+    if entry[1]:
+        web.header('Content-Encoding', 'gzip')
+    return iter(entry[2])
+
+
+def vm_to_dict(vm):
+    """The JSON fields of a VM."""
+    return {'name': vm.name, 'id': vm.id, 'vmtype': vm.vmtype,
+            'hostname': vm.hostname, 'clusteraddr': vm.clusteraddr,
+            'ipaddress': vm.ipaddress, 'ssh_port': vm.ssh_port,
+            'cloudtype': vm.cloudtype, 'network': vm.network,
+            'image': vm.image, 'alt_hostname': vm.alt_hostname,
+            'memory': vm.memory, 'flavor': vm.flavor,
+            'cpucores': vm.cpucores, 'storage': vm.storage,
+            'status': vm.status, 'condoraddr': vm.condoraddr,
+            'condorname': vm.condorname, 'condormasteraddr': vm.condormasteraddr,
+            'keep_alive': vm.keep_alive, 'user': vm.user, 'uservmtype': vm.uservmtype,
+            'clusterport': vm.clusterport,
+            'errorcount': vm.errorcount, 'errorconnect': vm.errorconnect,
+            'lastpoll': vm.lastpoll, 'last_state_change': vm.last_state_change,
+            'initialize_time': vm.initialize_time, 'startup_time': vm.startup_time,
+            'idle_start': vm.idle_start, 'spot_id': vm.spot_id,
+            'proxy_file': vm.proxy_file, 'myproxy_creds_name': vm.myproxy_creds_name,
+            'myproxy_server': vm.myproxy_server, 'myproxy_server_port': vm.myproxy_server_port,
+            'myproxy_renew_time': vm.myproxy_renew_time, 'override_status': vm.override_status,
+            'job_per_core': vm.job_per_core, 'force_retire': vm.force_retire,
+            'failed_retire': vm.failed_retire, 'x509userproxy_expiry_time': str(vm.x509userproxy_expiry_time),
+            'job_run_times': list(vm.job_run_times.data)}
+
+def cluster_fields(cluster):
+    """The JSON fields of a cluster, apart from its VMs."""
+    cluster_dict = {'name': cluster.name, 'network_address': cluster.network_address,
+            'cloud_type': cluster.cloud_type, 'memory': cluster.memory,
+            'network_pools': cluster.network_pools,
+            'vm_slots': cluster.vm_slots, 'cpu_cores': cluster.cpu_cores,
+            'storageGB': cluster.storageGB, 'enabled':cluster.enabled,
+            'max_mem': cluster.max_mem,
+            'max_vm_mem': cluster.max_vm_mem, 'max_slots': cluster.max_slots,
+            'max_storageGB': cluster.max_storageGB, 'boot_timeout': cluster.boot_timeout,
+            'connection_fail_disable_time': cluster.connection_fail_disable_time,
+            'connection_problem': cluster.connection_problem,
+            'errorconnect': cluster.errorconnect}
+    if isinstance(cluster, OpenStackCluster):
+        cluster_dict['tenant'] = cluster.tenant_name
+    return cluster_dict
+
+def cluster_to_dict(cluster):
+    """The JSON fields of a cluster and its VMs."""
+    cluster_dict = cluster_fields(cluster)
+    cluster_dict['vms'] = [vm_to_dict(vm) for vm in list(cluster.vms)]
+    return cluster_dict
+
+def job_to_dict(job):
+    """The JSON fields of a job."""
+    expiry_time = job.x509userproxy_expiry_time
+    return {'id': job.id, 'user': job.user, 'priority': job.priority,
+            'job_status': job.job_status, 'cluster_id': job.cluster_id,
+            'proc_id': job.proc_id, 'req_vmtype': job.req_vmtype,
+            'req_network': job.req_network,
+            'req_image': job.req_image, 'req_imageloc': job.req_imageloc,
+            'req_ami': job.req_ami, 'req_memory': job.req_memory,
+            'req_cpucores': job.req_cpucores, 'req_storage': job.req_storage,
+            'keep_alive': job.keep_alive, 'status': job.status,
+            'remote_host': job.remote_host, 'running_cloud': job.running_cloud,
+            'banned': job.banned, 'ban_time': job.ban_time, 'target_clouds': list(job.target_clouds),
+            'blocked_clouds': list(job.blocked_clouds), 'uservmtype': job.uservmtype,
+            'high_priority': job.high_priority, 'instance_type': job.instance_type,
+            'maximum_price': job.maximum_price, 'spool_dir': job.spool_dir,
+            'myproxy_server': job.myproxy_server, 'myproxy_server_port': job.myproxy_server_port,
+            'myproxy_creds_name': job.myproxy_creds_name,
+            'running_vm': job.running_vm.id if job.running_vm else None,
+            'x509userproxysubject': job.x509userproxysubject, 'x509userproxy': job.x509userproxy,
+            'original_x509userproxy': job.original_x509userproxy,
+            'x509userproxy_expiry_time': str(expiry_time) if expiry_time is not None else None,
+            'proxy_renew_time': job.proxy_renew_time, 'job_per_core': job.job_per_core,
+            'servertime': job.servertime, 'jobstarttime': job.jobstarttime,
+            'machine_reserved': job.machine_reserved,
+            'proxy_non_boot': job.proxy_non_boot, 'vmimage_proxy_file': job.vmimage_proxy_file,
+            'usertype_limit': job.usertype_limit, 'req_image_id': job.req_image_id,
+            'location': job.location,
+            'key_name': job.key_name, 'req_security_group': job.req_security_group,
+            'override_status': job.override_status, 'block_time': job.block_time
+            }
+
+# Everything job_to_dict reads from a job, as a tuple. blocked_clouds and
+# target_clouds are changed in place, so they are compared as copies.
+JOB_JSON_FIELDS = operator.attrgetter(
+        'id', 'user', 'priority', 'job_status', 'cluster_id', 'proc_id', 'req_vmtype',
+        'req_network', 'req_image', 'req_imageloc', 'req_ami', 'req_memory', 'req_cpucores',
+        'req_storage', 'keep_alive', 'status', 'remote_host', 'running_cloud', 'banned',
+        'ban_time', 'uservmtype', 'high_priority', 'instance_type', 'maximum_price',
+        'spool_dir', 'myproxy_server', 'myproxy_server_port', 'myproxy_creds_name',
+        'running_vm', 'x509userproxysubject', 'x509userproxy', 'original_x509userproxy',
+        'x509userproxy_expiry_time', 'proxy_renew_time', 'job_per_core', 'servertime',
+        'jobstarttime', 'machine_reserved', 'proxy_non_boot', 'vmimage_proxy_file',
+        'usertype_limit', 'req_image_id', 'location', 'key_name', 'req_security_group',
+        'override_status', 'block_time')
+
+
+class JSONCache:
+    """Encoded JSON for VMs and jobs, reused until the object changes.
+
+    A VM entry is good while the VM's change_count stays the same. Jobs
+    don't count their changes (doing it on every attribute set slows
+    condor_q parsing by a third), so a job entry keeps the values of the
+    attributes its JSON is made from (JOB_JSON_FIELDS) and is good while
+    they compare equal, which is much cheaper than encoding them again.
+
+    Entries are keyed by id() and hold a weak reference to check the object
+    is still the same one; the entries of objects that are gone are dropped
+    whenever the cache has doubled in size.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # id(object) -> (weak reference to the object, validity key, cached value)
+        self.entries = {}
+        self.prune_size = 1024
+
+    def get(self, obj, key, build):
+        """The cached value for obj if key still matches, otherwise build()."""
+        with self.lock:
+            entry = self.entries.get(id(obj))
+        if entry is None or entry[0]() is not obj or entry[1] != key:
+            entry = (weakref.ref(obj), key, build())
+            with self.lock:
+                self.entries[id(obj)] = entry
+                if len(self.entries) > self.prune_size:
+                    self.prune()
+        return entry[2]
+
+    def prune(self):
+        """Drop the entries of objects that are gone, with the lock held."""
+        for (obj_id, entry) in self.entries.items():
+            if entry[0]() is None:
+                del self.entries[obj_id]
+        self.prune_size = max(1024, 2 * len(self.entries))
+
+    def vm_json(self, vm):
+        return self.get(vm, vm.change_count, lambda: VMJSONEncoder().encode(vm_to_dict(vm)))
+
+    def job_entry(self, job):
+        """The job's JSON, and that JSON as a JSON string for /job-pool.json."""
+        def build():
+            text = JobJSONEncoder().encode(job_to_dict(job))
+            return (text, json.dumps(text))
+        key = (JOB_JSON_FIELDS(job), tuple(job.blocked_clouds), tuple(job.target_clouds))
+        return self.get(job, key, build)
+
+    def job_json(self, job):
+        return self.job_entry(job)[0]
+
+json_cache = JSONCache()
+
+
+def buffered(pieces, size=STREAM_CHUNK_SIZE):
+    """Join small pieces of output into chunks of about size bytes."""
+    chunk = []
+    length = 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+def iter_cluster_json(cluster):
+    """Yield the JSON for a cluster in pieces, its VMs from json_cache."""
+    head = ClusterJSONEncoder().encode(cluster_fields(cluster))
+    yield head[:-1] + ', "vms": ['
+    for (i, vm) in enumerate(list(cluster.vms)):
+        if i:
+            yield ', '
+        yield json_cache.vm_json(vm)
+    yield ']}'
+
+def iter_resource_pool_json(res_pool):
+    """Yield the JSON for /clusters.json in pieces."""
+    yield '{"resources": ['
+    for (i, cluster) in enumerate(list(res_pool.resources)):
+        if i:
+            yield ', '
+        for piece in iter_cluster_json(cluster):
+            yield piece
+    yield ']}'
+
+def iter_job_pool_json(job_pool):
+    """Yield the JSON for /job-pool.json in pieces.
+
+    As always, each job in the lists is itself a JSON encoded string.
+    """
+    queues = (('new_jobs', job_pool.job_container.get_unscheduled_jobs()),
+              ('sched_jobs', job_pool.job_container.get_scheduled_jobs()))
+    for (i, (name, jobs)) in enumerate(queues):
+        yield (', "%s": [' if i else '{"%s": [') % name
+        for (j, job) in enumerate(jobs):
+            if j:
+                yield ', '
+            yield json_cache.job_entry(job)[1]
+        yield ']'
+    yield '}'
+
+
 class VMJSONEncoder(json.JSONEncoder):
     def default(self, vm):
         if not isinstance (vm, VM):
             log.error("Cannot use VMJSONEncoder on non VM object of type %s, %s" % (type(vm), vm))
             return
-        return {'name': vm.name, 'id': vm.id, 'vmtype': vm.vmtype,
-                'hostname': vm.hostname, 'clusteraddr': vm.clusteraddr,
-                'ipaddress': vm.ipaddress, 'ssh_port': vm.ssh_port,
-                'cloudtype': vm.cloudtype, 'network': vm.network, 
-                'image': vm.image, 'alt_hostname': vm.alt_hostname,
-                'memory': vm.memory, 'flavor': vm.flavor,
-                'cpucores': vm.cpucores, 'storage': vm.storage, 
-                'status': vm.status, 'condoraddr': vm.condoraddr,
-                'condorname': vm.condorname, 'condormasteraddr': vm.condormasteraddr,
-                'keep_alive': vm.keep_alive, 'user': vm.user, 'uservmtype': vm.uservmtype,
-                'clusteraddr': vm.clusteraddr, 'clusterport': vm.clusterport,
-                'errorcount': vm.errorcount, 'errorconnect': vm.errorconnect,
-                'lastpoll': vm.lastpoll, 'last_state_change': vm.last_state_change,
-                'initialize_time': vm.initialize_time, 'startup_time': vm.startup_time,
-                'idle_start': vm.idle_start, 'spot_id': vm.spot_id,
-                'proxy_file': vm.proxy_file, 'myproxy_creds_name': vm.myproxy_creds_name,
-                'myproxy_server': vm.myproxy_server, 'myproxy_server_port': vm.myproxy_server_port,
-                'myproxy_renew_time': vm.myproxy_renew_time, 'override_status': vm.override_status,
-                'job_per_core': vm.job_per_core, 'force_retire': vm.force_retire,
-                'failed_retire': vm.failed_retire, 'x509userproxy_expiry_time': str(vm.x509userproxy_expiry_time),
-                'job_run_times': list(vm.job_run_times.data)}
+        return vm_to_dict(vm)
 
 class ClusterJSONEncoder(json.JSONEncoder):
     def default(self, cluster):
         if not isinstance (cluster, ICluster):
             log.error("Cannot use ClusterJSONEncoder on non Cluster object")
             return
-        vmEncodes = []
-        for vm in cluster.vms:
-            vmEncodes.append(VMJSONEncoder().encode(vm))
-        vmDecodes = []
-        for vm in vmEncodes:
-            vmDecodes.append(json.loads(vm))
-        cluster_dict = {'name': cluster.name, 'network_address': cluster.network_address,
-                'cloud_type': cluster.cloud_type, 'memory': cluster.memory, 
-                'network_pools': cluster.network_pools, 
-                'vm_slots': cluster.vm_slots, 'cpu_cores': cluster.cpu_cores, 
-                'storageGB': cluster.storageGB, 'vms': vmDecodes, 'enabled':cluster.enabled,
-                'max_mem': cluster.max_mem,
-                'max_vm_mem': cluster.max_vm_mem, 'max_slots': cluster.max_slots,
-                'max_storageGB': cluster.max_storageGB, 'boot_timeout': cluster.boot_timeout,
-                'connection_fail_disable_time': cluster.connection_fail_disable_time,
-                'connection_problem': cluster.connection_problem,
-                'errorconnect': cluster.errorconnect}
-        if isinstance(cluster, OpenStackCluster):
-            cluster_dict['tenant'] = cluster.tenant_name
-        return cluster_dict
+        return cluster_to_dict(cluster)
 
 class ResourcePoolJSONEncoder(json.JSONEncoder):
     def default(self, res_pool):
         if not isinstance (res_pool, ResourcePool):
             log.error("Cannot use ResourcePoolJSONEncoder on non ResourcePool Object")
             return
-        pool = []
-        for cluster in res_pool.resources:
-            pool.append(ClusterJSONEncoder().encode(cluster))
-        poolDecodes = []
-        for cluster in pool:
-            poolDecodes.append(json.loads(cluster))
-        return {'resources': poolDecodes}
+        return {'resources': [cluster_to_dict(cluster) for cluster in res_pool.resources]}
 
 class JobJSONEncoder(json.JSONEncoder):
     def default(self, job):
         if not isinstance(job, Job):
             log.error("Cannot use JobJSONEncoder on non Job Object")
             return
-        return {'id': job.id, 'user': job.user, 'priority': job.priority,
-                'job_status': job.job_status, 'cluster_id': job.cluster_id,
-                'proc_id': job.proc_id, 'req_vmtype': job.req_vmtype,
-                'req_network': job.req_network,
-                'req_image': job.req_image, 'req_imageloc': job.req_imageloc,
-                'req_ami': job.req_ami, 'req_memory': job.req_memory,
-                'req_cpucores': job.req_cpucores, 'req_storage': job.req_storage,
-                'keep_alive': job.keep_alive, 'status': job.status,
-                'remote_host': job.remote_host, 'running_cloud': job.running_cloud,
-                'banned': job.banned, 'ban_time': job.ban_time, 'target_clouds':job.target_clouds,
-                'blocked_clouds':job.blocked_clouds, 'uservmtype': job.uservmtype,
-                'high_priority': job.high_priority, 'instance_type': job.instance_type,
-                'maximum_price': job.maximum_price, 'spool_dir': job.spool_dir,
-                'myproxy_server': job.myproxy_server, 'myproxy_server_port': job.myproxy_server_port,
-                'myproxy_creds_name': job.myproxy_creds_name, 'running_vm': job.running_vm,
-                'x509userproxysubject': job.x509userproxysubject, 'x509userproxy': job.x509userproxy,
-                'original_x509userproxy': job.original_x509userproxy,
-                'x509userproxy_expiry_time': job.x509userproxy_expiry_time,
-                'proxy_renew_time': job.proxy_renew_time, 'job_per_core': job.job_per_core,
-                'servertime': job.servertime, 'jobstarttime': job.jobstarttime,
-                'machine_reserved': job.machine_reserved,
-                'proxy_non_boot': job.proxy_non_boot, 'vmimage_proxy_file': job.vmimage_proxy_file,
-                'usertype_limit': job.usertype_limit, 'req_image_id': job.req_image_id,
-                'location': job.location,
-                'key_name': job.key_name, 'req_security_group': job.req_security_group,
-                'override_status': job.override_status, 'block_time': job.block_time
-                }
+        return job_to_dict(job)
 
 class JobPoolJSONEncoder(json.JSONEncoder):
     def default(self, job_pool):
         if not isinstance(job_pool, JobPool):
             log.error("Cannot use JobPoolJSONEncoder on non JobPool Object")
             return
-        new_queue = []
-        for job in job_pool.job_container.get_unscheduled_jobs():
-            new_queue.append(JobJSONEncoder().encode(job))
-        sched_queue = []
-        for job in job_pool.job_container.get_scheduled_jobs():
-            sched_queue.append(JobJSONEncoder().encode(job))
-        new_decodes = []
-        for job in new_queue:
-            print job
-            new_decodes.append(job)
-        sched_decodes = []
-        for job in sched_queue:
-            sched_decodes.append(job)
-        return {'new_jobs': new_decodes, 'sched_jobs': sched_decodes}
+        return {'new_jobs': [json_cache.job_json(job) for job in job_pool.job_container.get_unscheduled_jobs()],
+                'sched_jobs': [json_cache.job_json(job) for job in job_pool.job_container.get_scheduled_jobs()]}
@@ -1,13 +1,22 @@
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
+import copy
 import time
 import threading
 import logging
 import cloudscheduler.config as config
+import cloudscheduler.events as events
 
 # Use this global variable for logging.
 log = None
 
+
+def job_event(job, attribute, old, new):
+    """Put a change to one of job's statuses on the event feed."""
+    events.feed.emit('job', job=job.id, user=job.user, uservmtype=job.uservmtype,
+                     attribute=attribute, old=old, new=new)
+
+
 #
 # This is an abstract base class; do not instantiate directly.
 #
@@ -111,11 +120,25 @@ class JobContainer():
     def get_users(self):
         pass
 
+    # Returns a copy of the container holding the same jobs, which adding or
+    # removing jobs in this container doesn't change. The jobs aren't copied.
+    @abstractmethod
+    def copy(self):
+        pass
+
     # Returns a list of all jobs in the container, in no particular order, or [] if the container is empty.
     @abstractmethod
     def get_all_jobs(self):
         pass
 
+    # Returns an iterator over the jobs of a user (if user is given) that are
+    # scheduled (scheduled=True) or unscheduled (scheduled=False), narrowed
+    # down with the container's own tables rather than by building lists.
+    # Don't iterate over a container other threads are changing without the lock.
+    @abstractmethod
+    def iter_jobs(self, user=None, scheduled=None):
+        pass
+
     # Get a job by job id.
     # Return the job with the given job id, or None if the job does not exist in the container.
     @abstractmethod
@@ -321,9 +344,34 @@ class HashTableJobContainer(JobContainer):
     def get_users(self):
         return self.jobs_by_user.keys()
 
+    def copy(self):
+        with self.lock:
+            copied = copy.copy(self)
+            copied.lock = threading.RLock()
+            copied.all_jobs = dict(self.all_jobs)
+            copied.new_jobs = dict(self.new_jobs)
+            copied.sched_jobs = dict(self.sched_jobs)
+            copied.jobs_by_user = defaultdict(dict)
+            for (user, jobs) in self.jobs_by_user.iteritems():
+                copied.jobs_by_user[user] = dict(jobs)
+        return copied
+
     def get_all_jobs(self):
         return self.all_jobs.values()
 
+    def iter_jobs(self, user=None, scheduled=None):
+        if user is not None:
+            jobs = self.jobs_by_user.get(user, {}).itervalues()
+            if scheduled is None:
+                return jobs
+            status = "Scheduled" if scheduled else "Unscheduled"
+            return (job for job in jobs if job.status == status)
+        if scheduled is True:
+            return self.sched_jobs.itervalues()
+        if scheduled is False:
+            return self.new_jobs.itervalues()
+        return self.all_jobs.itervalues()
+
     def get_job_by_id(self, jobid):
         try:
             return self.all_jobs[jobid]
@@ -511,7 +559,8 @@ class HashTableJobContainer(JobContainer):
             if job.job_status != status and job.override_status != None:
                 job.override_status = None
             if job.job_status != status:
-                log.debug("Job %s status change: %s -> %s" % (job.id, self.job_status_list[job.job_status], self.job_status_list[status]))
+                log.debug("Job %s status change: %s -> %s", job.id, self.job_status_list[job.job_status], self.job_status_list[status])
+                job_event(job, 'job_status', self.job_status_list[job.job_status], self.job_status_list[status])
             job.job_status = status
             job.remote_host = remote
             job.servertime = int(servertime)
@@ -534,6 +583,7 @@ class HashTableJobContainer(JobContainer):
             if jobid in self.new_jobs:
                 job = self.new_jobs[jobid]
                 job.set_status("Scheduled")
+                job_event(job, 'status', "Unscheduled", "Scheduled")
                 self.sched_jobs[jobid] = job
                 del self.new_jobs[jobid]
                 #log.verbose('Job %s marked as scheduled in the job container' % (jobid))
@@ -547,6 +597,7 @@ class HashTableJobContainer(JobContainer):
             if jobid in self.sched_jobs:
                 job = self.sched_jobs[jobid]
                 job.set_status("Unscheduled")
+                job_event(job, 'status', "Scheduled", "Unscheduled")
                 self.new_jobs[jobid] = job
                 del self.sched_jobs[jobid]
                 #log.verbose('Job %s marked as unscheduled in the job container' % (jobid))
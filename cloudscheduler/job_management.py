@@ -30,20 +30,24 @@ import re
 import sys
 import shlex
 import string
+import time
 import logging
 import datetime
 import threading
-import subprocess
 from urllib2 import URLError
 from StringIO import StringIO
 from collections import defaultdict
 
 import cloudscheduler.config as config
+import cloudscheduler.command_runner as command_runner
+import cloudscheduler.metrics as metrics
 from cloudscheduler.utilities import determine_path
 from cloudscheduler.utilities import get_cert_expiry_time
 from cloudscheduler.utilities import splitnstrip
+from cloudscheduler.utilities import Lazy
+import cloudscheduler.utilities as utilities
 import job_containers
-from decimal import *
+from fractions import Fraction
 
 ##
 ## LOGGING
@@ -251,12 +255,12 @@ class Job:
     
     def log(self):
         """Log a short string representing the job."""
-        log.info("Job ID: %s, User: %s, Priority: %d, VM Type: %s, Image location: %s, Memory: %d, MyProxy creds: %s, MyProxyServer: %s:%s" \
-          % (self.id, self.user, self.priority, self.req_vmtype, self.req_imageloc, self.req_memory, self.myproxy_creds_name, self.myproxy_server, self.myproxy_server_port))
+        log.info("Job ID: %s, User: %s, Priority: %d, VM Type: %s, Image location: %s, Memory: %d, MyProxy creds: %s, MyProxyServer: %s:%s",
+                 self.id, self.user, self.priority, self.req_vmtype, self.req_imageloc, self.req_memory, self.myproxy_creds_name, self.myproxy_server, self.myproxy_server_port)
     def log_dbg(self):
         """Log a longer string representing the job."""
-        log.debug("Job ID: %s, User: %s, Priority: %d, VM Type: %s, Image location: %s, Memory: %d, MyProxy creds: %s, MyProxyServer: %s:%s" \
-          % (self.id, self.user, self.priority, self.req_vmtype, self.req_imageloc, self.req_memory, self.myproxy_creds_name, self.myproxy_server, self.myproxy_server_port))
+        log.debug("Job ID: %s, User: %s, Priority: %d, VM Type: %s, Image location: %s, Memory: %d, MyProxy creds: %s, MyProxyServer: %s:%s",
+                  self.id, self.user, self.priority, self.req_vmtype, self.req_imageloc, self.req_memory, self.myproxy_creds_name, self.myproxy_server, self.myproxy_server_port)
     def get_job_info(self):
         """Formatted job info output for cloud_status -q."""
         CONDOR_STATUS = ("New", "Idle", "Running", "Removed", "Complete", "Held", "Error")
@@ -330,7 +334,7 @@ class Job:
         if self.spool_dir and self.original_x509userproxy:
             proxy += self.spool_dir + "/"
 
-        log.verbose("spool: %s orig: %s x509prox: %s" % (self.spool_dir, self.original_x509userproxy, self.x509userproxy))
+        log.verbose("spool: %s orig: %s x509prox: %s", self.spool_dir, self.original_x509userproxy, self.x509userproxy)
 
         if self.x509userproxy == None:
             proxy = None
@@ -409,10 +413,10 @@ class Job:
             
             proxyfilepath = ''.join(proxypath)
             if not os.path.isfile(proxyfilepath):
-                log.debug("Could not locate the proxy file at %s. Trying alternate location." % proxyfilepath)
+                log.debug("Could not locate the proxy file at %s. Trying alternate location.", proxyfilepath)
                 proxyfilepath = self.vmimage_proxy_file
                 if not os.path.isfile(proxyfilepath):
-                    log.debug("Could not locate the proxy file at %s." % proxyfilepath)
+                    log.debug("Could not locate the proxy file at %s.", proxyfilepath)
                     proxyfilepath = ''
                     # going to try stripping any extra path from the entered value
                     proxy_file_name = self.vmimage_proxy_file.split('/')
@@ -422,7 +426,7 @@ class Job:
                         proxy_file_name = proxy_file_name[0]
                     proxyfilepath = ''.join([self.spool_dir, '/', proxy_file_name])
                     if not os.path.isfile(proxyfilepath):
-                        log.debug("Could not locate the proxy file at %s either." % proxyfilepath)
+                        log.debug("Could not locate the proxy file at %s either.", proxyfilepath)
                         proxyfilepath = ''
         elif self.vmimage_proxy_file:
             if os.path.isfile(self.vmimage_proxy_file):
@@ -471,7 +475,7 @@ class JobPool:
 
         global log
         log = logging.getLogger("cloudscheduler")
-        log.debug("New JobPool %s created" % name)
+        log.debug("New JobPool %s created", name)
         self.job_container = job_containers.HashTableJobContainer()
 
         self.name = name
@@ -511,23 +515,26 @@ class JobPool:
 
     def job_query_local(self):
         """job_query_local -- query and parse condor_q for job information."""
-        log.verbose("Querying Condor scheduler daemon (schedd) with %s" % config.condor_q_command)
-        try:
-            condor_q = shlex.split(config.condor_q_command)
-            sp = subprocess.Popen(condor_q, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sp.communicate(input=None)
-            returncode = sp.returncode
-        except:
-            log.exception("Problem running %s, unexpected error" % string.join(condor_q, " "))
+        log.verbose("Querying Condor scheduler daemon (schedd) with %s", config.condor_q_command)
+        condor_q = shlex.split(config.condor_q_command)
+        result = command_runner.run(condor_q, timeout=config.condor_query_timeout, name="condor_q")
+        if result.error:
+            metrics.condor_query_errors.inc(command="condor_q")
+            log.error("Problem running %s: %s" % (string.join(condor_q, " "), result.error))
             return None
+        metrics.condor_query_seconds.observe(result.duration, command="condor_q")
 
-        if returncode != 0:
+        if result.returncode != 0:
+            metrics.condor_query_errors.inc(command="condor_q")
             log.error("Got non-zero return code '%s' from '%s'. stderr was: %s" %
-                              (returncode, string.join(condor_q, " "), condor_err))
+                              (result.returncode, string.join(condor_q, " "), result.err))
             return None
+        condor_out = result.out
 
+        metrics.condor_query_bytes.set(len(condor_out), command="condor_q")
+        start = time.time()
         job_ads = self._condor_q_to_job_list(condor_out)
+        metrics.condor_parse_seconds.observe(time.time() - start, command="condor_q")
         self.last_query = datetime.datetime.now()
         return job_ads
 
@@ -643,7 +650,7 @@ class JobPool:
             if job.job_status >= self.REMOVED:
                 jobs_removed_due_status += 1
                 query_jobs.remove(job)
-        log.verbose("Jobs removed due to status held, removed, error, complete: %i" % jobs_removed_due_status)
+        log.verbose("Jobs removed due to status held, removed, error, complete: %i", jobs_removed_due_status)
         # Update all system jobs:
         #   - remove jobs already in the system from the jobs list
         #   - remove finished jobs (job in system, not in jobs list)
@@ -688,7 +695,7 @@ class JobPool:
 
 
         # Update job status of all the non-new jobs
-        log.verbose("Updating job status of %d jobs" % (len(jobs_to_update)))
+        log.verbose("Updating job status of %d jobs", len(jobs_to_update))
         for job in jobs_to_update:
             self.update_job_status(job)
             #print job.get_ami_dict()
@@ -776,7 +783,7 @@ class JobPool:
             and not job.banned:
                 required_vmtypes.append(job.req_vmtype)
 
-        log.verbose("get_required_vmtypes - Required VM types: " + ", ".join(required_vmtypes))
+        log.verbose("get_required_vmtypes - Required VM types: %s", Lazy(", ".join, required_vmtypes))
         return required_vmtypes
 
     def get_required_uservmtypes(self):
@@ -795,7 +802,7 @@ class JobPool:
                and not job.banned:
                 required_vmtypes.append(job.uservmtype)
 
-        log.verbose("get_required_uservmtypes - Required VM types: " + ", ".join(required_vmtypes))
+        log.verbose("get_required_uservmtypes - Required VM types: %s", Lazy(", ".join, required_vmtypes))
         return required_vmtypes
 
     def get_required_vmtypes_dict(self):
@@ -849,7 +856,7 @@ class JobPool:
             if vmtype == None:
                 held_user_adjust -= 1 #This user is completely held
                 break
-            type_desired[vmtype] += 1 * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+            type_desired[vmtype] += (Fraction(1, config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
         for user in high_priority_jobs_by_users.keys():
             vmtype = None
             for job in high_priority_jobs_by_users[user]:
@@ -859,13 +866,13 @@ class JobPool:
             if vmtype == None:
                 held_user_adjust -= 1 # this user is completely held
                 break
-            type_desired[vmtype] += 1 * config.high_priority_job_weight
-        num_users = Decimal(held_user_adjust + len(new_jobs_by_users.keys()) + len(high_priority_jobs_by_users.keys()))
+            type_desired[vmtype] += config.high_priority_job_weight
+        num_users = held_user_adjust + len(new_jobs_by_users) + len(high_priority_jobs_by_users)
         if num_users == 0:
             log.verbose("All users held, completed, or banned")
             return {}
         for vmtype in type_desired.keys():
-            type_desired[vmtype] = type_desired[vmtype] / num_users
+            type_desired[vmtype] = Fraction(type_desired[vmtype], num_users)
         return type_desired
 
     def job_usertype_distribution_normal(self):
@@ -887,7 +894,7 @@ class JobPool:
             if vmtype == None:
                 held_user_adjust -= 1 #This user is completely held
                 continue
-            type_desired[vmtype] += 1 * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+            type_desired[vmtype] += (Fraction(1, config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
         for user in high_priority_jobs_by_users.keys():
             vmtype = None
             for job in high_priority_jobs_by_users[user]:
@@ -897,13 +904,13 @@ class JobPool:
             if vmtype == None:
                 held_user_adjust -= 1 # this user is completely held
                 continue
-            type_desired[vmtype] += 1 * config.high_priority_job_weight
-        num_users = Decimal(held_user_adjust + len(new_jobs_by_users.keys()) + len(high_priority_jobs_by_users.keys()))
+            type_desired[vmtype] += config.high_priority_job_weight
+        num_users = held_user_adjust + len(new_jobs_by_users) + len(high_priority_jobs_by_users)
         if num_users == 0:
             log.verbose("All users held, completed, or banned")
             return {}
         for vmtype in type_desired.keys():
-            type_desired[vmtype] = type_desired[vmtype] / num_users
+            type_desired[vmtype] = Fraction(type_desired[vmtype], num_users)
         return type_desired
 
     def job_type_distribution_multi_vmtype(self):
@@ -944,18 +951,18 @@ class JobPool:
         for user in user_types.keys():
             for vmtype in user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] += Fraction(1, len(user_types[user])) * (Fraction(1, config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] = Fraction(1, len(user_types[user])) * (Fraction(1, config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
         for user in high_user_types.keys():
             for vmtype in high_user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] += Fraction(config.high_priority_job_weight, len(high_user_types[user]))
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] = Fraction(config.high_priority_job_weight, len(high_user_types[user]))
         num_users = held_user_adjust + len(set(user_types.keys() + high_user_types.keys()))
         if num_users != 0:
-            num_users = Decimal('1.0') / num_users
+            num_users = Fraction(1, num_users)
         else:
             log.verbose("All users' jobs held, complete, or banned")
             return {}
@@ -1002,18 +1009,18 @@ class JobPool:
         for user in user_types.keys():
             for vmtype in user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] += Fraction(1, len(user_types[user])) * (Fraction(1, config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] = Fraction(1, len(user_types[user])) * (Fraction(1, config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
         for user in high_user_types.keys():
             for vmtype in high_user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] += Fraction(config.high_priority_job_weight, len(high_user_types[user]))
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] = Fraction(config.high_priority_job_weight, len(high_user_types[user]))
         num_users = held_user_adjust + len(set(user_types.keys() + high_user_types.keys()))
         if num_users != 0:
-            num_users = Decimal('1.0') / num_users
+            num_users = Fraction(1, num_users)
         else:
             log.verbose("All users' jobs held, complete, or banned")
             return {}
@@ -1044,67 +1051,90 @@ class JobPool:
                 limits[job.uservmtype] = job.usertype_limit
         return limits
 
-    def job_hold_local(self, jobs, reason=""):
-        """job_query_local -- query and parse condor_q for job information."""
-        log.verbose("Holding Condor jobs with %s" % config.condor_hold_command)
-        try:
-            condor_out = ""
-            condor_err = ""
-            log.verbose("Holding jobs via condor_hold.")
-            condor_hold = shlex.split(config.condor_hold_command)
-            if reason:
-                try:
-                    ri = condor_hold.index('-reason')
-                    condor_hold[ri+1] = reason
-                except ValueError:
-                    condor_hold.append('-reason')
-                    reason = reason.strip('\n')
-                    reason = ' '.join(reason.split('\n'))
-                    condor_hold.append(reason)
-
-            job_ids = [str(job.cluster_id)+"."+str(job.proc_id) for job in jobs]
-            condor_hold.extend(job_ids)
-            log.verbose("Popen condor_hold command")
-            log.verbose(' '.join(condor_hold))
-            sp = subprocess.Popen(condor_hold, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            log.verbose("Popen communicate condor_hold.")
-            (condor_out, condor_err) = sp.communicate(input=None)
-            returncode = sp.returncode
-        except:
-            if condor_err:
-                log.exception("Problem running %s, unexpected error" % string.join(condor_err, " "))
-            else:
-                log.exception("Problem running condor_hold, unexpected error.")
-            return None
+    def job_hold_local(self, jobs, reason="", constraint=None):
+        """job_hold_local -- condor_hold jobs.
 
-        if returncode != 0:
-            log.error("Got non-zero return code '%s' from '%s'. stderr was: %s" %
-                              (returncode, string.join(condor_out, " "), condor_err))
-            return None
-        log.debug("Out: %s, Err: %s" %(condor_out, condor_err))
-        return returncode
+        Keywords:
+            jobs       - the Jobs to hold
+            reason     - the hold reason condor records
+            constraint - a ClassAd expression matching jobs, see
+                         _condor_job_command
+        Returns the jobs that couldn't be held.
+        """
+        log.verbose("Holding Condor jobs with %s", config.condor_hold_command)
+        condor_hold = shlex.split(config.condor_hold_command)
+        if reason:
+            try:
+                ri = condor_hold.index('-reason')
+                condor_hold[ri+1] = reason
+            except ValueError:
+                condor_hold.append('-reason')
+                reason = reason.strip('\n')
+                reason = ' '.join(reason.split('\n'))
+                condor_hold.append(reason)
+        return self._condor_job_command(condor_hold, "held", jobs, constraint)
 
-    def job_release_local(self, jobs):
-        """job_query_local -- query and parse condor_q for job information."""
-        log.verbose("Releasing Condor jobs with %s" % config.condor_release_command)
-        try:
-            condor_release = shlex.split(config.condor_release_command)
-            job_ids = [str(job.cluster_id)+"."+str(job.proc_id) for job in jobs]
-            condor_release.extend(job_ids)
-            sp = subprocess.Popen(condor_release, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (_, condor_err) = sp.communicate(input=None)
-            returncode = sp.returncode
-        except:
-            log.exception("Problem running %s, unexpected error" % string.join(condor_release, " "))
-            return None
+    def job_release_local(self, jobs, constraint=None):
+        """job_release_local -- condor_release jobs.
+
+        Keywords:
+            jobs       - the Jobs to release
+            constraint - a ClassAd expression matching jobs, see
+                         _condor_job_command
+        Returns the jobs that couldn't be released.
+        """
+        log.verbose("Releasing Condor jobs with %s", config.condor_release_command)
+        condor_release = shlex.split(config.condor_release_command)
+        return self._condor_job_command(condor_release, "released", jobs, constraint)
 
-        if returncode != 0:
+    def _condor_job_command(self, command, done, jobs, constraint=None):
+        """Run the condor job command, condor_hold or condor_release, on jobs.
+
+        With a constraint, the command is run once with -constraint, which
+        condor applies to every matching job however many there are. The
+        constraint should match jobs and nothing else. Without one, or if that
+        run fails, the command is given the job ids, condor_job_batch_size to a
+        run, with up to condor_control_threads runs at once. A job counts as
+        done when condor reports "Job <id> <done>" for it.
+
+        Returns the jobs it wasn't done to.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        name = os.path.basename(command[0])
+        if constraint:
+            result = command_runner.run(command + ['-constraint', constraint], name=name)
+            if result.ok():
+                log.debug("%s %d jobs matching %s", name, len(jobs), constraint)
+                return []
+            log.warning("Problem running %s -constraint '%s': %s %s %s, trying the jobs by id" %
+                        (name, constraint, result.error or result.returncode, result.out, result.err))
+        batches = utilities.chunks(jobs, config.condor_job_batch_size)
+        failed = []
+        results = utilities.parallel_map(lambda batch: self._condor_job_batch(command, done, batch),
+                                         batches, config.condor_control_threads)
+        for (batch, batch_failed) in zip(batches, results):
+            failed.extend(batch if batch_failed is None else batch_failed)
+        if failed:
+            log.error("%s failed for %d of %d jobs: %s" % (name, len(failed), len(jobs),
+                      ", ".join(_job_id(job) for job in failed[:20])))
+        return failed
+
+    def _condor_job_batch(self, command, done, jobs):
+        """Run command on one batch of jobs by id. Returns the jobs it wasn't done to."""
+        job_ids = [_job_id(job) for job in jobs]
+        log.verbose(' '.join(command + job_ids))
+        result = command_runner.run(command + job_ids, name=os.path.basename(command[0]))
+        if result.error:
+            return jobs
+        done_ids = set(re.findall(r"^Job (\S+) (?:already )?%s" % done, result.out, re.M))
+        if not done_ids:
+            if result.returncode == 0:
+                return []
             log.error("Got non-zero return code '%s' from '%s'. stderr was: %s" %
-                              (returncode, string.join(condor_release, " "), condor_err))
-            return None
-        return returncode
+                      (result.returncode, command[0], result.err))
+        return [job for (job, job_id) in zip(jobs, job_ids) if job_id not in done_ids]
 
     def track_run_time(self, removed):
         """Keeps track of the approximate run time of jobs on each VM."""
@@ -1115,6 +1145,7 @@ class JobPool:
                 if int(job.jobstarttime) > 0:
                     if job.running_vm != None:
                         job.running_vm.job_run_times.append(int(job.servertime) - int(job.jobstarttime))
+                        job.running_vm.mark_changed()
 
     def fetch_job_failure_reasons(self):
         reasons = []
@@ -1182,12 +1213,42 @@ class JobPool:
         if jobs == []:
             log.verbose("(none)")
         for job in jobs:
-            log.verbose("\tJob: %s, %10s, %4d, %10s" % (job.id, job.user, job.priority, job.req_vmtype))
+            log.verbose("\tJob: %s, %10s, %4d, %10s", job.id, job.user, job.priority, job.req_vmtype)
 
 
 
 # utility parsing methods
 
+def _job_id(job):
+    """job's condor id, cluster.proc."""
+    return "%s.%s" % (job.cluster_id, job.proc_id)
+
+
+def classad_string(value):
+    """value as a ClassAd string literal, for constraint expressions."""
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def names_image(ami, image):
+    """Whether a job's VMAMI (a plain ami or a dict of cloud -> ami) names
+    image for any cloud."""
+    if isinstance(ami, dict):
+        return image in ami.values()
+    return ami == image
+
+
+def image_constraint(image):
+    """A ClassAd expression matching the jobs whose VMAMI names image for
+    any cloud, the same jobs names_image picks out once they are parsed."""
+    # A VMAMI entry is an ami, or cloud:ami, separated by commas
+    pattern = r"(^|[,:])\s*%s\s*(,|$)" % re.escape(image)
+    constraint = "regexp(%s, VMAMI)" % classad_string(pattern)
+    if names_image(_attr_list_to_dict(config.default_VMAMI), image):
+        # Jobs without a VMAMI of their own are given the default one
+        constraint = '(VMAMI =?= undefined || VMAMI =?= "" || %s)' % constraint
+    return constraint
+
+
 def _attr_list_to_dict(attr_list):
     """
     _attr_list_to_dict -- parse a string like: host:ami, ..., host:ami into a
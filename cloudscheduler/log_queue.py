@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## LOG QUEUE
+##
+## Writes the log from a thread of its own, so a slow disk, a full pipe on
+## stdout or a stuck syslog can't hold up the threads doing the logging.
+##
+## The logger gets a QueueHandler, which finishes the message off on the
+## logging thread (so arguments are formatted as they were when logged) and
+## puts the record on a bounded queue without waiting. A QueueWriter thread
+## takes records off in batches and hands them to the real handlers,
+## flushing each once per batch rather than once per record. When the queue
+## is full, records are dropped and counted; the writer logs how many once
+## it catches up.
+##
+
+from __future__ import with_statement
+
+import Queue
+import logging
+import threading
+
+import cloudscheduler.metrics as metrics
+
+# Most records written between flushes
+BATCH_SIZE = 500
+# Longest stop() waits for the queue to be written out, in seconds
+STOP_WAIT = 10
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on a queue for a QueueWriter instead of writing them."""
+
+    def __init__(self, size):
+        logging.Handler.__init__(self)
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Format record's message and traceback now, the writer only adds the layout."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+            metrics.log_records_dropped.inc()
+        except Exception:
+            self.handleError(record)
+
+
+class QueueWriter(threading.Thread):
+    """Writes the records a QueueHandler queued to the handlers."""
+
+    def __init__(self, log, queue_handler, handlers):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        self.log = log
+        self.queue_handler = queue_handler
+        self.handlers = list(handlers)
+        self.reported = 0
+        self.stopping = object()
+
+    def run(self):
+        queue = self.queue_handler.queue
+        while True:
+            records = [queue.get()]
+            while len(records) < BATCH_SIZE:
+                try:
+                    records.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            done = records[-1] is self.stopping
+            if done:
+                records.pop()
+            self.write(records)
+            if done:
+                return
+
+    def write(self, records):
+        dropped = self.queue_handler.dropped
+        if dropped > self.reported:
+            records.append(logging.LogRecord("cloudscheduler", logging.WARNING, __file__, 0,
+                                             "The log fell behind, %d messages were not written"
+                                             % (dropped - self.reported), None, None))
+            self.reported = dropped
+        for handler in self.handlers:
+            # The handlers flush after every record, hold that to the end of the batch
+            handler.flush = lambda: None
+            try:
+                for record in records:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                del handler.flush
+                handler.flush()
+
+    def stop(self, wait=STOP_WAIT):
+        """Write out what's queued, waiting up to wait seconds, and stop.
+
+        Records logged from then on are written straight to the handlers.
+        """
+        if not self.is_alive():
+            return
+        for handler in self.handlers:
+            self.log.addHandler(handler)
+        self.log.removeHandler(self.queue_handler)
+        try:
+            self.queue_handler.queue.put(self.stopping, timeout=wait)
+        except Queue.Full:
+            return
+        self.join(wait)
+
+
+def start(log, handlers, size):
+    """Have log's records written to handlers by a new QueueWriter.
+
+    Keywords:
+        log      - the logger
+        handlers - the handlers to write to, not added to log themselves
+        size     - records that can wait to be written
+    Returns the started QueueWriter.
+    """
+    queue_handler = QueueHandler(size)
+    writer = QueueWriter(log, queue_handler, handlers)
+    writer.start()
+    log.addHandler(queue_handler)
+    return writer
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## METRICS
+##
+## Counters, gauges and histograms for info_server's /metrics, written in the
+## Prometheus text exposition format so they can be scraped and alerted on.
+##
+## The metrics Cloud Scheduler keeps are defined at the bottom of this
+## module; code records to them directly, e.g.
+##   metrics.condor_query_seconds.observe(elapsed, command="condor_q")
+## Each metric takes a lock only for the update itself. Gauges describing
+## the pools are filled in by info_server when /metrics is read.
+##
+
+from __future__ import with_statement
+
+import bisect
+import threading
+
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# Seconds, for the timing histograms
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Per cycle counts
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for (name, value) in pairs)
+    return "{%s}" % ",".join(escaped)
+
+
+class Metric:
+    """A named metric with one value per combination of label values."""
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        """Constructor.
+
+        Keywords:
+            name   - the metric name, cloudscheduler_ prefixed
+            help   - one line description for the HELP comment
+            labels - names of the labels every update must give
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        """The values of the given labels in order. Raises KeyError for a missing one."""
+        if len(labels) != len(self.labels):
+            raise KeyError("%s takes the labels %s, not %s" % (self.name, self.labels, labels.keys()))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self):
+        """The metric's lines in the text exposition format."""
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        with self.lock:
+            values = sorted(self.values.items())
+        for (key, value) in values:
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return ["%s%s %s" % (self.name, format_labels(self.labels, key), format_value(value))]
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, values):
+        """Replace every value with values, a dict of label value tuples -> value.
+
+        For gauges collected all at once, where label combinations come and go.
+        """
+        values = dict((tuple(str(label) for label in key), value) for (key, value) in values.iteritems())
+        with self.lock:
+            self.values = values
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels))
+
+
+class Histogram(Metric):
+    """Observations counted into buckets, with their count and sum."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # A count per bucket and one past the last, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, **labels):
+        counts = self.values.get(self.key(labels))
+        if counts is None:
+            return 0
+        return sum(counts[:-1])
+
+    def render_value(self, key, counts):
+        lines = []
+        total = 0
+        for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labels, key, ('le', format_value(bound))), total))
+        labels = format_labels(self.labels, key)
+        lines.append("%s_sum%s %s" % (self.name, labels, format_value(counts[-1])))
+        lines.append("%s_count%s %d" % (self.name, labels, total))
+        return lines
+
+
+class Registry:
+    """The metrics to expose, in the order they were added."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Every metric in the text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# Threads
+thread_loop_seconds = registry.histogram("cloudscheduler_thread_loop_seconds",
+        "Time taken by a cycle of each scheduler thread", ('thread',))
+thread_heart_beat_age_seconds = registry.gauge("cloudscheduler_thread_heart_beat_age_seconds",
+        "Time since each scheduler thread last finished a cycle", ('thread',))
+thread_stalled = registry.gauge("cloudscheduler_thread_stalled",
+        "1 while the watchdog finds a scheduler thread stalled", ('thread',))
+thread_stalls = registry.counter("cloudscheduler_thread_stalls_total",
+        "Times the watchdog found each scheduler thread stalled", ('thread',))
+thread_restarts = registry.counter("cloudscheduler_thread_restarts_total",
+        "Stalled scheduler threads the watchdog replaced", ('thread',))
+
+# Logging
+log_records_dropped = registry.counter("cloudscheduler_log_records_dropped_total",
+        "Log messages dropped because the log queue was full")
+
+# Commands
+command_seconds = registry.histogram("cloudscheduler_command_seconds",
+        "Time taken by the commands Cloud Scheduler runs", ('command',))
+command_failures = registry.counter("cloudscheduler_command_failures_total",
+        "Commands that couldn't start, timed out, wrote too much or exited non-zero",
+        ('command', 'reason'))
+
+# VM user data
+content_cache_reads = registry.counter("cloudscheduler_content_cache_reads_total",
+        "Reads of user data files and URLs, by whether they were cached", ('result',))
+user_data_renders = registry.counter("cloudscheduler_user_data_renders_total",
+        "User data MIME messages built, by whether one was already built", ('result',))
+
+# Condor
+condor_query_seconds = registry.histogram("cloudscheduler_condor_query_seconds",
+        "Time taken to run condor_q and condor_status", ('command',))
+condor_query_bytes = registry.gauge("cloudscheduler_condor_query_bytes",
+        "Size of the last condor_q and condor_status output", ('command',))
+condor_query_errors = registry.counter("cloudscheduler_condor_query_errors_total",
+        "condor_q and condor_status runs that failed", ('command',))
+condor_parse_seconds = registry.histogram("cloudscheduler_condor_parse_seconds",
+        "Time taken to parse condor_q and condor_status output", ('command',))
+
+# Clouds
+cloud_api_seconds = registry.histogram("cloudscheduler_cloud_api_seconds",
+        "Time taken by cloud API calls", ('cloud', 'operation'))
+cloud_api_errors = registry.counter("cloudscheduler_cloud_api_errors_total",
+        "Cloud API calls that raised or returned an error", ('cloud', 'operation'))
+
+# Scheduling
+scheduling_decisions = registry.counter("cloudscheduler_scheduling_decisions_total",
+        "Attempts to start a VM for a job, by outcome", ('outcome',))
+scheduler_cycle_decisions = registry.histogram("cloudscheduler_scheduler_cycle_decisions",
+        "Attempts to start a VM for a job in each scheduler cycle", buckets=COUNT_BUCKETS)
+destroy_queue_depth = registry.gauge("cloudscheduler_destroy_queue_depth",
+        "VM destroys started by each thread and not yet finished", ('thread',))
+
+# Pools, collected when the metrics are read
+vms = registry.gauge("cloudscheduler_vms", "VMs by cloud and status", ('cloud', 'status'))
+jobs = registry.gauge("cloudscheduler_jobs", "Jobs by scheduling state", ('state',))
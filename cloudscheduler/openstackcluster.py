@@ -16,6 +16,7 @@ import gzip
 
 log = utilities.get_cloudscheduler_logger()
 
+@cluster_tools.timed_cloud_api
 class OpenStackCluster(cluster_tools.ICluster):
     ERROR = 1
     DEFAULT_INSTANCE_TYPE = config.default_VMInstanceType if config.default_VMInstanceType else "m1.small"
@@ -30,6 +31,8 @@ class OpenStackCluster(cluster_tools.ICluster):
             "ERROR" : "Error",
             "VERIFY_RESIZE": "Error",
     }
+    # Most pages of servers vm_list_states reads before giving up
+    LIST_MAX_PAGES = 100
     def __init__(self, name="Dummy Cluster", cloud_type="Dummy",
                  memory=[], max_vm_mem= -1, networks=[], vm_slots=0,
                  cpu_cores=0, storage=0, security_group=None,
@@ -343,6 +346,30 @@ class OpenStackCluster(cluster_tools.ICluster):
                 vm.status = self.VM_STATES['ERROR']
         return vm.status
 
+    def vm_list_states(self):
+        """ List the status of every server in the tenant, a page at a time.
+
+        Nova caps each page at its osapi_max_limit, so the pages are followed
+        by marker until one comes back empty. Returns None if that takes more
+        than LIST_MAX_PAGES pages, as a partial list can't tell a VM that's
+        gone from one on a page that wasn't read.
+        """
+        nova = self._get_creds_nova_updated()
+        if not nova:
+            return None
+        states = {}
+        marker = None
+        for page in range(self.LIST_MAX_PAGES):
+            instances = nova.servers.list(marker=marker)
+            if not instances:
+                return states
+            for instance in instances:
+                states[instance.id] = self.VM_STATES.get(instance.status, instance.status)
+            marker = instances[-1].id
+        log.warning("Stopped listing the servers on %s after %d pages, polling its VMs one at a time" %
+                    (self.name, self.LIST_MAX_PAGES))
+        return None
+
     def _get_creds_nova(self):
         """Get an auth token to Nova."""
         try:
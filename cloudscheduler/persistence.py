@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## PERSISTENCE JOURNAL
+##
+## Keeps the persistence file current without pickling every cluster and VM
+## each scheduler cycle.
+##
+## The persistence file is a snapshot: the pickled [resources,
+## retired_resources, generation] list, where generation is a new id for
+## each snapshot. Next to it is an append-only journal
+## (<persistence_file>.journal) of the changes made since the snapshot was
+## taken, starting with a header naming the snapshot it belongs to:
+##   ('generation', None, generation)
+##   ('vm', key, vm)          - a VM was added or one of its attributes changed
+##   ('remove', key, vm_id)   - a VM left the cluster
+##   ('cluster', key, attrs)  - a cluster's enabled flag (or Azure count) changed
+## where key is ('resources' or 'retired', cluster name).
+##
+## VMs flag their own changes (VM.state_changed), so a save only looks at
+## cluster membership and the flags and writes nothing if nothing happened.
+## Once the journal grows past config.persistence_compact_records, or the
+## set of clusters changes, a new snapshot is written to a temporary file,
+## synced and renamed over the old one, and the journal is emptied. A crash
+## can leave a truncated last journal record, which is skipped when the
+## journal is replayed, or the previous snapshot's journal next to a new
+## snapshot, which is skipped whole as its generation doesn't match.
+##
+
+from __future__ import with_statement
+
+import os
+import uuid
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# Cluster attributes that are carried over from the persistence file on restart
+PERSISTED_CLUSTER_ATTRIBUTES = ('enabled', 'count')
+
+
+def cluster_keys(resources, retired_resources):
+    """Yield (key, cluster) for every cluster in the two lists."""
+    for cluster in resources:
+        yield (('resources', cluster.name), cluster)
+    for cluster in retired_resources:
+        yield (('retired', cluster.name), cluster)
+
+
+def cluster_attributes(cluster):
+    """The persisted attributes of cluster as a dict."""
+    return dict((name, getattr(cluster, name)) for name in PERSISTED_CLUSTER_ATTRIBUTES
+                if hasattr(cluster, name))
+
+
+def sync_directory(path):
+    """fsync the directory holding path so a rename in it is durable."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    os.close(fd)
+
+
+class PersistenceJournal:
+    """Writes the persistence snapshot and journal for a ResourcePool."""
+
+    def __init__(self, path=None, compact_records=None):
+        """Constructor.
+
+        Keywords:
+            path            - the snapshot file, defaults to config.persistence_file
+            compact_records - journal records to allow before writing a new snapshot,
+                              defaults to config.persistence_compact_records
+        """
+        self.path = path
+        self.compact_records = compact_records
+        # Journal records written since the last snapshot
+        self.records = 0
+        # What the snapshot plus journal hold, to diff the live state against
+        self.saved_vms = {}
+        self.saved_clusters = {}
+        # Identity of the cluster objects in the last snapshot, None to force one
+        self.layout = None
+        # Generation of the last snapshot, and whether the journal still needs its header
+        self.generation = None
+        self.header_pending = False
+
+    def snapshot_path(self):
+        if self.path:
+            return self.path
+        return config.persistence_file
+
+    def journal_path(self):
+        return self.snapshot_path() + ".journal"
+
+    def save(self, resources, retired_resources, compact=False):
+        """Bring the persistence file up to date with the given clusters.
+
+        Writes a new snapshot if compact is set, the clusters have changed or
+        the journal is full, otherwise appends only the changes since the
+        last save. Returns the number of records written (0 if nothing changed).
+        Raises IOError or OSError if the files can't be written.
+        """
+        layout = [(key, id(cluster)) for (key, cluster) in cluster_keys(resources, retired_resources)]
+        if compact or layout != self.layout:
+            return self.write_snapshot(resources, retired_resources, layout)
+
+        records = self.changes(resources, retired_resources)
+        if not records:
+            return 0
+        limit = self.compact_records
+        if limit is None:
+            limit = config.persistence_compact_records
+        if self.records + len(records) > limit:
+            return self.write_snapshot(resources, retired_resources, layout)
+        try:
+            self.append(records)
+        except:
+            # The diff state no longer matches the files, start over next time
+            self.layout = None
+            raise
+        return len(records)
+
+    def changes(self, resources, retired_resources):
+        """Journal records for everything that changed since the last save."""
+        records = []
+        for (key, cluster) in cluster_keys(resources, retired_resources):
+            attributes = cluster_attributes(cluster)
+            if attributes != self.saved_clusters.get(key):
+                records.append(('cluster', key, attributes))
+                self.saved_clusters[key] = attributes
+
+            saved = self.saved_vms.get(key, set())
+            current = set()
+            for vm in list(cluster.vms):
+                current.add(vm.id)
+                if vm.state_changed or vm.id not in saved:
+                    # Clear first so a change made while pickling isn't lost
+                    vm.state_changed = False
+                    records.append(('vm', key, vm))
+            for vm_id in saved - current:
+                records.append(('remove', key, vm_id))
+            self.saved_vms[key] = current
+        return records
+
+    def append(self, records):
+        """Write records after the last snapshot."""
+        self.write_records(records)
+        self.records += len(records)
+
+    def write_records(self, records):
+        """Append records to the journal and sync it."""
+        if self.header_pending:
+            records = [('generation', None, self.generation)] + list(records)
+        data = "".join(pickle.dumps(record, pickle.HIGHEST_PROTOCOL) for record in records)
+        journal = open(self.journal_path(), "ab")
+        try:
+            journal.write(data)
+            journal.flush()
+            os.fsync(journal.fileno())
+        finally:
+            journal.close()
+        self.header_pending = False
+
+    def write_snapshot(self, resources, retired_resources, layout=None):
+        """Atomically replace the snapshot and empty the journal."""
+        saved_vms = {}
+        saved_clusters = {}
+        for (key, cluster) in cluster_keys(resources, retired_resources):
+            saved_clusters[key] = cluster_attributes(cluster)
+            saved_vms[key] = set()
+            for vm in list(cluster.vms):
+                vm.state_changed = False
+                saved_vms[key].add(vm.id)
+
+        # Nothing may be journaled against the files until the snapshot is in place
+        self.layout = None
+        self.write_snapshot_file(resources, retired_resources)
+
+        if layout is None:
+            layout = [(key, id(cluster)) for (key, cluster) in cluster_keys(resources, retired_resources)]
+        self.layout = layout
+        self.saved_vms = saved_vms
+        self.saved_clusters = saved_clusters
+        self.records = 0
+        return sum(len(vms) for vms in saved_vms.itervalues()) + len(saved_clusters)
+
+    def write_snapshot_file(self, resources, retired_resources):
+        """Replace the snapshot through a synced temporary file and drop the journal."""
+        path = self.snapshot_path()
+        temp_path = path + ".tmp"
+        generation = uuid.uuid4().hex
+        snapshot = open(temp_path, "wb")
+        try:
+            pickle.dump([resources, retired_resources, generation], snapshot, pickle.HIGHEST_PROTOCOL)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        finally:
+            snapshot.close()
+        os.rename(temp_path, path)
+        sync_directory(path)
+        # The old journal only holds changes up to the last snapshot, so
+        # replaying it over this one would bring back stale VMs; if a crash
+        # leaves it behind, its header no longer matches and replay skips it
+        if os.path.exists(self.journal_path()):
+            os.remove(self.journal_path())
+        self.generation = generation
+        self.header_pending = True
+
+    def replay(self, resources, retired_resources, generation=None):
+        """Apply the journal to the clusters loaded from the snapshot.
+
+        generation is the snapshot's, None for one written before snapshots
+        had them. A journal from another generation is not applied. Returns
+        the number of records applied. A damaged record ends the replay,
+        everything before it is kept.
+        """
+        try:
+            journal = open(self.journal_path(), "rb")
+        except IOError:
+            return 0
+
+        clusters = dict(cluster_keys(resources, retired_resources))
+        applied = 0
+        first = True
+        try:
+            while True:
+                try:
+                    (kind, key, value) = pickle.load(journal)
+                except EOFError:
+                    break
+                except Exception, e:
+                    log.warning("Stopped replaying persistence journal %s at a damaged record: %s" %
+                                (self.journal_path(), e))
+                    break
+                if first:
+                    first = False
+                    journal_generation = None
+                    if kind == 'generation':
+                        journal_generation = value
+                    if journal_generation != generation:
+                        log.warning("Skipping persistence journal %s, it belongs to an older snapshot" %
+                                    self.journal_path())
+                        break
+                    if kind == 'generation':
+                        continue
+                cluster = clusters.get(key)
+                if cluster is None:
+                    log.debug("Persistence journal refers to unknown cluster %s" % (key,))
+                    continue
+                if kind == 'cluster':
+                    for (name, attribute) in value.iteritems():
+                        setattr(cluster, name, attribute)
+                elif kind == 'vm':
+                    cluster.vms = [vm for vm in cluster.vms if vm.id != value.id]
+                    cluster.vms.append(value)
+                elif kind == 'remove':
+                    cluster.vms = [vm for vm in cluster.vms if vm.id != value]
+                applied += 1
+        finally:
+            journal.close()
+        log.verbose("Replayed %d persistence journal records" % applied)
+        return applied
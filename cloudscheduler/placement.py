@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## BATCH PLACEMENT
+##
+## Places all of a scheduling cycle's VM requests onto clusters in one pass
+## instead of booting one job at a time on the first cloud that fits.
+##
+## The solver is a greedy bin packer with a one step lookahead:
+##   - requests are served most under-allocated (lowest fair share diff)
+##     first, and among equal diffs the request with the fewest fitting
+##     clouds goes first,
+##   - each request takes the best ordered (priority, fill ratio) cluster
+##     that still has room, but avoids a cluster if taking it would leave
+##     too little slots, memory or storage for pending requests that have
+##     nowhere else to go,
+##   - per user VM allowances and the cycle's boot budget are respected.
+##
+
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+class PlacementRequest:
+    """A single VM wanted for a job this scheduling cycle."""
+
+    def __init__(self, user, job, candidates, share_diff):
+        """Constructor.
+
+        Keywords:
+            user       - owner of the job
+            job        - the Job to boot a VM for
+            candidates - fitting clusters, best first (as from get_resourceBF)
+            share_diff - the uservmtype's fair share diff (negative is under allocated)
+        """
+        self.user = user
+        self.job = job
+        self.candidates = candidates
+        self.share_diff = share_diff
+        self.memory = job.req_memory
+        self.storage = job.req_storage
+
+
+class ClusterCapacity:
+    """Free capacity of a cluster, minus what has been reserved this cycle."""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.slots = cluster.vm_slots
+        self.memory = cluster.memory
+        self.storage = cluster.storageGB
+        # Demand from pending requests that can only go to this cluster
+        self.sole_slots = 0
+        self.sole_memory = 0
+        self.sole_storage = 0
+
+    def fits(self, request):
+        """True if the request fits in what is left of the cluster."""
+        return self.slots > 0 and request.memory <= self.memory and request.storage <= self.storage
+
+    def leaves_room(self, request):
+        """True if taking the request still leaves room for the sole-option demand."""
+        return self.slots - 1 >= self.sole_slots and \
+               self.memory - request.memory >= self.sole_memory and \
+               self.storage - request.storage >= self.sole_storage
+
+    def reserve(self, request):
+        self.slots -= 1
+        self.memory -= request.memory
+        self.storage -= request.storage
+
+
+def solve(requests, max_vms=-1, user_allowance=None):
+    """Assign each request a cluster.
+
+    Keywords:
+        requests       - list of PlacementRequest
+        max_vms        - maximum number of VMs to place, -1 for no limit
+        user_allowance - (dict) user -> number of VMs the user may still start
+    Returns a list of (request, clusters) tuples in boot order. clusters is
+    the request's candidate list with the chosen cluster moved to the front,
+    so the remaining clouds can still be tried if the boot fails.
+    """
+    if user_allowance is None:
+        user_allowance = {}
+    allowance = dict(user_allowance)
+    capacity = {}
+    def capacity_for(cluster):
+        if cluster.name not in capacity:
+            capacity[cluster.name] = ClusterCapacity(cluster)
+        return capacity[cluster.name]
+
+    ordered = sorted(requests, key=lambda request: (request.share_diff, len(request.candidates)))
+    for request in ordered:
+        if len(request.candidates) == 1:
+            cap = capacity_for(request.candidates[0])
+            cap.sole_slots += 1
+            cap.sole_memory += request.memory
+            cap.sole_storage += request.storage
+
+    placements = []
+    unplaced = 0
+    for request in ordered:
+        if len(request.candidates) == 1:
+            cap = capacity_for(request.candidates[0])
+            cap.sole_slots -= 1
+            cap.sole_memory -= request.memory
+            cap.sole_storage -= request.storage
+        if max_vms >= 0 and len(placements) >= max_vms:
+            break
+        if request.user in allowance and allowance[request.user] <= 0:
+            continue
+
+        choice = None
+        fallback = None
+        for cluster in request.candidates:
+            cap = capacity_for(cluster)
+            if not cap.fits(request):
+                continue
+            if fallback is None:
+                fallback = cap
+            if cap.leaves_room(request):
+                choice = cap
+                break
+        if choice is None:
+            choice = fallback
+        if choice is None:
+            unplaced += 1
+            continue
+
+        choice.reserve(request)
+        if request.user in allowance:
+            allowance[request.user] -= 1
+        clusters = [choice.cluster] + [cluster for cluster in request.candidates if cluster is not choice.cluster]
+        placements.append((request, clusters))
+
+    log.verbose("Batch placement: %d of %d VM requests placed, %d without capacity" %
+                (len(placements), len(requests), unplaced))
+    return placements
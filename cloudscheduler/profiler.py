@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## PROFILER
+##
+## Looking inside the running daemon, for admin_server:
+##   format_stacks  - where every thread is right now, from sys._current_frames()
+##   sample_stacks  - a named thread's stack, sampled every SAMPLE_INTERVAL
+##                    seconds for a while and counted in the collapsed stack
+##                    format flamegraph.pl and speedscope read. It works on a
+##                    thread that is stuck, and costs the thread nothing.
+##   profile_cycles - the cycles a named thread runs over the next while,
+##                    run under cProfile for pstats output. Only threads whose
+##                    run_cycle is decorated with @profiled can be profiled
+##                    this way, and a cycle that doesn't end isn't seen.
+##
+## Only one capture runs at a time.
+##
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import traceback
+
+from cStringIO import StringIO
+
+import cloudscheduler.tracing as tracing
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# Seconds between samples of a thread's stack
+SAMPLE_INTERVAL = 0.01
+# Longest capture allowed, in seconds
+CAPTURE_SECONDS_MAX = 300
+# How long a cProfile capture waits past its end for a profiled cycle to finish
+CYCLE_FINISH_WAIT = 60
+
+capture_lock = threading.Lock()
+
+
+class CaptureBusy(Exception):
+    """Another capture is running."""
+    pass
+
+
+def find_thread(name):
+    """The live threading.Thread called name, or None."""
+    for thread in threading.enumerate():
+        if thread.name == name:
+            return thread
+    return None
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+
+def collapse(frame):
+    """frame's stack, outermost first, as one line of the collapsed stack format."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+def thread_stack(thread, frame=None):
+    """thread's current stack, with what it is doing if it is a scheduler thread."""
+    if frame is None:
+        frame = sys._current_frames().get(thread.ident)
+    output = ["Thread %s%s:\n" % (thread.name, " (daemon)" if thread.daemon else "")]
+    heart_beat = getattr(thread, 'heart_beat', None)
+    if heart_beat:
+        output.append("  Last heart beat %.1fs ago\n" % (time.time() - heart_beat))
+    trace = tracing.traces.running(thread)
+    if trace is not None:
+        output.append("  In %s for %.1fs: %s\n" % (trace.name, time.time() - trace.start,
+                                                  " > ".join(trace.current()) or "-"))
+    if frame is None:
+        output.append("  No stack, the thread isn't running\n")
+    else:
+        output.extend(traceback.format_stack(frame))
+    return ''.join(output)
+
+
+def format_stacks():
+    """Every thread's current stack, by thread name."""
+    frames = sys._current_frames()
+    threads = sorted(threading.enumerate(), key=lambda thread: thread.name)
+    return "\n".join(thread_stack(thread, frames.get(thread.ident)) for thread in threads)
+
+
+def sample_stacks(thread, seconds, interval=SAMPLE_INTERVAL):
+    """Sample thread's stack every interval for seconds.
+
+    Returns a dict of collapsed stack -> samples. Raises CaptureBusy if
+    another capture is running.
+    """
+    if not capture_lock.acquire(False):
+        raise CaptureBusy()
+    try:
+        stacks = {}
+        deadline = time.time() + min(seconds, CAPTURE_SECONDS_MAX)
+        while time.time() < deadline and thread.is_alive():
+            frame = sys._current_frames().get(thread.ident)
+            if frame is not None:
+                stack = collapse(frame)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            del frame
+            time.sleep(interval)
+        return stacks
+    finally:
+        capture_lock.release()
+
+
+def format_collapsed(stacks):
+    """stacks from sample_stacks, one "frame;frame;frame count" line each, most sampled first."""
+    return ''.join("%s %d\n" % (stack, count) for (stack, count)
+                   in sorted(stacks.iteritems(), key=lambda item: (-item[1], item[0])))
+
+
+class CycleProfile:
+    """A cProfile capture of the cycles of one thread."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.condition = threading.Condition(threading.Lock())
+        self.open = True
+        self.running = False
+        self.cycles = 0
+
+# Thread name -> the CycleProfile its cycles are being profiled into
+cycle_profiles = {}
+
+
+def profiled(method):
+    """Decorator running a thread's cycle method under cProfile while profile_cycles asks for it."""
+    @functools.wraps(method)
+    def profiled_cycle(self, *args, **kwargs):
+        capture = cycle_profiles.get(self.name)
+        if capture is None:
+            return method(self, *args, **kwargs)
+        with capture.condition:
+            if not capture.open:
+                capture = None
+            else:
+                capture.running = True
+                capture.cycles += 1
+        if capture is None:
+            return method(self, *args, **kwargs)
+        try:
+            return capture.profile.runcall(method, self, *args, **kwargs)
+        finally:
+            with capture.condition:
+                capture.running = False
+                capture.condition.notify_all()
+    return profiled_cycle
+
+
+def profile_cycles(thread, seconds, sort='cumulative', limit=50):
+    """Profile the cycles thread starts in the next seconds.
+
+    Returns pstats output sorted by sort, limited to limit functions. Raises
+    CaptureBusy if another capture is running.
+    """
+    if not capture_lock.acquire(False):
+        raise CaptureBusy()
+    try:
+        capture = cycle_profiles[thread.name] = CycleProfile()
+        try:
+            time.sleep(min(seconds, CAPTURE_SECONDS_MAX))
+            with capture.condition:
+                capture.open = False
+                deadline = time.time() + CYCLE_FINISH_WAIT
+                while capture.running and time.time() < deadline:
+                    capture.condition.wait(deadline - time.time())
+                if capture.running:
+                    return ("A %s cycle has been running for over %ds since the capture ended, "
+                            "sample its stack instead.\n" % (thread.name, CYCLE_FINISH_WAIT))
+        finally:
+            del cycle_profiles[thread.name]
+        if not capture.cycles:
+            return "%s didn't start a cycle in %ss.\n" % (thread.name, seconds)
+        output = StringIO()
+        output.write("%d %s cycles profiled\n" % (capture.cycles, thread.name))
+        stats = pstats.Stats(capture.profile, stream=output)
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+    finally:
+        capture_lock.release()
@@ -3,12 +3,13 @@ import threading
 import time
 import traceback
 import datetime
-import subprocess
 import tempfile
 import shutil
 import shlex
 
 import cloudscheduler.config as config
+import cloudscheduler.command_runner as command_runner
+import cloudscheduler.events as events
 import cloudscheduler.utilities as utilities
 import cloudscheduler.job_management as job_management
 import cloudscheduler.cloud_management as cloud_management
@@ -18,6 +19,75 @@ from job_management import Job
 
 log = utilities.get_cloudscheduler_logger()
 
+
+def group_by_proxy(items, proxy_file):
+    """items with a proxy as (path, items sharing it) pairs, in the order the paths first come up.
+
+    Keywords:
+        items      - jobs or VMs
+        proxy_file - function giving the path of an item's proxy file, or None
+    """
+    groups = {}
+    paths = []
+    for item in items:
+        item_path = proxy_file(item)
+        if item_path is None:
+            continue
+        if item_path not in groups:
+            groups[item_path] = []
+            paths.append(item_path)
+        groups[item_path].append(item)
+    return [(path, groups[path]) for path in paths]
+
+
+def refresh_proxies(items, proxy_file, kind):
+    """Renew the proxies of items that are about to expire.
+
+    Each proxy file is checked and renewed once however many items share it,
+    and config.proxy_refresh_threads are renewed at once.
+
+    Keywords:
+        items      - jobs or VMs
+        proxy_file - function giving the path of an item's proxy file, or None
+        kind       - "job" or "VM", for the log
+    Returns the number of proxy files renewed.
+    """
+    renewals = []
+    for (path, group) in group_by_proxy(items, proxy_file):
+        item = group[0]
+        certextime = item.get_x509userproxy_expiry_time()
+        if certextime:
+            log.verbose("Proxy %s for %d %ss expires in %s" % (path, len(group), kind, certextime - datetime.datetime.utcnow()))
+        if item.is_proxy_expired():
+            log.warning("Proxy %s for %s %s is expired.  Skipping proxy renewal for it." % (path, kind, ", ".join(str(member.id) for member in group)))
+        elif item.needs_proxy_renewal():
+            creds = [member for member in group if member.get_myproxy_creds_name() != None]
+            if creds:
+                renewals.append((path, creds[0], group))
+            else:
+                # If we get here, this means that the proxy should be renewed, but there
+                # is no MyProxy info for it.  Not an error; just that the owner didn't
+                # give any MyProxy information to renew the credentials.
+                log.debug("Not renewing proxy %s because missing MyProxy info." % (path))
+        else:
+            log.verbose("No need to renew proxy %s" % (path))
+
+    def renew(renewal):
+        (path, item, group) = renewal
+        log.verbose("Renewing proxy %s for %d %ss" % (path, len(group), kind))
+        if not MyProxyProxyRefresher().renew_proxy(path, item.get_myproxy_creds_name(), item.get_myproxy_server(), item.get_myproxy_server_port(), item.get_renew_time()):
+            log.error("Error renewing proxy %s for %s %s" % (path, kind, ", ".join(str(member.id) for member in group)))
+            return False
+        # Yay, proxy renewal worked! :-)
+        log.verbose("Proxy %s renewed." % (path))
+        # Don't forget to reset the proxy expiry time cache of everything using it.
+        for member in group:
+            member.reset_x509userproxy_expiry_time()
+        return True
+
+    results = utilities.parallel_map(renew, renewals, config.proxy_refresh_threads)
+    return len([result for result in results if result])
+
 class JobProxyRefresher(threading.Thread):
     """
     JobProxyRefresher - Periodically checks the expiry time on job user proxies and attempt
@@ -45,31 +115,8 @@ class JobProxyRefresher(threading.Thread):
                 cycle_start_ts = datetime.datetime.today()
 
                 jobs = self.job_pool.job_container.get_all_jobs()
-                log.verbose("Refreshing job user proxies. [%d proxies to process]" % (len(jobs)))
-                for job in jobs:
-                    jobcertextime = job.get_x509userproxy_expiry_time()
-                    if jobcertextime:
-                        log.verbose("Proxy for job %s expires in %s" % (job.id, jobcertextime - datetime.datetime.utcnow()))
-                    if job.is_proxy_expired():
-                        log.warning("Proxy for job %s is expired.  Skipping proxy renewal for this job." % (job.id))
-                    elif job.needs_proxy_renewal():
-                        if job.get_myproxy_creds_name() != None:
-                            log.verbose("Renewing proxy %s for job %s" % (job.get_x509userproxy(), job.id))
-                            if MyProxyProxyRefresher().renew_proxy(job.get_x509userproxy(), job.get_myproxy_creds_name(), job.get_myproxy_server(), job.get_myproxy_server_port(), job.get_renew_time()):
-                                # Yay, proxy renewal worked! :-)
-                                log.verbose("Proxy for job %s renewed." % (job.id))
-                                # Don't forget to reset the proxy expiry time cache.
-                                job.reset_x509userproxy_expiry_time()
-                            else:
-                                log.error("Error renewing proxy for job %s" % (job.id))
-                        else:
-                            # If we get here, this means that the proxy should be renewed, but there
-                            # is not MyProxy info for that job's proxy.  Not an error; just that the
-                            # owner of the job didn't give any MyProxy information to renew the
-                            # credentials.
-                            log.debug("Not renewing proxy for job %s because missing MyProxy info." % (job.id))
-                    else:
-                        log.verbose("No need to renew proxy for job %s" % (job.id))
+                log.verbose("Refreshing job user proxies. [%d jobs to process]" % (len(jobs)))
+                refresh_proxies(jobs, lambda job: job.get_x509userproxy(), "job")
 
                 # Lets record the current time and then log how much time the cycle took.
                 cycle_end_ts = datetime.datetime.today()
@@ -77,7 +124,7 @@ class JobProxyRefresher(threading.Thread):
 
                 log.verbose("JobProxyRefresher waiting %ds..." % self.polling_interval)
                 sleep_tics = self.polling_interval
-                self.heart_beat = time.time()
+                events.heart_beat(self)
                 while (not self.quit) and sleep_tics > 0:
                     time.sleep(1)
                     sleep_tics -= 1
@@ -114,31 +161,8 @@ class VMProxyRefresher(threading.Thread):
                 cycle_start_ts = datetime.datetime.today()
 
                 vms = self.cloud_resources.get_all_vms()
-                log.verbose("Refreshing VM proxies. [%d proxies to process]" % (len(vms)))
-                for vm in vms:
-                    vmcertextime = vm.get_x509userproxy_expiry_time()
-                    if vmcertextime:
-                        log.verbose("Proxy for VM %s expires in %s" % (vm.id, vmcertextime - datetime.datetime.utcnow()))
-                    if vm.is_proxy_expired():
-                        log.warning("Proxy for VM %s is expired.  Skipping proxy renewal for this VM." % (vm.id))
-                    elif vm.needs_proxy_renewal():
-                        if vm.get_myproxy_creds_name() != None:
-                            log.debug("Renewing proxy %s for VM %s" % (vm.get_proxy_file(), vm.id))
-                            if MyProxyProxyRefresher().renew_proxy(vm.get_proxy_file(), vm.get_myproxy_creds_name(), vm.get_myproxy_server(), vm.get_myproxy_server_port(), vm.get_renew_time()):
-                                # Yay, proxy renewal worked! :-)
-                                log.verbose("Proxy for VM %s renewed." % (vm.id))
-                                # Don't forget to reset the proxy expiry time cache.
-                                vm.reset_x509userproxy_expiry_time()
-                            else:
-                                log.error("Error renewing proxy for VM %s" % (vm.id))
-                        else:
-                            # If we get here, this means that the proxy should be renewed, but there
-                            # is no MyProxy info for that vm's proxy.  Not an error; just that the
-                            # owner of the vm didn't give any MyProxy information to renew the
-                            # credentials.
-                            log.debug("Not renewing proxy for VM %s because missing MyProxy info." % (vm.id))
-                    else:
-                        log.verbose("No need to renew proxy for VM %s" % (vm.id))
+                log.verbose("Refreshing VM proxies. [%d VMs to process]" % (len(vms)))
+                refresh_proxies(vms, lambda vm: vm.get_proxy_file(), "VM")
 
                 # Lets record the current time and then log how much time the cycle took.
                 cycle_end_ts = datetime.datetime.today()
@@ -146,7 +170,7 @@ class VMProxyRefresher(threading.Thread):
 
                 log.verbose("VMProxyRefresher waiting %ds..." % self.polling_interval)
                 sleep_tics = self.polling_interval
-                self.heart_beat = time.time()
+                events.heart_beat(self)
                 while (not self.quit) and sleep_tics > 0:
                     time.sleep(1)
                     sleep_tics -= 1
@@ -205,10 +229,9 @@ class MyProxyProxyRefresher():
             myproxy_logon_cmd = '%s -s %s -p %s -k "%s" -a %s -o %s -t %s -d -v' % (myproxy_command, myproxy_server, myproxy_server_port, myproxy_creds_name, proxy_file_path, new_proxy_file_path, renew_time)
             cmd_args = shlex.split(myproxy_logon_cmd)
             log.verbose('Invoking myproxy-logon command to refresh proxy %s ...' % (proxy_file_path))
-            myproxy_logon_process = subprocess.Popen(cmd_args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (stdout, stderr) = myproxy_logon_process.communicate()
-            if myproxy_logon_process.returncode != 0:
-                log.error("Error renewing proxy from MyProxy server: %s %s" % (stdout, stderr))
+            result = command_runner.run(cmd_args, name="myproxy-logon")
+            if not result.ok():
+                log.error("Error renewing proxy from MyProxy server: %s %s %s" % (result.error or "", result.out, result.err))
                 os.remove(new_proxy_file_path)
                 return False
             else:
@@ -0,0 +1,828 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## SIMULATOR
+##
+## Discrete-event simulation of a Cloud Scheduler deployment. The real
+## Scheduler, Cleanup and poller cycles from the cloud_scheduler daemon are
+## driven in simulated time against:
+##   - DummyCluster clouds with configurable boot latency, failure rates and
+##     quotas,
+##   - a fake Condor pool that replays a job arrival trace, matches idle jobs
+##     to registered VMs and answers condor_q, condor_status, condor_off,
+##     condor_hold and condor_release.
+##
+## Nothing sleeps: time.time is replaced by the simulation clock while a run
+## is in progress and the clock jumps from one event to the next. The report
+## covers job wait times, VM churn, cloud utilisation and the CPU cost of
+## each daemon cycle.
+##
+
+import os
+import sys
+import imp
+import time
+import json
+import heapq
+import random
+import logging
+import resource
+import tempfile
+from collections import defaultdict, deque
+from optparse import OptionParser
+from distutils.spawn import find_executable
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+import cloudscheduler.cluster_tools as cluster_tools
+import cloudscheduler.job_management as job_management
+from cloudscheduler.cloud_management import ResourcePool
+
+log = utilities.get_cloudscheduler_logger()
+
+## Condor Job Status mapping
+IDLE = 1
+RUNNING = 2
+COMPLETE = 4
+HELD = 5
+
+
+def load_daemon(path=None):
+    """Load the cloud_scheduler daemon script as a module.
+
+    Keywords:
+        path - location of the script, defaults to the copy next to the
+               cloudscheduler package and then to the one on the PATH
+    """
+    if not path:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cloud_scheduler")
+        if not os.path.isfile(path):
+            path = find_executable("cloud_scheduler")
+    if not path or not os.path.isfile(path):
+        raise IOError("Could not find the cloud_scheduler script to simulate")
+    # Don't leave a compiled cloud_schedulerc next to the script
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source("cloud_scheduler_daemon", path)
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of an already sorted list, 0 if empty."""
+    if not values:
+        return 0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def summarize(values):
+    """Count, mean, median, 95th percentile and max of a list of numbers."""
+    values = sorted(values)
+    if not values:
+        return {'count': 0, 'mean': 0, 'p50': 0, 'p95': 0, 'max': 0}
+    return {'count': len(values),
+            'mean': float(sum(values)) / len(values),
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'max': values[-1]}
+
+
+class SimClock:
+    """Simulated wall clock, stands in for time.time during a run."""
+
+    def __init__(self, start=1500000000.0):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+
+class SimJob:
+    """A job in the fake Condor queue."""
+
+    def __init__(self, number, user, vmtype, submit_time, runtime,
+                 memory=None, cpucores=None, storage=None):
+        self.number = number
+        self.id = "sim.schedd#%d.0#%d" % (number, int(submit_time))
+        self.user = user
+        self.vmtype = vmtype
+        self.uservmtype = ':'.join([user, vmtype])
+        self.submit_time = submit_time
+        self.runtime = runtime
+        self.memory = memory if memory else config.default_VMMem
+        self.cpucores = cpucores if cpucores else config.default_VMCPUCores
+        self.storage = storage if storage else config.default_VMStorage
+        self.status = IDLE
+        self.machine = None
+        self.start_time = None
+        self.first_start_time = None
+        self.evictions = 0
+
+
+class SimMachine:
+    """A VM's startd registered with the fake Condor collector."""
+
+    def __init__(self, cluster, vm, now):
+        self.cluster = cluster
+        self.vm = vm
+        self.name = vm.hostname
+        self.address = "<%s:9618>" % vm.hostname
+        self.uservmtype = vm.uservmtype
+        self.job = None
+        self.retiring = False
+        self.entered_state = now
+
+
+@cluster_tools.timed_cloud_api
+class DummyCluster(cluster_tools.ICluster):
+    """A simulated cloud.
+
+    VMs take boot_latency seconds to reach Running. vm_create fails outright
+    with probability create_failure_rate and a created VM goes to Error
+    instead of Running with probability boot_failure_rate. quota, when set,
+    is the number of VMs the cloud actually allows even if vm_slots says
+    there is room, so requests past it fail with a quota error.
+    """
+
+    VM_STATES = {"Starting": "Starting", "Running": "Running", "Error": "Error"}
+    ERROR = 1
+    QUOTA_EXCEEDED = -2
+
+    def __init__(self, name, vm_slots, memory=None, cpu_cores=8, storage=None,
+                 quota=None, boot_latency=120, create_failure_rate=0.0,
+                 boot_failure_rate=0.0, priority=0, simulation=None, rand=None):
+        if memory is None:
+            memory = vm_slots * 8192
+        if storage is None:
+            storage = vm_slots * 100
+        cluster_tools.ICluster.__init__(self, name=name, host=name, cloud_type="Dummy",
+                                        memory=memory, vm_slots=vm_slots, cpu_cores=cpu_cores,
+                                        storage=storage, enabled=True, priority=priority)
+        self.total_cpu_cores = -1
+        self.quota = quota
+        self.boot_latency = boot_latency
+        self.create_failure_rate = create_failure_rate
+        self.boot_failure_rate = boot_failure_rate
+        self.simulation = simulation
+        self.random = rand if rand else random.Random()
+        self.boots = {}
+        self.next_vm_number = 0
+        self.peak_vms = 0
+        self.stats = defaultdict(int)
+
+    def __getstate__(self):
+        """Override to leave the simulation out of the persistence file."""
+        state = cluster_tools.ICluster.__getstate__(self)
+        del state['simulation']
+        del state['random']
+        return state
+
+    def vm_create(self, vm_name, vm_type, vm_user, vm_image, vm_mem, vm_cores,
+                  vm_storage, vm_keepalive=0, job_per_core=False):
+        """Create a simulated VM that boots after boot_latency seconds."""
+        if self.random.random() < self.create_failure_rate:
+            self.stats['create_failures'] += 1
+            log.debug("Simulated create failure on %s" % self.name)
+            return self.ERROR
+        if self.quota is not None and len(self.vms) >= self.quota:
+            self.stats['quota_refusals'] += 1
+            log.debug("Simulated quota of %d VMs reached on %s" % (self.quota, self.name))
+            return self.QUOTA_EXCEEDED
+
+        self.next_vm_number += 1
+        vm_id = "%s-%d" % (self.name, self.next_vm_number)
+        if not vm_keepalive and self.keep_alive:
+            vm_keepalive = self.keep_alive
+        new_vm = cluster_tools.VM(name=vm_name, id=vm_id, vmtype=vm_type, user=vm_user,
+                                  clusteraddr=self.network_address, hostname=vm_id,
+                                  cloudtype=self.cloud_type, image=vm_name,
+                                  memory=vm_mem, cpucores=vm_cores, storage=vm_storage,
+                                  keep_alive=vm_keepalive, job_per_core=job_per_core)
+        try:
+            self.resource_checkout(new_vm)
+        except cluster_tools.NoResourcesError, e:
+            log.debug("Not enough %s on %s for simulated VM" % (e.resource, self.name))
+            return self.QUOTA_EXCEEDED
+
+        boot_at = time.time() + self.boot_latency
+        fails = self.random.random() < self.boot_failure_rate
+        self.boots[vm_id] = (boot_at, fails)
+        with self.vms_lock:
+            self.vms.append(new_vm)
+            self.peak_vms = max(self.peak_vms, len(self.vms))
+        self.stats['created'] += 1
+        if fails:
+            self.stats['boot_failures'] += 1
+        if self.simulation:
+            self.simulation.vm_created(self, new_vm, boot_at, fails)
+        return 0
+
+    def vm_poll(self, vm):
+        """Report Starting until the boot latency has passed, then Running or Error."""
+        (boot_at, fails) = self.boots.get(vm.id, (0, True))
+        now = time.time()
+        if now < boot_at:
+            status = "Starting"
+        elif fails:
+            status = "Error"
+        else:
+            status = "Running"
+        with self.vms_lock:
+            if vm.status != status:
+                vm.last_state_change = int(now)
+            vm.status = status
+            vm.lastpoll = int(now)
+        return vm.status
+
+    def vm_list_states(self):
+        """The status vm_poll would give each VM, for every VM at once."""
+        now = time.time()
+        states = {}
+        for (vm_id, (boot_at, fails)) in self.boots.items():
+            if now < boot_at:
+                states[vm_id] = "Starting"
+            elif fails:
+                states[vm_id] = "Error"
+            else:
+                states[vm_id] = "Running"
+        return states
+
+    def vm_destroy(self, vm, return_resources=True, reason=""):
+        """Remove a simulated VM, evicting any job Condor had on it."""
+        log.debug("Destroying simulated VM %s on %s: %s" % (vm.id, self.name, reason))
+        if self.simulation:
+            self.simulation.vm_destroyed(vm)
+        with self.vms_lock:
+            if vm not in self.vms:
+                return 0
+            if return_resources and vm.return_resources:
+                self.resource_return(vm)
+            self.vms.remove(vm)
+        self.boots.pop(vm.id, None)
+        self.stats['destroyed'] += 1
+        return 0
+
+
+class FakeCondor:
+    """The Condor schedd, collector and negotiator as seen by the simulation."""
+
+    def __init__(self, trace):
+        self.pending = deque(sorted(trace, key=lambda job: job.submit_time))
+        self.submitted = len(self.pending)
+        self.queue = {}
+        self.idle_jobs = defaultdict(deque)
+        self.machines = {}
+        self.machines_by_address = {}
+        self.idle_machines = defaultdict(set)
+        self.busy_by_cluster = defaultdict(int)
+        self.completed = []
+        self.stats = defaultdict(int)
+
+    def arrive(self, now):
+        """Submit the trace jobs whose submit time has come."""
+        while self.pending and self.pending[0].submit_time <= now:
+            job = self.pending.popleft()
+            self.queue[job.id] = job
+            self.idle_jobs[job.uservmtype].append(job)
+
+    def done(self):
+        return not self.pending and not self.queue
+
+    ## condor_q / condor_status
+
+    def job_query(self, now):
+        """The queue as condor_q -l would report it, as Job objects."""
+        self.arrive(now)
+        jobs = []
+        for sim_job in self.queue.itervalues():
+            remote_host = None
+            if sim_job.machine:
+                remote_host = "slot1@%s" % sim_job.machine.name
+            jobs.append(job_management.Job(GlobalJobId=sim_job.id, Owner=sim_job.user,
+                        JobStatus=sim_job.status, ClusterId=sim_job.number, ProcId=0,
+                        VMType=sim_job.vmtype, VMMem=sim_job.memory,
+                        VMCPUCores=sim_job.cpucores, VMStorage=sim_job.storage,
+                        RemoteHost=remote_host, ServerTime=int(now),
+                        JobStartDate=int(sim_job.start_time or 0)))
+        return jobs
+
+    def status_query(self, now):
+        """The collector's startd ads, as condor_status -l would report them."""
+        machines = []
+        for machine in self.machines.itervalues():
+            user = machine.vm.user
+            ad = {'Name': "slot1@%s" % machine.name,
+                  'Machine': machine.name,
+                  'MyAddress': machine.address,
+                  'VMType': machine.vm.vmtype,
+                  'MyCurrentTime': int(now),
+                  'EnteredCurrentState': int(machine.entered_state),
+                  'Start': '(Owner == "%s")' % user,
+                  'SlotType': 'Static',
+                  'TotalSlots': '1'}
+            if machine.job:
+                ad['State'] = 'Claimed'
+                ad['Activity'] = 'Busy'
+                ad['RemoteOwner'] = user
+                ad['JobId'] = "%d.0" % machine.job.number
+                ad['GlobalJobId'] = machine.job.id
+            else:
+                ad['State'] = 'Unclaimed'
+                ad['Activity'] = 'Idle'
+            machines.append(ad)
+        return machines
+
+    def master_query(self):
+        return [{'Machine': machine.name, 'MasterIpAddr': machine.address}
+                for machine in self.machines.itervalues()]
+
+    ## condor_off / condor_hold / condor_release
+
+    def condor_off(self, machine_addr):
+        """Peaceful condor_off: the startd leaves once its job is done."""
+        machine = self.machines_by_address.get(machine_addr)
+        if machine is None:
+            return (0, 1, 0, 1)
+        machine.retiring = True
+        self.idle_machines[machine.uservmtype].discard(machine.name)
+        if machine.job is None:
+            self.remove_machine(machine)
+        self.stats['condor_off'] += 1
+        return (0, 0, 0, 0)
+
+    def hold(self, jobs):
+        for job in jobs:
+            sim_job = self.queue.get(job.id)
+            if sim_job and sim_job.status == IDLE:
+                sim_job.status = HELD
+                self.stats['held'] += 1
+        return 0
+
+    def release(self, jobs):
+        for job in jobs:
+            sim_job = self.queue.get(job.id)
+            if sim_job and sim_job.status == HELD:
+                sim_job.status = IDLE
+                self.idle_jobs[sim_job.uservmtype].append(sim_job)
+                self.stats['released'] += 1
+        return 0
+
+    ## startd life cycle
+
+    def register(self, cluster, vm, now):
+        machine = SimMachine(cluster, vm, now)
+        self.machines[machine.name] = machine
+        self.machines_by_address[machine.address] = machine
+        self.idle_machines[machine.uservmtype].add(machine.name)
+
+    def remove_machine(self, machine):
+        self.machines.pop(machine.name, None)
+        self.machines_by_address.pop(machine.address, None)
+        self.idle_machines[machine.uservmtype].discard(machine.name)
+
+    def vm_gone(self, vm):
+        """A VM was destroyed: its startd vanishes and its job is evicted."""
+        machine = self.machines.get(vm.hostname)
+        if machine is None:
+            return
+        job = machine.job
+        if job is not None:
+            job.status = IDLE
+            job.machine = None
+            job.start_time = None
+            job.evictions += 1
+            self.busy_by_cluster[machine.cluster.name] -= 1
+            self.idle_jobs[job.uservmtype].appendleft(job)
+            self.stats['evictions'] += 1
+        self.remove_machine(machine)
+
+    def negotiate(self, now):
+        """Match idle jobs to idle machines of the same user and VM type.
+
+        Returns a list of (end_time, job, machine) for the jobs started.
+        """
+        self.arrive(now)
+        started = []
+        for uservmtype, names in self.idle_machines.iteritems():
+            jobs = self.idle_jobs.get(uservmtype)
+            while names and jobs:
+                job = jobs.popleft()
+                if job.status != IDLE or job.machine is not None or job.id not in self.queue:
+                    continue
+                machine = self.machines[names.pop()]
+                machine.job = job
+                machine.entered_state = now
+                job.machine = machine
+                job.status = RUNNING
+                job.start_time = now
+                if job.first_start_time is None:
+                    job.first_start_time = now
+                self.busy_by_cluster[machine.cluster.name] += 1
+                started.append((now + job.runtime, job, machine))
+        return started
+
+    def finish(self, job, machine, now):
+        """A job's runtime is up, unless it was evicted in the meantime."""
+        if job.machine is not machine or job.status != RUNNING:
+            return
+        job.status = COMPLETE
+        job.machine = None
+        del self.queue[job.id]
+        self.completed.append(job)
+        self.busy_by_cluster[machine.cluster.name] -= 1
+        machine.job = None
+        machine.entered_state = now
+        if machine.retiring:
+            self.remove_machine(machine)
+        elif machine.name in self.machines:
+            self.idle_machines[machine.uservmtype].add(machine.name)
+
+
+def make_resource_pool(condor, clusters):
+    """Build a ResourcePool whose Condor calls go to the fake pool."""
+
+    class SimResourcePool(ResourcePool):
+        def __init__(self):
+            # Keep the lists per instance, ResourcePool's are class attributes
+            self.resources = []
+            self.retired_resources = []
+            self.machine_list = []
+            self.prev_machine_list = []
+            self.vm_machine_list = []
+            self.prev_vm_machine_list = []
+            self.master_list = []
+            ResourcePool.__init__(self, os.devnull, name="Simulated")
+            for cluster in clusters:
+                self.add_resource(cluster)
+
+        def resource_query_local(self):
+            return condor.status_query(time.time())
+
+        def master_resource_query_local(self):
+            return condor.master_query()
+
+        def do_condor_off_batch(self, machines):
+            return [condor.condor_off(machine_addr) == (0, 0, 0, 0)
+                    for (machine_name, machine_addr, master_addr) in machines]
+
+    return SimResourcePool()
+
+
+def make_job_pool(condor):
+    """Build a JobPool whose Condor calls go to the fake pool."""
+
+    class SimJobPool(job_management.JobPool):
+        def job_query_local(self):
+            self.last_query = time.time()
+            return condor.job_query(time.time())
+
+        def job_hold_local(self, jobs, reason="", constraint=None):
+            condor.hold(jobs)
+            return []
+
+        def job_release_local(self, jobs, constraint=None):
+            condor.release(jobs)
+            return []
+
+    return SimJobPool("Simulated")
+
+
+class Simulation:
+    """Drives the daemon's cycles against DummyClusters and a FakeCondor."""
+
+    def __init__(self, daemon, clusters, trace, negotiator_interval=60,
+                 register_delay=60, duration=48*3600, clock=None):
+        """Constructor.
+
+        Keywords:
+            daemon              - the loaded cloud_scheduler module (see load_daemon)
+            clusters            - list of DummyCluster
+            trace               - list of SimJob, submit times relative to the start
+            negotiator_interval - seconds between Condor negotiation cycles
+            register_delay      - seconds between a VM running and its startd registering
+            duration            - maximum simulated seconds to run for
+        """
+        self.clock = clock if clock else SimClock()
+        self.start = self.clock.now
+        for job in trace:
+            job.submit_time += self.start
+        self.condor = FakeCondor(trace)
+        self.clusters = clusters
+        for cluster in clusters:
+            cluster.simulation = self
+        self.negotiator_interval = negotiator_interval
+        self.register_delay = register_delay
+        self.duration = duration
+        self.events = []
+        self.sequence = 0
+        self.cycle_cpu = defaultdict(list)
+        self.vm_seconds = defaultdict(float)
+        self.busy_seconds = defaultdict(float)
+        self.last_account = self.start
+
+        self.resource_pool = make_resource_pool(self.condor, clusters)
+        self.job_pool = make_job_pool(self.condor)
+        self.components = [
+            ("JobPoller", daemon.JobPoller(self.job_pool)),
+            ("MachinePoller", daemon.MachinePoller(self.resource_pool)),
+            ("Scheduler", daemon.Scheduler(self.resource_pool, self.job_pool)),
+            ("Cleanup", daemon.Cleanup(self.resource_pool, self.job_pool)),
+            ("VMPoller", daemon.VMPoller(self.resource_pool, self.job_pool)),
+        ]
+
+    def at(self, when, action, *args):
+        """Queue action(*args) to happen at simulated time when."""
+        self.sequence += 1
+        heapq.heappush(self.events, (when, self.sequence, action, args))
+
+    ## Callbacks from DummyCluster
+
+    def vm_created(self, cluster, vm, boot_at, fails):
+        if not fails:
+            self.at(boot_at + self.register_delay, self.register_vm, cluster, vm)
+
+    def vm_destroyed(self, vm):
+        self.condor.vm_gone(vm)
+
+    def register_vm(self, cluster, vm):
+        if vm in cluster.vms:
+            self.condor.register(cluster, vm, self.clock.now)
+
+    ## Periodic work
+
+    def run_component(self, name, component, interval):
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        component.run_cycle()
+        # Let VM destroys started this cycle finish before time moves on
+        for thread in getattr(component, 'destroy_threads', {}).values():
+            thread.join()
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        self.cycle_cpu[name].append((after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime))
+        component.heart_beat = self.clock.now
+        self.at(self.clock.now + interval, self.run_component, name, component, interval)
+
+    def negotiate(self):
+        for (end_time, job, machine) in self.condor.negotiate(self.clock.now):
+            self.at(end_time, self.condor.finish, job, machine, end_time)
+        self.at(self.clock.now + self.negotiator_interval, self.negotiate)
+
+    def account(self, now):
+        """Integrate VM and busy VM counts per cloud up to now."""
+        elapsed = now - self.last_account
+        if elapsed > 0:
+            for cluster in self.clusters:
+                self.vm_seconds[cluster.name] += len(cluster.vms) * elapsed
+                self.busy_seconds[cluster.name] += self.condor.busy_by_cluster[cluster.name] * elapsed
+        self.last_account = now
+
+    def finished(self):
+        return self.condor.done() and not [cluster for cluster in self.clusters if cluster.vms]
+
+    def run(self):
+        """Run until every job is done and all VMs are gone, or for duration seconds."""
+        intervals = {"JobPoller": "polling_interval", "MachinePoller": "polling_interval",
+                     "Scheduler": "scheduling_interval", "Cleanup": "polling_interval",
+                     "VMPoller": "run_interval"}
+        for (name, component) in self.components:
+            self.at(self.start, self.run_component, name, component,
+                    max(1, getattr(component, intervals[name])))
+        self.at(self.start, self.negotiate)
+
+        real_time = time.time
+        time.time = self.clock.time
+        try:
+            end = self.start + self.duration
+            while self.events and not self.finished():
+                (when, _, action, args) = heapq.heappop(self.events)
+                if when > end:
+                    break
+                self.account(when)
+                self.clock.now = when
+                action(*args)
+            self.account(min(self.clock.now, end))
+        finally:
+            time.time = real_time
+        return self.report()
+
+    def report(self):
+        """Gather the run's metrics into a dict."""
+        elapsed = self.clock.now - self.start
+        hours = elapsed / 3600.0 if elapsed else 1
+        started = [job for job in self.condor.completed] + \
+                  [job for job in self.condor.queue.itervalues() if job.first_start_time is not None]
+        waits = [job.first_start_time - job.submit_time for job in started]
+
+        vms = defaultdict(int)
+        clouds = {}
+        for cluster in self.clusters:
+            for key, value in cluster.stats.iteritems():
+                vms[key] += value
+            vm_seconds = self.vm_seconds[cluster.name]
+            capacity = cluster.max_slots * elapsed
+            clouds[cluster.name] = {
+                'max_slots': cluster.max_slots,
+                'peak_vms': cluster.peak_vms,
+                'utilisation': vm_seconds / capacity if capacity else 0,
+                'busy_fraction': self.busy_seconds[cluster.name] / vm_seconds if vm_seconds else 0,
+            }
+        vms = dict(vms)
+        vms['churn_per_hour'] = (vms.get('created', 0) + vms.get('destroyed', 0)) / hours
+
+        cycles = {}
+        for name, costs in self.cycle_cpu.iteritems():
+            summary = summarize(costs)
+            summary['total'] = sum(costs)
+            cycles[name] = summary
+
+        return {'simulated_seconds': elapsed,
+                'jobs': {'submitted': self.condor.submitted,
+                         'started': len(started),
+                         'completed': len(self.condor.completed),
+                         'held': self.condor.stats['held'],
+                         'evictions': self.condor.stats['evictions'],
+                         'wait_seconds': summarize(waits)},
+                'vms': vms,
+                'clouds': clouds,
+                'cycle_cpu_seconds': cycles}
+
+
+def generate_trace(num_jobs, users=10, vmtypes=2, submit_window=6*3600,
+                   mean_runtime=1800, rand=None):
+    """A synthetic trace: Poisson arrivals over submit_window, exponential runtimes."""
+    rand = rand if rand else random.Random()
+    trace = []
+    rate = float(num_jobs) / submit_window if submit_window else 0
+    submit_time = 0.0
+    for number in range(1, num_jobs + 1):
+        if rate:
+            submit_time += rand.expovariate(rate)
+        user = "user%d" % rand.randrange(users)
+        vmtype = "vmtype%d" % rand.randrange(vmtypes)
+        runtime = max(1, int(rand.expovariate(1.0 / mean_runtime)))
+        trace.append(SimJob(number, user, vmtype, submit_time, runtime))
+    return trace
+
+
+def read_trace(path):
+    """Read a trace file.
+
+    One job per line: submit_time user vmtype runtime [memory [cpucores [storage]]]
+    with times in seconds from the start of the simulation. Blank lines and
+    lines starting with # are ignored.
+    """
+    trace = []
+    trace_file = open(path)
+    try:
+        for line in trace_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) < 4:
+                raise ValueError("Trace line needs at least 4 fields: %s" % line)
+            extra = [int(field) for field in fields[4:7]]
+            trace.append(SimJob(len(trace) + 1, fields[1], fields[2], float(fields[0]),
+                                int(fields[3]), *extra))
+    finally:
+        trace_file.close()
+    return trace
+
+
+def parse_cloud(spec, defaults, rand):
+    """Build a DummyCluster from NAME:SLOTS[:QUOTA[:BOOT_LATENCY[:CREATE_FAIL[:BOOT_FAIL]]]]."""
+    fields = spec.split(':')
+    if len(fields) < 2:
+        raise ValueError("Cloud needs at least NAME:SLOTS: %s" % spec)
+    values = [defaults['quota'], defaults['boot_latency'],
+              defaults['create_failure_rate'], defaults['boot_failure_rate']]
+    for i, field in enumerate(fields[2:6]):
+        if field:
+            values[i] = float(field)
+    quota = int(values[0]) if values[0] is not None else None
+    return DummyCluster(fields[0], int(fields[1]), quota=quota, boot_latency=values[1],
+                        create_failure_rate=values[2], boot_failure_rate=values[3], rand=rand)
+
+
+def format_report(report):
+    """Render a report dict as text."""
+    lines = []
+    jobs = report['jobs']
+    wait = jobs['wait_seconds']
+    lines.append("Simulated time: %.1f hours" % (report['simulated_seconds'] / 3600.0))
+    lines.append("Jobs: %d submitted, %d started, %d completed, %d held, %d evictions" %
+                 (jobs['submitted'], jobs['started'], jobs['completed'], jobs['held'], jobs['evictions']))
+    lines.append("Job wait (s): mean %.0f  p50 %.0f  p95 %.0f  max %.0f" %
+                 (wait['mean'], wait['p50'], wait['p95'], wait['max']))
+    vms = report['vms']
+    lines.append("VMs: %d created, %d destroyed, %d create failures, %d quota refusals, %d boot failures, %.1f churn/hour" %
+                 (vms.get('created', 0), vms.get('destroyed', 0), vms.get('create_failures', 0),
+                  vms.get('quota_refusals', 0), vms.get('boot_failures', 0), vms['churn_per_hour']))
+    for name in sorted(report['clouds']):
+        cloud = report['clouds'][name]
+        lines.append("Cloud %s: %d slots, peak %d VMs, utilisation %.1f%%, busy %.1f%% of VM time" %
+                     (name, cloud['max_slots'], cloud['peak_vms'], cloud['utilisation'] * 100,
+                      cloud['busy_fraction'] * 100))
+    for name in sorted(report['cycle_cpu_seconds']):
+        cycle = report['cycle_cpu_seconds'][name]
+        lines.append("%s cycles: %d, CPU per cycle mean %.4fs  p95 %.4fs  max %.4fs  total %.1fs" %
+                     (name, cycle['count'], cycle['mean'], cycle['p95'], cycle['max'], cycle['total']))
+    return "\n".join(lines)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+                          description="Simulate Cloud Scheduler against dummy clouds and a fake Condor pool.")
+    parser.add_option("-f", "--config-file", dest="config_file", metavar="FILE",
+                      help="cloud_scheduler.conf to take the scheduler settings from")
+    parser.add_option("--daemon", dest="daemon", metavar="FILE",
+                      help="cloud_scheduler script to simulate")
+    parser.add_option("-c", "--cloud", dest="clouds", action="append", default=[],
+                      metavar="NAME:SLOTS[:QUOTA[:BOOT_LATENCY[:CREATE_FAIL[:BOOT_FAIL]]]]",
+                      help="a dummy cloud, may be given more than once (default 5 clouds of 1000 slots)")
+    parser.add_option("--boot-latency", dest="boot_latency", type="float", default=120,
+                      help="default seconds for a VM to boot")
+    parser.add_option("--create-failure-rate", dest="create_failure_rate", type="float", default=0.0,
+                      help="default fraction of VM creates that fail")
+    parser.add_option("--boot-failure-rate", dest="boot_failure_rate", type="float", default=0.0,
+                      help="default fraction of VMs that go to Error instead of booting")
+    parser.add_option("--quota", dest="quota", type="int", default=None,
+                      help="default number of VMs a cloud really allows")
+    parser.add_option("-t", "--trace", dest="trace", metavar="FILE",
+                      help="job trace: submit_time user vmtype runtime [memory [cpucores [storage]]]")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=100000,
+                      help="number of jobs in the generated trace")
+    parser.add_option("--users", dest="users", type="int", default=10)
+    parser.add_option("--vmtypes", dest="vmtypes", type="int", default=2,
+                      help="VM types per user in the generated trace")
+    parser.add_option("--submit-window", dest="submit_window", type="float", default=6*3600,
+                      help="seconds over which the generated jobs arrive")
+    parser.add_option("--mean-runtime", dest="mean_runtime", type="float", default=1800,
+                      help="mean job runtime in seconds of the generated trace")
+    parser.add_option("--duration", dest="duration", type="float", default=48,
+                      help="maximum simulated hours")
+    parser.add_option("--negotiator-interval", dest="negotiator_interval", type="float", default=60)
+    parser.add_option("--register-delay", dest="register_delay", type="float", default=60,
+                      help="seconds from a VM running to its startd registering")
+    parser.add_option("--seed", dest="seed", type="int", default=None)
+    parser.add_option("--log-level", dest="log_level", default="WARNING",
+                      help="cloudscheduler log level during the run")
+    parser.add_option("--json", dest="json", action="store_true", default=False,
+                      help="print the report as JSON")
+    (options, args) = parser.parse_args()
+
+    if options.config_file:
+        config.setup(path=options.config_file)
+    log.setLevel(utilities.LEVELS[options.log_level.upper()])
+    if options.log_level.upper() != "WARNING":
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(config.log_format))
+        log.addHandler(handler)
+    # Keep the persistence file of a real install out of the way
+    persistence_dir = tempfile.mkdtemp(prefix="cs-sim-")
+    config.persistence_file = os.path.join(persistence_dir, "cloudscheduler.persistence")
+    config.ban_tracking = False
+    config.user_limit_file = None
+    config.target_cloud_alias_file = None
+
+    rand = random.Random(options.seed)
+    defaults = {'quota': options.quota, 'boot_latency': options.boot_latency,
+                'create_failure_rate': options.create_failure_rate,
+                'boot_failure_rate': options.boot_failure_rate}
+    specs = options.clouds or ["cloud%d:1000" % i for i in range(5)]
+    try:
+        clusters = [parse_cloud(spec, defaults, rand) for spec in specs]
+        if options.trace:
+            trace = read_trace(options.trace)
+        else:
+            trace = generate_trace(options.jobs, options.users, options.vmtypes,
+                                   options.submit_window, options.mean_runtime, rand)
+        daemon = load_daemon(options.daemon)
+    except (ValueError, IOError), e:
+        print >> sys.stderr, "Simulation setup problem: %s" % e
+        sys.exit(1)
+
+    simulation = Simulation(daemon, clusters, trace,
+                            negotiator_interval=options.negotiator_interval,
+                            register_delay=options.register_delay,
+                            duration=options.duration * 3600)
+    try:
+        report = simulation.run()
+    finally:
+        for path in (config.persistence_file, config.persistence_file + ".journal"):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(persistence_dir)
+
+    if options.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        print format_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## INFO SNAPSHOTS
+##
+## Read-only copies of the resource pool and the job pool for info_server,
+## so monitoring requests never walk the lists the scheduler threads are
+## changing and never hold their locks.
+##
+## The VMPoller publishes a new resource snapshot at the end of each cycle
+## and the JobPoller a new job snapshot; each gets the next version number,
+## which info_server uses for its ETags and to reuse rendered responses.
+##
+## Snapshots are copy-on-write: the pool and cluster objects are shallow
+## copies with their own lists, and a VM is only copied again once its
+## change_count has moved, so unchanged VMs are shared between versions.
+## VMs that were in the last snapshot but aren't in the new one are put on
+## the event feed as removed.
+##
+## Jobs aren't copied, a job snapshot holds a copy of the job container's
+## tables, so the jobs listed can't change under a request but their
+## attributes are the live ones.
+##
+
+from __future__ import with_statement
+
+import copy
+import time
+import types
+import itertools
+import threading
+
+import cloudscheduler.events as events
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+
+def shallow_copy(obj):
+    """A copy of obj sharing its attribute values.
+
+    Goes around __init__, __setattr__ and __setstate__, which have side
+    effects for clusters and VMs. Methods of obj stored as attributes are
+    bound to the copy instead.
+    """
+    if isinstance(obj, types.InstanceType):
+        copied = types.InstanceType(obj.__class__)
+        copied.__dict__.update(obj.__dict__)
+    else:
+        copied = copy.copy(obj)
+    for (name, value) in obj.__dict__.items():
+        if isinstance(value, types.MethodType) and value.im_self is obj:
+            copied.__dict__[name] = types.MethodType(value.im_func, copied, value.im_class)
+    return copied
+
+
+class Snapshot:
+    """One published copy of a pool."""
+
+    def __init__(self, kind, version, pool, epoch):
+        """Constructor.
+
+        Keywords:
+            kind    - 'resources' or 'jobs'
+            version - the publisher's version number for this snapshot
+            pool    - the frozen ResourcePool or JobPool
+            epoch   - the publisher's start time, so versions don't repeat across restarts
+        """
+        self.kind = kind
+        self.version = version
+        self.pool = pool
+        self.created = time.time()
+        self.tag = "%x-%s%d" % (epoch, kind[0], version)
+
+    def age(self):
+        return time.time() - self.created
+
+
+class SnapshotPublisher:
+    """Makes the snapshots and holds the latest of each kind."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = itertools.count(1)
+        self.epoch = int(time.time())
+        self.resources = None
+        self.jobs = None
+        # id(vm) -> (vm, change_count, frozen copy) from the last resource snapshot
+        self.vm_copies = {}
+
+    def freeze_cluster(self, cluster, vm_copies):
+        frozen = shallow_copy(cluster)
+        vms = []
+        for vm in list(cluster.vms):
+            change_count = vm.change_count
+            entry = self.vm_copies.get(id(vm))
+            if entry is None or entry[0] is not vm or entry[1] != change_count:
+                entry = (vm, change_count, shallow_copy(vm))
+            vm_copies[id(vm)] = entry
+            vms.append(entry[2])
+        frozen.__dict__['vms'] = vms
+        return frozen
+
+    def feed_removed_vms(self, vm_copies):
+        """Put the VMs in the last snapshot but not in vm_copies on the event feed."""
+        for (key, (vm, change_count, frozen)) in self.vm_copies.iteritems():
+            if vm_copies.get(key, (None,))[0] is not vm:
+                events.feed.emit('vm', vm=vm.id, hostname=vm.hostname, uservmtype=vm.uservmtype,
+                                 clusteraddr=vm.clusteraddr, attribute='status', old=vm.status,
+                                 new='Removed')
+
+    def publish_resources(self, resource_pool):
+        """Snapshot resource_pool and make it the latest. Returns the Snapshot."""
+        with self.lock:
+            vm_copies = {}
+            pool = shallow_copy(resource_pool)
+            pool.resources = [self.freeze_cluster(cluster, vm_copies)
+                              for cluster in list(resource_pool.resources)]
+            pool.retired_resources = [self.freeze_cluster(cluster, vm_copies)
+                                      for cluster in list(resource_pool.retired_resources)]
+            pool.missing_vm_condor_machines = set(resource_pool.missing_vm_condor_machines)
+            pool.ban_events = list(resource_pool.ban_events)
+            self.feed_removed_vms(vm_copies)
+            self.vm_copies = vm_copies
+            self.resources = Snapshot('resources', self.versions.next(), pool, self.epoch)
+            return self.resources
+
+    def publish_jobs(self, job_pool):
+        """Snapshot job_pool and make it the latest. Returns the Snapshot."""
+        with self.lock:
+            pool = shallow_copy(job_pool)
+            pool.job_container = job_pool.job_container.copy()
+            self.jobs = Snapshot('jobs', self.versions.next(), pool, self.epoch)
+            return self.jobs
+
+    def current_resources(self, resource_pool):
+        """The latest resource snapshot, made from resource_pool if there isn't one yet."""
+        snapshot = self.resources
+        if snapshot is None:
+            snapshot = self.publish_resources(resource_pool)
+        return snapshot
+
+    def current_jobs(self, job_pool):
+        """The latest job snapshot, made from job_pool if there isn't one yet."""
+        snapshot = self.jobs
+        if snapshot is None:
+            snapshot = self.publish_jobs(job_pool)
+        return snapshot
+
+publisher = SnapshotPublisher()
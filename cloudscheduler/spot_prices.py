@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## SPOT PRICES
+##
+## The current EC2 spot prices of the regions the AmazonEC2 clouds are in,
+## kept in memory so pricing a spot bid doesn't wait on the EC2 API.
+##
+## A SpotPriceRefresher thread fetches each region's prices every
+## config.spot_price_refresh_interval seconds: one paginated
+## DescribeSpotPriceHistory call per region, for every instance type, zone
+## and product at once, over a connection made the way the cloud makes its
+## own. Spot prices don't depend on the account, so clouds sharing an
+## endpoint and region are fetched once.
+##
+## The prices go into the shared SpotPriceTable, prices, which answers
+## lowest() from memory and is shown by info_server's /spot-prices. A
+## region whose fetch fails keeps its last prices until one works.
+##
+
+from __future__ import with_statement
+
+import time
+import datetime
+import threading
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# Regions fetched at once
+REFRESH_THREADS = 4
+# Most pages of prices asked for in a region's fetch
+MAX_PAGES = 100
+# Product the prices are for when a query doesn't say
+DEFAULT_PRODUCT = "Linux/UNIX"
+
+
+class SpotPriceTable:
+    """The latest spot price of each instance type, zone and product, by region."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Region -> {(zone, instance type, product): (price, timestamp)}
+        self.regions = {}
+        # Region -> when its prices were fetched
+        self.fetched = {}
+        # Region -> the error of its last fetch, None if it worked
+        self.errors = {}
+
+    def update(self, region, prices):
+        """Replace region's prices with prices, a list of boto SpotPriceHistory."""
+        table = {}
+        for price in prices:
+            key = (price.availability_zone, price.instance_type, price.product_description)
+            # The history can hold more than one price for a key, keep the newest
+            if key not in table or table[key][1] < price.timestamp:
+                table[key] = (price.price, price.timestamp)
+        with self.lock:
+            self.regions[region] = table
+            self.fetched[region] = time.time()
+            self.errors[region] = None
+
+    def failed(self, region, error):
+        with self.lock:
+            self.errors[region] = error
+
+    def lowest(self, region, instance_type, product=DEFAULT_PRODUCT, zones=None):
+        """The lowest price of instance_type in region, in any of zones or any
+        zone if None. Returns None if there's no price for it.
+        """
+        table = self.regions.get(region, {})
+        prices = [price for ((zone, inst, prod), (price, timestamp)) in table.items()
+                  if inst == instance_type and prod == product and (zones is None or zone in zones)]
+        if not prices:
+            return None
+        return min(prices)
+
+    def rows(self):
+        """Every price as a dict, sorted by region, instance type, product and zone."""
+        with self.lock:
+            regions = self.regions.items()
+        rows = []
+        for (region, table) in regions:
+            for ((zone, instance_type, product), (price, timestamp)) in table.items():
+                rows.append({'region': region, 'zone': zone, 'instance_type': instance_type,
+                             'product': product, 'price': price, 'timestamp': timestamp})
+        rows.sort(key=lambda row: (row['region'], row['instance_type'], row['product'], row['zone']))
+        return rows
+
+    def status(self):
+        """Region -> (when its prices were fetched, the error of its last fetch)."""
+        with self.lock:
+            return dict((region, (self.fetched.get(region), self.errors.get(region)))
+                        for region in set(self.fetched) | set(self.errors))
+
+    def clear(self):
+        with self.lock:
+            self.regions = {}
+            self.fetched = {}
+            self.errors = {}
+
+prices = SpotPriceTable()
+
+
+def region_of(cluster):
+    """The name of the region cluster's connection is made to."""
+    if len(cluster.regions) > 0:
+        return cluster.regions[0]
+    return cluster.name
+
+
+def fetch(connection):
+    """Every current spot price connection's region has, following the pages."""
+    now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    found = []
+    next_token = None
+    for page in range(MAX_PAGES):
+        result = connection.get_spot_price_history(start_time=now, end_time=now, next_token=next_token)
+        found.extend(result)
+        next_token = getattr(result, 'next_token', None)
+        if not next_token:
+            break
+    else:
+        log.warning("Stopped fetching spot prices from %s after %d pages" % (connection.host, MAX_PAGES))
+    return found
+
+
+class SpotPriceRefresher(threading.Thread):
+    """
+    SpotPriceRefresher - Periodically fetches the spot prices of the regions
+                         of the AmazonEC2 clouds into prices
+    """
+
+    def __init__(self, resource_pool, table=None):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        self.resource_pool = resource_pool
+        self.table = table if table is not None else prices
+        self.quit = False
+        self.heart_beat = time.time()
+        self.polling_interval = config.spot_price_refresh_interval
+
+    def stop(self):
+        log.debug("Waiting for spot price refresher loop to end")
+        self.quit = True
+
+    def run(self):
+        log.info("Starting spot price refresher...")
+        while not self.quit:
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("Unexpected error refreshing spot prices")
+            self.heart_beat = time.time()
+            sleep_tics = self.polling_interval
+            while (not self.quit) and sleep_tics > 0:
+                time.sleep(1)
+                sleep_tics -= 1
+        log.info("Exiting spot price refresher thread")
+
+    def sources(self):
+        """(region, cluster) pairs, one cluster for each endpoint and region."""
+        seen = set()
+        sources = []
+        for cluster in list(self.resource_pool.resources):
+            if getattr(cluster, 'cloud_type', None) != "AmazonEC2":
+                continue
+            key = (cluster.network_address, region_of(cluster))
+            if key in seen:
+                continue
+            seen.add(key)
+            sources.append((region_of(cluster), cluster))
+        return sources
+
+    def refresh(self):
+        """Fetch the prices of every region once."""
+        def refresh_region(source):
+            (region, cluster) = source
+            try:
+                connection = cluster._get_connection()
+                if connection is None:
+                    raise Exception("couldn't connect to %s" % cluster.name)
+                self.table.update(region, fetch(connection))
+                log.verbose("Refreshed spot prices of %s" % region)
+            except Exception, e:
+                log.error("Couldn't refresh spot prices of %s from %s: %s" % (region, cluster.name, e))
+                self.table.failed(region, str(e))
+        utilities.parallel_map(refresh_region, self.sources(), REFRESH_THREADS)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## STATE STORE
+##
+## An embedded SQLite database holding the runtime state that otherwise
+## lives in the persistence pickle, the ban file and memory:
+##   clusters - one row per cluster (pickled without its VMs)
+##   vms      - one row per VM, with the fields cloud_status wants as columns
+##   bans     - one row per banned image / cluster pair
+##   failures - the last ban_min_track boot results per image / cluster
+##
+## Writers never touch the database themselves. Statements are queued and a
+## single writer thread applies everything waiting in one transaction, so a
+## scheduler cycle's changes cost one commit and never wait on the disk.
+## Reads open their own connection; the database runs in WAL mode so they
+## don't block the writer.
+##
+## Enabled by setting state_store_file in cloud_scheduler.conf.
+##
+
+from __future__ import with_statement
+
+import sys
+import time
+import types
+import Queue
+import sqlite3
+import threading
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+from cloudscheduler.persistence import PersistenceJournal
+from cloudscheduler.utilities import ErrTrackQueue
+
+log = utilities.get_cloudscheduler_logger()
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS clusters (pool TEXT, name TEXT, data BLOB, "
+    "PRIMARY KEY (pool, name))",
+    "CREATE TABLE IF NOT EXISTS vms (pool TEXT, cluster TEXT, id TEXT, user TEXT, vmtype TEXT, "
+    "status TEXT, hostname TEXT, updated REAL, data BLOB, PRIMARY KEY (pool, cluster, id))",
+    "CREATE TABLE IF NOT EXISTS bans (image TEXT, cluster TEXT, PRIMARY KEY (image, cluster))",
+    "CREATE TABLE IF NOT EXISTS failures (id INTEGER PRIMARY KEY AUTOINCREMENT, image TEXT, "
+    "cluster TEXT, success INTEGER, time REAL)",
+    "CREATE INDEX IF NOT EXISTS failures_by_pair ON failures (image, cluster, id)",
+]
+
+INSERT_VM = "INSERT OR REPLACE INTO vms (pool, cluster, id, user, vmtype, status, hostname, " \
+            "updated, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+INSERT_CLUSTER = "INSERT OR REPLACE INTO clusters (pool, name, data) VALUES (?, ?, ?)"
+
+
+def vm_row(key, vm, now):
+    """Parameters for INSERT_VM."""
+    return (key[0], key[1], vm.id, vm.user, vm.vmtype, vm.status, vm.hostname, now,
+            sqlite3.Binary(pickle.dumps(vm, pickle.HIGHEST_PROTOCOL)))
+
+
+def cluster_row(key, cluster):
+    """Parameters for INSERT_CLUSTER, the cluster is stored without its VMs.
+
+    Only the cluster's class and pickled state are stored: copying the
+    cluster would go through __setstate__, which invalidates every cached
+    fit (ICluster.capacity_epoch).
+    """
+    state = cluster.__getstate__()
+    state['vms'] = []
+    return (key[0], key[1], sqlite3.Binary(pickle.dumps((cluster.__class__, state), pickle.HIGHEST_PROTOCOL)))
+
+
+def load_cluster(data):
+    """The cluster in an INSERT_CLUSTER row's data, without its VMs."""
+    (cls, state) = pickle.loads(str(data))
+    cluster = types.InstanceType(cls)
+    cluster.__setstate__(state)
+    return cluster
+
+
+class StateStore:
+    """The SQLite state store and its writer thread."""
+
+    def __init__(self, path, batch_size=1000):
+        """Constructor.
+
+        Keywords:
+            path       - the database file, created if it doesn't exist
+            batch_size - most queued writes to apply in a single transaction
+        Raises sqlite3.Error if the database can't be opened.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.saved_bans = set()
+
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+        self.writer = threading.Thread(target=self.run_writer, name="StateStoreWriter")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def run_writer(self):
+        """Apply queued writes, everything waiting at once in one transaction."""
+        connection = self.connect()
+        connection.execute("PRAGMA synchronous=NORMAL")
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                with connection:
+                    for statements in batch:
+                        if statements is None:
+                            stop = True
+                            continue
+                        for (sql, parameters) in statements:
+                            connection.executemany(sql, parameters)
+            except sqlite3.Error, e:
+                log.error("Couldn't write %d changes to the state store %s: %s" % (len(batch), self.path, e))
+            except:
+                log.exception("Unknown problem writing to the state store!")
+            for statements in batch:
+                self.queue.task_done()
+        connection.close()
+
+    def write(self, statements):
+        """Queue a list of (sql, [parameters, ...]) to be applied together."""
+        if statements:
+            self.queue.put(statements)
+
+    def flush(self):
+        """Wait for everything queued so far to be written."""
+        self.queue.join()
+
+    def close(self):
+        """Write what is queued and stop the writer thread."""
+        self.queue.put(None)
+        self.writer.join()
+
+    def query(self, sql, parameters=()):
+        """Rows for a read, after any queued writes have landed."""
+        self.flush()
+        connection = self.connect()
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def replace_resources(self, resources, retired_resources):
+        """Replace every cluster and VM row."""
+        now = time.time()
+        clusters = []
+        vms = []
+        for (pool, cluster_list) in (('resources', resources), ('retired', retired_resources)):
+            for cluster in cluster_list:
+                key = (pool, cluster.name)
+                clusters.append(cluster_row(key, cluster))
+                vms.extend(vm_row(key, vm, now) for vm in list(cluster.vms))
+        self.write([("DELETE FROM vms", [()]), ("DELETE FROM clusters", [()]),
+                    (INSERT_CLUSTER, clusters), (INSERT_VM, vms)])
+
+    def write_records(self, records, clusters):
+        """Apply PersistenceJournal records.
+
+        Keywords:
+            records  - ('vm' | 'remove' | 'cluster', key, value) tuples
+            clusters - dict of key -> cluster, for rewriting changed clusters
+        """
+        now = time.time()
+        statements = []
+        for (kind, key, value) in records:
+            if kind == 'vm':
+                statements.append((INSERT_VM, [vm_row(key, value, now)]))
+            elif kind == 'remove':
+                statements.append(("DELETE FROM vms WHERE pool = ? AND cluster = ? AND id = ?",
+                                   [(key[0], key[1], value)]))
+            elif kind == 'cluster' and key in clusters:
+                statements.append((INSERT_CLUSTER, [cluster_row(key, clusters[key])]))
+        self.write(statements)
+
+    def has_resources(self):
+        return len(self.query("SELECT name FROM clusters LIMIT 1")) > 0
+
+    def load_resources(self):
+        """Rebuild the [resources, retired_resources] lists from the store."""
+        resources = []
+        retired_resources = []
+        clusters = {}
+        for (pool, name, data) in self.query("SELECT pool, name, data FROM clusters ORDER BY rowid"):
+            cluster = load_cluster(data)
+            cluster.vms = []
+            clusters[(pool, name)] = cluster
+            if pool == 'retired':
+                retired_resources.append(cluster)
+            else:
+                resources.append(cluster)
+        for (pool, name, data) in self.query("SELECT pool, cluster, data FROM vms ORDER BY rowid"):
+            if (pool, name) in clusters:
+                clusters[(pool, name)].vms.append(pickle.loads(str(data)))
+        return (resources, retired_resources)
+
+    def vm_rows(self):
+        """The stored VMs as dicts, without unpickling them."""
+        columns = ('pool', 'cluster', 'id', 'user', 'vmtype', 'status', 'hostname', 'updated')
+        rows = self.query("SELECT %s FROM vms ORDER BY cluster, id" % ", ".join(columns))
+        return [dict(zip(columns, row)) for row in rows]
+
+    def save_bans(self, banned_job_resource):
+        """Write the difference between banned_job_resource and the stored bans."""
+        bans = set()
+        for (image, clusters) in banned_job_resource.iteritems():
+            bans.update((image, cluster) for cluster in clusters)
+        self.write([("DELETE FROM bans WHERE image = ? AND cluster = ?", list(self.saved_bans - bans)),
+                    ("INSERT OR REPLACE INTO bans (image, cluster) VALUES (?, ?)", list(bans - self.saved_bans))])
+        self.saved_bans = bans
+
+    def load_bans(self):
+        """The stored bans as an image -> [cluster names] dict."""
+        banned_job_resource = {}
+        bans = set()
+        for (image, cluster) in self.query("SELECT image, cluster FROM bans ORDER BY image, cluster"):
+            banned_job_resource.setdefault(image, []).append(cluster)
+            bans.add((image, cluster))
+        self.saved_bans = bans
+        return banned_job_resource
+
+    def add_failure(self, image, cluster, success):
+        """Record a boot result, keeping the latest ban_min_track for the pair."""
+        self.write([("INSERT INTO failures (image, cluster, success, time) VALUES (?, ?, ?, ?)",
+                     [(image, cluster, int(bool(success)), time.time())]),
+                    ("DELETE FROM failures WHERE image = ? AND cluster = ? AND id NOT IN "
+                     "(SELECT id FROM failures WHERE image = ? AND cluster = ? ORDER BY id DESC LIMIT ?)",
+                     [(image, cluster, image, cluster, config.ban_min_track)])])
+
+    def load_failures(self):
+        """Rebuild ResourcePool.failures, (image, cluster) -> ErrTrackQueue, from the store."""
+        failures = {}
+        for (image, cluster, success) in self.query("SELECT image, cluster, success FROM failures ORDER BY id"):
+            if (image, cluster) not in failures:
+                failures[(image, cluster)] = ErrTrackQueue(cluster)
+            failures[(image, cluster)].append(success)
+        return failures
+
+
+class StoreJournal(PersistenceJournal):
+    """A PersistenceJournal that keeps the VMs in a StateStore instead of files.
+
+    Rows are replaced in place, so there is nothing to compact: a full
+    rewrite only happens when the set of clusters changes.
+    """
+
+    def __init__(self, store):
+        PersistenceJournal.__init__(self, compact_records=sys.maxint)
+        self.store = store
+        self.clusters = {}
+
+    def save(self, resources, retired_resources, compact=False):
+        self.clusters = dict(((pool, cluster.name), cluster)
+                             for (pool, cluster_list) in (('resources', resources), ('retired', retired_resources))
+                             for cluster in cluster_list)
+        records = PersistenceJournal.save(self, resources, retired_resources, compact)
+        if compact:
+            self.store.flush()
+        return records
+
+    def write_records(self, records):
+        self.store.write_records(records, self.clusters)
+
+    def write_snapshot_file(self, resources, retired_resources):
+        self.store.replace_resources(resources, retired_resources)
+
+    def replay(self, resources, retired_resources, generation=None):
+        return 0
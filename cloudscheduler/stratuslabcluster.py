@@ -12,6 +12,7 @@ import base64
 log = utilities.get_cloudscheduler_logger()
 
 
+@cluster_tools.timed_cloud_api
 class StratusLabCluster(cluster_tools.ICluster):
     
     VM_TARGETSTATE = "Running"
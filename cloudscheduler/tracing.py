@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## CYCLE TRACES
+##
+## Timing of the steps inside each cycle of the scheduler threads, so a slow
+## cycle can be pinned on the step that got slow.
+##
+## A thread's run_cycle is decorated with @cycle, which starts a trace for
+## the thread. Inside it, steps are timed as spans, either by decorating the
+## method with @traced, with a "with span(name):" block, or by calling
+## phase(name) between the parts of a long method, which ends the last phase
+## and starts the next one. Spans nest. Outside of a traced cycle they cost
+## a dictionary lookup and record nothing.
+##
+## The last config.trace_history finished traces of each thread are kept for
+## info_server's /traces, which can also give them as Chrome trace event
+## JSON (chrome://tracing, Perfetto or speedscope) for flame views.
+##
+
+from __future__ import with_statement
+
+import time
+import functools
+import threading
+import contextlib
+
+from collections import deque
+from thread import get_ident
+
+import cloudscheduler.config as config
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# A cycle with more spans than this keeps the first ones and counts the rest
+MAX_SPANS = 2000
+
+
+class Trace:
+    """The spans of one cycle of one thread."""
+
+    def __init__(self, thread, name):
+        """Constructor.
+
+        Keywords:
+            thread - the name of the thread running the cycle
+            name   - the name of the cycle, usually the traced method's
+        """
+        self.thread = thread
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+        # (name, start, duration, depth), in the order they ended
+        self.spans = []
+        self.dropped = 0
+        # Open spans and phases, innermost last: [is_phase, name, start]
+        self.stack = []
+
+    def record(self, name, start, end, depth):
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((name, start, end - start, depth))
+        else:
+            self.dropped += 1
+
+    def open(self, name, is_phase=False):
+        self.stack.append([is_phase, name, time.time()])
+
+    def close(self, now):
+        """End the innermost open span or phase."""
+        (is_phase, name, start) = self.stack.pop()
+        self.record(name, start, now, len(self.stack) + 1)
+        return is_phase
+
+    def close_span(self):
+        """End the innermost span, and any phases left open inside it."""
+        now = time.time()
+        while self.stack and self.close(now):
+            pass
+
+    def phase(self, name):
+        if self.stack and self.stack[-1][0]:
+            self.close(time.time())
+        if name:
+            self.open(name, is_phase=True)
+
+    def finish(self, error=None):
+        now = time.time()
+        while self.stack:
+            self.close(now)
+        self.duration = now - self.start
+        self.error = error
+
+    def current(self):
+        """The names of the open spans, outermost first."""
+        return [name for (is_phase, name, start) in list(self.stack)]
+
+    def describe(self):
+        """The spans so far as indented lines, with how long the open ones have been running."""
+        now = time.time()
+        spans = list(self.spans)
+        spans.extend((name, start, None, depth + 1) for (depth, (is_phase, name, start))
+                     in enumerate(list(self.stack)))
+        lines = []
+        for (name, start, duration, depth) in sorted(spans, key=lambda span: (span[1], span[3])):
+            if duration is None:
+                lines.append("%s%s running for %.3fs\n" % ("  " * depth, name, now - start))
+            else:
+                lines.append("%s%s %.3fs\n" % ("  " * depth, name, duration))
+        return ''.join(lines)
+
+    def to_dict(self):
+        spans = sorted(self.spans, key=lambda span: (span[1], span[3]))
+        return {'thread': self.thread, 'name': self.name, 'start': self.start,
+                'duration': self.duration, 'error': self.error, 'dropped': self.dropped,
+                'spans': [{'name': name, 'start': start, 'duration': duration, 'depth': depth}
+                          for (name, start, duration, depth) in spans]}
+
+
+class TraceBuffer:
+    """The recent finished traces of each thread, and the ones in progress."""
+
+    def __init__(self, size=None):
+        """Constructor.
+
+        Keywords:
+            size - traces to keep per thread, defaults to config.trace_history;
+                   0 turns tracing off
+        """
+        self.size = size
+        self.lock = threading.Lock()
+        self.finished = {}
+        # Thread ident -> the Trace of the cycle it's running
+        self.active = {}
+
+    def history(self):
+        if self.size is None:
+            return config.trace_history
+        return self.size
+
+    def begin(self, thread, name):
+        """Start a trace for the current thread. Returns None if tracing is off."""
+        if self.history() <= 0:
+            return None
+        trace = Trace(thread, name)
+        self.active[get_ident()] = trace
+        return trace
+
+    def end(self, trace, error=None):
+        trace.finish(error)
+        self.active.pop(get_ident(), None)
+        with self.lock:
+            traces = self.finished.get(trace.thread)
+            if traces is None or traces.maxlen != self.history():
+                traces = self.finished[trace.thread] = deque(traces or (), maxlen=self.history())
+            traces.append(trace)
+
+    def current(self):
+        """The trace the current thread is running, or None."""
+        return self.active.get(get_ident())
+
+    def running(self, thread):
+        """The trace the threading.Thread thread is running, or None."""
+        return self.active.get(thread.ident)
+
+    def recent(self, thread=None, count=None):
+        """Finished traces, oldest first.
+
+        Keywords:
+            thread - only this thread's, by name
+            count  - only the last count of each thread
+        """
+        with self.lock:
+            if thread is not None:
+                groups = [self.finished.get(thread, ())]
+            else:
+                groups = self.finished.values()
+            traces = []
+            for group in groups:
+                group = list(group)
+                traces.extend(group[-count:] if count else group)
+        return sorted(traces, key=lambda trace: trace.start)
+
+    def clear(self):
+        with self.lock:
+            self.finished = {}
+
+traces = TraceBuffer()
+
+
+def cycle(method):
+    """Decorator tracing each call of a thread's cycle method as one cycle."""
+    @functools.wraps(method)
+    def traced_cycle(self, *args, **kwargs):
+        if traces.current() is not None:
+            return method(self, *args, **kwargs)
+        trace = traces.begin(self.name, method.__name__)
+        if trace is None:
+            return method(self, *args, **kwargs)
+        error = None
+        try:
+            try:
+                return method(self, *args, **kwargs)
+            except Exception, e:
+                error = e.__class__.__name__
+                raise
+        finally:
+            traces.end(trace, error)
+    return traced_cycle
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time the body of the with block as a span called name."""
+    trace = traces.current()
+    if trace is None:
+        yield
+        return
+    trace.open(name)
+    try:
+        yield
+    finally:
+        trace.close_span()
+
+
+def traced(method):
+    """Decorator timing each call of method, inside a traced cycle, as a span."""
+    name = method.__name__
+    @functools.wraps(method)
+    def traced_method(*args, **kwargs):
+        trace = traces.current()
+        if trace is None:
+            return method(*args, **kwargs)
+        trace.open(name)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            trace.close_span()
+    return traced_method
+
+
+def phase(name):
+    """End the current phase of the enclosing span or cycle, and start one called name.
+
+    phase(None) just ends the current one.
+    """
+    trace = traces.current()
+    if trace is not None:
+        trace.phase(name)
+
+
+def chrome_trace(trace_list):
+    """trace_list in the Chrome trace event format, as a dict ready for json.dumps."""
+    events = []
+    tids = {}
+    for trace in trace_list:
+        tid = tids.get(trace.thread)
+        if tid is None:
+            tid = tids[trace.thread] = len(tids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                           'args': {'name': trace.thread}})
+        args = {}
+        if trace.error:
+            args['error'] = trace.error
+        if trace.dropped:
+            args['dropped_spans'] = trace.dropped
+        events.append({'name': trace.name, 'cat': 'cycle', 'ph': 'X', 'pid': 1, 'tid': tid,
+                       'ts': int(trace.start * 1e6), 'dur': int(trace.duration * 1e6),
+                       'args': args})
+        for (name, start, duration, depth) in trace.spans:
+            events.append({'name': name, 'cat': 'step', 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': int(start * 1e6), 'dur': int(duration * 1e6)})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
@@ -6,9 +6,8 @@ import sys
 import socket
 import logging
 import subprocess
-import time
 import gzip
-import errno
+import threading
 from urlparse import urlparse
 from datetime import datetime
 import config
@@ -18,6 +17,7 @@ except ImportError:
     pass
 from cStringIO import StringIO
 from collections import deque
+from collections import OrderedDict
 
 
 def determine_path ():
@@ -46,13 +46,33 @@ class NullHandler(logging.Handler):
         pass
 
 
+class Lazy(object):
+    """A log message argument that is only worked out if the message is
+    written, so a disabled level doesn't pay for it:
+        log.verbose("Required VM types: %s", Lazy(", ".join, vmtypes))
+    """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
 def get_cloudscheduler_logger():
     """Gets a reference to the 'cloudscheduler' log handle."""
-    logging.VERBOSE = LEVELS["VERBOSE"]
-    logging.addLevelName(logging.VERBOSE, "VERBOSE")
     log = logging.getLogger("cloudscheduler")
-    setattr(log, "verbose", lambda *args: log.log(logging.VERBOSE, *args))
-    log.addHandler(NullHandler())
+    if not hasattr(log, "verbose"):
+        logging.VERBOSE = LEVELS["VERBOSE"]
+        logging.addLevelName(logging.VERBOSE, "VERBOSE")
+
+        def verbose(msg, *args, **kwargs):
+            if log.isEnabledFor(logging.VERBOSE):
+                log._log(logging.VERBOSE, msg, args, **kwargs)
+        log.verbose = verbose
+        log.addHandler(NullHandler())
 
     return log
 
@@ -105,6 +125,32 @@ def get_globus_path(executable="grid-proxy-init"):
             return ""
 
 
+# (kind, path, mtime, size, inode) -> what get_cert_DN or get_cert_expiry_time found
+_cert_info = {}
+_cert_info_lock = threading.Lock()
+# Most certificates _cert_info keeps before it starts over
+CERT_INFO_SIZE = 4096
+
+
+def _cached_cert_info(kind, cert_file_path, extract):
+    """extract(cert_file_path), reused until the file changes. Failures aren't kept."""
+    try:
+        info = os.stat(cert_file_path)
+    except (OSError, TypeError):
+        return extract(cert_file_path)
+    key = (kind, cert_file_path, info.st_mtime, info.st_size, info.st_ino)
+    with _cert_info_lock:
+        if key in _cert_info:
+            return _cert_info[key]
+    value = extract(cert_file_path)
+    if value is not None:
+        with _cert_info_lock:
+            if len(_cert_info) >= CERT_INFO_SIZE:
+                _cert_info.clear()
+            _cert_info[key] = value
+    return value
+
+
 def get_cert_DN(cert_file_path):
     """This utility function will extract the subject DN from an x509 certificate.
 
@@ -114,8 +160,14 @@ def get_cert_DN(cert_file_path):
        forked to extract the info out of the certificate.
 
        It requires the openssl package to be installed.
+
+       The subject is kept until the file changes.
        
     """
+    return _cached_cert_info('subject', cert_file_path, _read_cert_DN)
+
+
+def _read_cert_DN(cert_file_path):
     if config.use_pyopenssl:
         try:
             cert_file = open(cert_file_path, 'r')
@@ -128,9 +180,10 @@ def get_cert_DN(cert_file_path):
             log.exception('Error extracting cert subject using pyopenssl.')
             return None
     else:
+        import cloudscheduler.command_runner as command_runner
         openssl_cmd = [config.openssl_path, 'x509', '-in', cert_file_path, '-subject', '-noout']
         try:
-            dn = subprocess.Popen(openssl_cmd, stdout=subprocess.PIPE).communicate()[0].strip()[9:]
+            dn = command_runner.run(openssl_cmd, name="openssl").out.strip()[9:]
             return dn
         except:
             log = get_cloudscheduler_logger()
@@ -149,9 +202,15 @@ def get_cert_expiry_time(cert_file_path):
     the certificate expiry time.  Else a openssl subprocess will be forked to
     extract the info out of the certificate.
 
+    The expiry time is kept until the file changes.
+
     Returns None on error
 
     """
+    return _cached_cert_info('expiry', cert_file_path, _read_cert_expiry_time)
+
+
+def _read_cert_expiry_time(cert_file_path):
     if config.use_pyopenssl:
         try:
             cert_file = open(cert_file_path, 'r')
@@ -166,10 +225,10 @@ def get_cert_expiry_time(cert_file_path):
             log.exception('Error extracting cert expiry time using pyopenssl.')
             return None
     else:
+        import cloudscheduler.command_runner as command_runner
         openssl_cmd = [config.openssl_path, 'x509', '-in', cert_file_path, '-enddate', '-noout']
         try:
-            stdout_stderr = subprocess.Popen(openssl_cmd, stdout=subprocess.PIPE).communicate()
-            datetime_string = stdout_stderr[0].strip().split('=')[1]
+            datetime_string = command_runner.run(openssl_cmd, name="openssl").out.strip().split('=')[1]
             expiry_time = datetime.strptime(datetime_string, '%b %d %H:%M:%S %Y %Z')
             return expiry_time
         except:
@@ -272,16 +331,44 @@ def match_host_with_condor_host_master(hostname, condor_hostname):
 
 
 class ErrTrackQueue():
-    """Error Tracking Queue - Keeps a True/False record of each VM Boot."""
-    def __init__(self, name):
-        """Initializes new queue with the configured length."""
-        self.data = deque(maxlen=10)
+    """Error Tracking Queue - Keeps a True/False record of the latest VM Boots,
+    with running tallies of the successes and failures it holds."""
+    def __init__(self, name, length=None):
+        """Initializes new queue with the configured length (ban_min_track)."""
+        if length is None:
+            length = config.ban_min_track
+        self.data = deque(maxlen=length)
         self.name = name
+        self.successes = 0
+        self.failures = 0
+
+    def append(self, value):
+        """Record a boot, dropping the oldest one from the tallies if full."""
+        value = bool(value)
+        if len(self.data) == self.data.maxlen:
+            if self.data[0]:
+                self.successes -= 1
+            else:
+                self.failures -= 1
+        self.data.append(value)
+        if value:
+            self.successes += 1
+        else:
+            self.failures += 1
+
+    def clear(self):
+        """Forget every recorded boot."""
+        self.data.clear()
+        self.successes = 0
+        self.failures = 0
+
+    def min_use(self):
+        """True once enough boots have been recorded to judge the failure rate."""
+        return len(self.data) >= min(config.ban_min_track, self.data.maxlen)
 
     def dist_true(self):
         """Calculate the distribution of True(succuessful) starts."""
-        tc = sum(self.data)
-        return (float(tc) / float(len(self.data))) if len(self.data) > 0 else 0
+        return (float(self.successes) / float(len(self.data))) if len(self.data) > 0 else 0
 
     def dist_false(self):
         """Calculate the distribution of False(failed) starts."""
@@ -295,6 +382,10 @@ class JobRunTrackQueue():
         self.data = deque(maxlen=10)
         self.name = name
         self.avg = 0
+
+    def append(self, run_time):
+        """Adds a job run-time to the queue."""
+        self.data.append(run_time)
         
     def average(self):
         """"Returns the average run-time of jobs in the queue."""
@@ -304,46 +395,99 @@ class JobRunTrackQueue():
         return self.avg
 
 
-def check_popen_timeout(process, timeout=180):
-    """ Timeout feature for subprocess.Popen - polls the process for timeout seconds waiting for it to complete
-        If the process has exited return False (process did not timeout)
-        Else if the process times out attempt to terminate the process or kill if terminate fails and return True (process timed out)
+def chunks(items, size):
+    """items in consecutive lists of at most size."""
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def parallel_map(function, items, workers):
+    """Call function on each of items from at most workers threads at once.
+
+    Returns the results in the order of items. An exception raised by
+    function is logged and gives None as the result.
     """
     log = get_cloudscheduler_logger()
-    ret = True
-    while timeout > 0:
-        if process.poll() != None:
-            ret = False
-            break
-        time.sleep(1)
-        timeout -= 1
-    if timeout == 0:
-        log.debug("subprocess timed out - attempting to terminate pid %s" % process.pid)
-        try:
-            process.terminate()
-        except OSError, e:
-            if e.errno != errno.ESRCH:
-                raise
-        time.sleep(2) # give OS a chance to terminate
-        if process.poll() == None: # Did not terminate
-            log.debug("terminate() on pid %s failed using kill()" % process.pid)
+    items = list(items)
+    results = [None] * len(items)
+    pending = deque(enumerate(items))
+
+    def worker():
+        while True:
+            try:
+                (index, item) = pending.popleft()
+            except IndexError:
+                return
             try:
-                process.kill()
-            except OSError, e:
-                if e.errno != errno.ESRCH:
-                    raise
-    return ret
+                results[index] = function(item)
+            except Exception:
+                log.exception("Problem running %s" % getattr(function, '__name__', function))
+
+    if workers <= 1 or len(items) <= 1:
+        worker()
+        return results
+    threads = [threading.Thread(target=worker, name="parallel_map-%d" % number)
+               for number in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class LRUCache:
+    """A dictionary holding at most size items, dropping the least recently used."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+# User data -> its compressed form, for VMs booted with the same user data
+_gzipped_userdata = LRUCache(128)
 
 
 def gzip_userdata(user_data):
     # Compress the user data to try and get under the limit
     if not user_data:
         return ""
+    compressed = _gzipped_userdata.get(user_data)
+    if compressed is not None:
+        return compressed
     udbuf = StringIO()
     udf = gzip.GzipFile(mode='wb', fileobj=udbuf)
     try:
         udf.write(user_data)
     finally:
         udf.close()
-    return udbuf.getvalue()
+    compressed = udbuf.getvalue()
+    _gzipped_userdata.put(user_data, compressed)
+    return compressed
 
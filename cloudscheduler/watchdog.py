@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## WATCHDOG
+##
+## Watches the heart beats of the service threads for one that has stopped
+## finishing cycles, say stuck in a cloud API call or condor_q that never
+## returns.
+##
+## A thread is stalled once its last heart beat is more than its polling or
+## scheduling interval plus config.watchdog_stall_time old. The watchdog
+## then logs where the thread is stuck, its stack and the steps of the cycle
+## it is in, sets the thread_stalled metric and puts a 'stall' event on the
+## feed. The diagnostics are kept in stalls and recent_stalls for
+## cloud_status -x. When the thread beats again a 'recover' event follows.
+##
+## With config.watchdog_restart, a stalled thread is also replaced if the
+## restart function given to the Watchdog makes a new one in its place. The
+## old one is told to stop and is marked abandoned. It goes on with its
+## cycle if the call it is stuck in ever returns, so restart only replaces
+## threads that check their quit flag before changing anything, or are safe
+## to run twice; the others are only reported.
+##
+
+from __future__ import with_statement
+
+import time
+import threading
+
+from collections import deque
+
+import cloudscheduler.config as config
+import cloudscheduler.events as events
+import cloudscheduler.metrics as metrics
+import cloudscheduler.profiler as profiler
+import cloudscheduler.tracing as tracing
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+# Seconds between checks of the heart beats
+CHECK_INTERVAL = 10
+# Stalls kept for cloud_status -x after they're over
+RECENT_STALLS = 20
+# Attributes the service threads keep their cycle interval in
+INTERVAL_ATTRIBUTES = ('scheduling_interval', 'polling_interval', 'run_interval')
+
+
+def cycle_interval(thread):
+    """The seconds thread sleeps between cycles, 0 if it doesn't say."""
+    for name in INTERVAL_ATTRIBUTES:
+        interval = getattr(thread, name, None)
+        if interval is not None:
+            return max(interval, 0)
+    return 0
+
+
+def stall_bound(thread):
+    """How old thread's heart beat can get before it is stalled."""
+    return cycle_interval(thread) + config.watchdog_stall_time
+
+
+def diagnose(thread):
+    """Where thread is: its stack, and the steps of its current or last cycle."""
+    output = [profiler.thread_stack(thread)]
+    trace = tracing.traces.running(thread)
+    if trace is not None:
+        output.append("Steps of the %s cycle so far:\n" % trace.name)
+    else:
+        recent = tracing.traces.recent(thread.name, 1)
+        trace = recent and recent[-1]
+        if trace:
+            output.append("Steps of the last %s cycle, which took %.3fs:\n" % (trace.name, trace.duration))
+    if trace:
+        output.append(trace.describe())
+    return ''.join(output)
+
+
+class Stall:
+    """A thread the watchdog found stalled."""
+
+    def __init__(self, thread, age, bound):
+        self.thread = thread.name
+        self.time = time.time()
+        self.age = age
+        self.bound = bound
+        self.diagnostics = diagnose(thread)
+        self.restarted = False
+
+# Thread name -> its Stall, while stalled
+stalls = {}
+# The last RECENT_STALLS stalls, over or not
+recent_stalls = deque(maxlen=RECENT_STALLS)
+
+
+class Watchdog(threading.Thread):
+    """
+    Watchdog - Reports service threads that have stopped finishing cycles,
+               and replaces them if configured to
+    """
+
+    def __init__(self, threads, restart=None):
+        """Constructor.
+
+        Keywords:
+            threads - the list of threads to watch. Replaced threads are
+                      swapped for their replacements in it by restart.
+            restart - function taking a stalled thread that starts a new one
+                      and only then puts it in its place, so nothing watching
+                      threads finds it not yet alive, and returns it, or None
+                      if the thread can't be replaced
+        """
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        self.threads = threads
+        self.restart = restart
+        self.quit = False
+
+    def stop(self):
+        log.debug("Waiting for watchdog loop to end")
+        self.quit = True
+
+    def run(self):
+        log.info("Starting watchdog...")
+        while not self.quit:
+            self.check()
+            sleep_tics = CHECK_INTERVAL
+            while (not self.quit) and sleep_tics > 0:
+                time.sleep(1)
+                sleep_tics -= 1
+        log.info("Exiting watchdog thread")
+
+    def check(self):
+        """Look at each thread's heart beat once."""
+        now = time.time()
+        for thread in list(self.threads):
+            # Threads shutting down can take as long as they need
+            if not thread.is_alive() or getattr(thread, 'quit', False):
+                continue
+            age = now - thread.heart_beat
+            bound = stall_bound(thread)
+            stall = stalls.get(thread.name)
+            if age > bound and stall is None:
+                self.stalled(thread, age, bound)
+            elif age <= bound and stall is not None:
+                self.recovered(thread, stall)
+
+    def stalled(self, thread, age, bound):
+        stall = stalls[thread.name] = Stall(thread, age, bound)
+        recent_stalls.append(stall)
+        log.error("%s thread has not finished a cycle in %ds, expected within %ds. It is at:\n%s"
+                  % (thread.name, age, bound, stall.diagnostics))
+        metrics.thread_stalled.set(1, thread=thread.name)
+        metrics.thread_stalls.inc(thread=thread.name)
+        events.feed.emit('stall', thread=thread.name, age=int(age), bound=bound)
+        if config.watchdog_restart:
+            stall.restarted = self.replace(thread)
+
+    def recovered(self, thread, stall):
+        del stalls[thread.name]
+        log.info("%s thread finished a cycle again, %ds after it was found stalled"
+                 % (thread.name, time.time() - stall.time))
+        metrics.thread_stalled.set(0, thread=thread.name)
+        events.feed.emit('recover', thread=thread.name, age=int(time.time() - stall.time + stall.age))
+
+    def replace(self, thread):
+        """Have restart start a new thread in place of the stalled thread. Returns True if one was started."""
+        replacement = None
+        if self.restart:
+            replacement = self.restart(thread)
+        if replacement is None:
+            log.warning("%s thread can't be restarted, leaving it stalled" % thread.name)
+            return False
+        thread.abandoned = True
+        thread.stop()
+        log.warning("Started a new %s thread in place of the stalled one" % thread.name)
+        metrics.thread_restarts.inc(thread=thread.name)
+        # The replacement's heart beat is new, the stall is over
+        del stalls[thread.name]
+        metrics.thread_stalled.set(0, thread=thread.name)
+        return True
@@ -23,6 +23,8 @@ tests=(
 	"$status -i"                  # GET /ips
 	"$status -l"                  # GET /cloud-config
 	"$status -m"                  # GET /vms
+	"$status -m --status Running --fields id,hostname,status" # GET /vms.json?status=Running&fields=...
+	"$status -m -c $cloud --sort -lastpoll --limit 5"        # GET /vms.json?cloud=$cloud&sort=-lastpoll&limit=5
 	"$status -o"                  # GET /vms?metric=total
 	"$status -o -c $cloud"        # GET /clusters/$cloud/vms?metric=total
 	"$status -q all"              # GET /jobs?state=sched|new|high
@@ -30,6 +32,7 @@ tests=(
 	"$status -q held"             # GET /jobs?state=held
 	"$status -q high"             # GET /jobs?state=high
 	"$status -q idle"             # GET /jobs?state=idle
+	"$status -q idle --user $user --limit 10" # GET /jobs.json?state=idle&user=$user&limit=10
 	"$status -q new"              # GET /jobs?state=new
 	"$status -q running"          # GET /jobs?state=running
 	"$status -q sched"            # GET /jobs?state=sched
@@ -40,6 +43,9 @@ tests=(
 	"$status -v"                  # GET /
 	"$status -w"                  # GET /failures/image
 	"$status -x"                  # GET /thread-heart-beats
+	"$status --traces"            # GET /traces
+	"$status --traces -j"         # GET /traces.json
+	"$status --chrome-trace /tmp/cs-trace.json" # GET /traces/chrome.json
 	"$status -z"                  # GET /failures/boot
 
 	"$admin"
@@ -55,6 +61,9 @@ tests=(
 	"$admin -o -c $cloud -n $vm"          # PUT /clouds/$cloud/vms/$vm?action=force_retire
 	"$admin -o -c $cloud -a"              # PUT /clouds/$cloud/vms?action=force_retire&count=all
 	"$admin -o -c $cloud -b 1"            # PUT /clouds/$cloud/vms?action=force_retire&count=1
+	"$admin --stacks"                     # GET /threads
+	"$admin --profile Scheduler --profile-seconds 2"            # POST /threads/Scheduler/profile
+	"$admin --profile Cleanup --profile-seconds 2 --cprofile"   # POST /threads/Cleanup/profile?mode=cprofile
 	"$admin -q"                           # POST /?action=quick_shutdown
 	"$admin -t"                           # POST /cloud-aliases
 	"$admin -u $user -p job"              # POST /users/$user?refresh=job_proxy
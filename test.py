@@ -2160,6 +2160,1570 @@ xmlns:condor="urn:condor">
         job_pool = cloudscheduler.job_management.JobPool("testpool", condor_query_type="soap")
         self.assertEqual(job_pool.job_query, job_pool.job_query_SOAP)
 
+class FairShareTests(unittest.TestCase):
+
+    def test_shares_exact(self):
+        from fractions import Fraction
+        from cloudscheduler.fairshare import shares
+        dist = shares({'a:t1': 1, 'b:t1': 2})
+        self.assertEqual(dist['a:t1'], Fraction(1, 3))
+        self.assertEqual(dist['b:t1'], Fraction(2, 3))
+        self.assertEqual(sum(dist.values()), 1)
+
+    def test_shares_empty(self):
+        from cloudscheduler.fairshare import shares
+        self.assertEqual(shares({}), {})
+        self.assertEqual(shares({'a:t1': 0}), {})
+
+    def test_shares_match_decimal(self):
+        from decimal import Decimal
+        from cloudscheduler.fairshare import shares
+        counts = {'a:t1': 7, 'b:t1': 11, 'c:t2': 13}
+        total = Decimal(31)
+        for vmtype, share in shares(counts).iteritems():
+            old = counts[vmtype] * (1 / total)
+            self.assertTrue(abs(Decimal(share.numerator) / Decimal(share.denominator) - old) < Decimal('1e-24'))
+            self.assertEqual(int(round(share * 31)), int(round(old * 31)))
+
+    def test_diff_shares(self):
+        from fractions import Fraction
+        from cloudscheduler.fairshare import diff_shares
+        diff = diff_shares({'a:t1': Fraction(1, 2), 'b:t1': Fraction(1, 2)},
+                           {'a:t1': Fraction(1, 4), 'c:t1': Fraction(3, 4)})
+        self.assertEqual(diff['a:t1'], Fraction(1, 4))
+        self.assertEqual(diff['b:t1'], 1)
+        self.assertEqual(diff['c:t1'], Fraction(-3, 4))
+
+    def test_spread_limited(self):
+        from fractions import Fraction
+        from cloudscheduler.fairshare import spread_limited
+        diff = {'a:t1': Fraction(-1, 2), 'b:t1': Fraction(1, 4), 'c:t1': Fraction(1, 4)}
+        spread_limited(diff, set(['a:t1']))
+        self.assertEqual(diff['a:t1'], Fraction(-1, 2))
+        self.assertEqual(diff['b:t1'], 0)
+        self.assertEqual(diff['c:t1'], 0)
+
+    def test_limited_usertypes(self):
+        from cloudscheduler.fairshare import limited_usertypes
+        limited = limited_usertypes(['a:t1', 'a:t2', 'b:t1', 'c:t1'], {'a': 3, 'b': 2, 'c': 1},
+                                    {'a': 3}, {'a:t1': 2, 'a:t2': 1, 'b:t1': 2, 'c:t1': 1},
+                                    {'b:t1': 2, 'c:t1': -1})
+        self.assertEqual(limited, set(['a:t1', 'a:t2', 'b:t1']))
+
+    def test_job_distribution_normal(self):
+        from fractions import Fraction
+        from cloudscheduler.job_management import JobPool, Job
+        job_pool = JobPool("testpool")
+        job_pool.job_container.add_job(Job(GlobalJobId="test#1.0#1", Owner="a", VMType="t1", JobStatus=1))
+        job_pool.job_container.add_job(Job(GlobalJobId="test#2.0#1", Owner="b", VMType="t1", JobStatus=1))
+        job_pool.job_container.add_job(Job(GlobalJobId="test#3.0#1", Owner="c", VMType="t2", JobStatus=1))
+        desired = job_pool.job_usertype_distribution_normal()
+        self.assertEqual(desired['a:t1'], Fraction(1, 3))
+        self.assertEqual(desired['c:t2'], Fraction(1, 3))
+        self.assertEqual(sum(desired.values()), 1)
+
+
+class FitCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.cluster_tools import ICluster
+        (self.configfile, self.configfilename) = tempfile.mkstemp()
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.test_pool.resources = []
+        self.small = ICluster(name="small", memory=2048, vm_slots=2, cpu_cores=2, storage=100)
+        self.big = ICluster(name="big", memory=8192, vm_slots=10, cpu_cores=8, storage=500)
+        self.test_pool.add_resource(self.small)
+        self.test_pool.add_resource(self.big)
+
+    def tearDown(self):
+        os.remove(self.configfilename)
+
+    def test_fit_is_cached(self):
+        fits = self.test_pool.get_fitting_resources(None, 1024, 1, 10, "", "")
+        self.assertEqual(fits, [self.small, self.big])
+        self.test_pool.resources.reverse() # not a capacity change, cache still used
+        self.assertEqual(self.test_pool.get_fitting_resources(None, 1024, 1, 10, "", ""), fits)
+
+    def test_capacity_change_invalidates(self):
+        self.assertEqual(self.test_pool.get_fitting_resources(None, 1024, 1, 10, "", ""), [self.small, self.big])
+        self.small.vm_slots = 0
+        self.assertEqual(self.test_pool.get_fitting_resources(None, 1024, 1, 10, "", ""), [self.big])
+        self.big.enabled = False
+        self.assertEqual(self.test_pool.get_fitting_resources(None, 1024, 1, 10, "", ""), [])
+
+    def test_invalidate_fit_cache(self):
+        self.assertEqual(len(self.test_pool.get_resourceBF(None, 4096, 1, 10, "", "")), 1)
+        self.test_pool.resources.remove(self.big)
+        self.test_pool.invalidate_fit_cache()
+        self.assertEqual(self.test_pool.get_resourceBF(None, 4096, 1, 10, "", ""), [])
+
+    def test_cached_list_is_a_copy(self):
+        fits = self.test_pool.get_resourceBF(None, 1024, 1, 10, "", "")
+        fits.pop()
+        self.assertEqual(len(self.test_pool.get_resourceBF(None, 1024, 1, 10, "", "")), 2)
+
+
+class PlacementTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.cluster_tools import ICluster
+        self.roomy = ICluster(name="roomy", memory=8192, vm_slots=4, storage=100)
+        self.tight = ICluster(name="tight", memory=2048, vm_slots=1, storage=100)
+
+    def request(self, user, candidates, diff=-1, memory=1024):
+        from cloudscheduler.job_management import Job
+        from cloudscheduler.placement import PlacementRequest
+        job = Job(GlobalJobId="test#%s.0#1" % user, Owner=user, VMType="t1", VMMem=memory)
+        return PlacementRequest(user, job, candidates, diff)
+
+    def test_lookahead_keeps_sole_fit_free(self):
+        from cloudscheduler.placement import solve
+        # 'a' prefers tight but is the only fit for 'b', so 'a' goes to roomy
+        a = self.request("a", [self.tight, self.roomy])
+        b = self.request("b", [self.tight])
+        placed = dict((request.user, clusters[0]) for request, clusters in solve([a, b]))
+        self.assertEqual(placed["a"], self.roomy)
+        self.assertEqual(placed["b"], self.tight)
+
+    def test_under_allocated_first(self):
+        from cloudscheduler.placement import solve
+        requests = [self.request("over", [self.tight], diff=1), self.request("under", [self.tight], diff=-1)]
+        placements = solve(requests)
+        self.assertEqual(len(placements), 1)
+        self.assertEqual(placements[0][0].user, "under")
+
+    def test_limits(self):
+        from cloudscheduler.placement import solve
+        requests = [self.request("a", [self.roomy]), self.request("a", [self.roomy]), self.request("b", [self.roomy])]
+        self.assertEqual(len(solve(requests, user_allowance={"a": 1})), 2)
+        self.assertEqual(len(solve(requests, max_vms=1)), 1)
+
+    def test_memory_capacity(self):
+        from cloudscheduler.placement import solve
+        requests = [self.request(user, [self.roomy], memory=3072) for user in ("a", "b", "c")]
+        self.assertEqual(len(solve(requests)), 2)
+
+
+class PersistenceJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.cluster_tools import ICluster, VM
+        from cloudscheduler.persistence import PersistenceJournal
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "persistence")
+        self.journal = PersistenceJournal(self.path, compact_records=10)
+        self.cluster = ICluster(name="cloud", memory=8192, vm_slots=4, storage=100)
+        self.vm = VM(id="vm-1", vmtype="type", user="user", memory=1024)
+        self.cluster.vms.append(self.vm)
+        self.resources = [self.cluster]
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        import cPickle
+        (resources, retired, generation) = cPickle.load(open(self.path, "rb"))
+        self.journal.replay(resources, retired, generation)
+        return resources[0]
+
+    def test_only_changes_are_journaled(self):
+        self.journal.save(self.resources, [])
+        self.assertEqual(self.journal.save(self.resources, []), 0)
+        self.vm.lastpoll = 1234
+        self.assertEqual(self.journal.save(self.resources, []), 0)
+        self.vm.status = "Running"
+        self.assertEqual(self.journal.save(self.resources, []), 1)
+        self.assertEqual(self.load().vms[0].status, "Running")
+
+    def test_membership_changes(self):
+        from cloudscheduler.cluster_tools import VM
+        self.journal.save(self.resources, [])
+        self.cluster.vms.append(VM(id="vm-2"))
+        self.cluster.vms.remove(self.vm)
+        self.cluster.enabled = False
+        self.assertEqual(self.journal.save(self.resources, []), 3)
+        cluster = self.load()
+        self.assertEqual([vm.id for vm in cluster.vms], ["vm-2"])
+        self.assertFalse(cluster.enabled)
+
+    def test_damaged_tail_is_skipped(self):
+        self.journal.save(self.resources, [])
+        self.vm.status = "Running"
+        self.journal.save(self.resources, [])
+        self.vm.status = "Error"
+        self.journal.save(self.resources, [])
+        journal = open(self.path + ".journal", "rb+")
+        journal.truncate(os.path.getsize(self.path + ".journal") - 5)
+        journal.close()
+        self.assertEqual(self.load().vms[0].status, "Running")
+
+    def test_compaction(self):
+        self.journal.save(self.resources, [])
+        for n in range(12):
+            self.vm.errorcount = n
+            self.journal.save(self.resources, [])
+        self.assertTrue(self.journal.records < 10)
+        self.assertEqual(self.load().vms[0].errorcount, 11)
+        self.journal.save(self.resources, [], compact=True)
+        self.assertFalse(os.path.exists(self.path + ".journal"))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_stale_journal_is_skipped(self):
+        import shutil
+        from cloudscheduler.cluster_tools import VM
+        self.journal.save(self.resources, [])
+        self.cluster.vms.append(VM(id="vm-2"))
+        self.vm.status = "Running"
+        self.journal.save(self.resources, [])
+        shutil.copy(self.path + ".journal", self.path + ".old")
+        # A crash between the new snapshot's rename and the journal's removal
+        self.cluster.vms.pop()
+        self.vm.status = "Error"
+        self.journal.save(self.resources, [], compact=True)
+        os.rename(self.path + ".old", self.path + ".journal")
+        cluster = self.load()
+        self.assertEqual([(vm.id, vm.status) for vm in cluster.vms], [("vm-1", "Error")])
+
+
+class FailureTrackingTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.cluster_tools import ICluster
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        (fd, self.ban_file) = tempfile.mkstemp()
+        os.close(fd)
+        self.old_ban_file = cloudscheduler.config.ban_file
+        cloudscheduler.config.ban_file = self.ban_file
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.cloud = ICluster(name="cloud")
+        self.other = ICluster(name="other")
+
+    def tearDown(self):
+        cloudscheduler.config.ban_file = self.old_ban_file
+        os.remove(self.configfilename)
+        os.remove(self.ban_file)
+
+    def job(self):
+        from cloudscheduler.job_management import Job
+        return Job(GlobalJobId="test#1.0#1", Owner="user", VMType="t1", VMAMI={"other": "ami-2", "default": "ami-1"})
+
+    def test_rolling_tallies(self):
+        queue = utilities.ErrTrackQueue("cloud", length=3)
+        for value in (True, False, False, True, False):
+            queue.append(value)
+        self.assertEqual((queue.successes, queue.failures), (1, 2))
+        self.assertAlmostEqual(queue.dist_false(), 2.0 / 3)
+        queue.clear()
+        self.assertEqual((queue.successes, queue.failures, len(queue.data)), (0, 0, 0))
+
+    def test_ban_after_failures(self):
+        job = self.job()
+        for n in range(cloudscheduler.config.ban_min_track):
+            self.test_pool.track_failures(job, [self.cloud, self.other], False)
+        self.assertEqual(len(self.test_pool.failures), 2)
+        self.assertTrue(("ami-2", "other") in self.test_pool.failures)
+        self.test_pool.check_failures()
+        self.assertEqual(self.test_pool.banned_pairs, set([("ami-1", "cloud"), ("ami-2", "other")]))
+        self.assertEqual(len(self.test_pool.ban_events), 2)
+        self.assertEqual(self.test_pool.failures_touched, set())
+
+    def test_success_prevents_ban(self):
+        job = self.job()
+        self.test_pool.track_failures(job, [self.cloud], True)
+        for n in range(cloudscheduler.config.ban_min_track - 1):
+            self.test_pool.track_failures(job, [self.cloud], False)
+        self.test_pool.check_failures()
+        self.assertEqual(self.test_pool.banned_pairs, set())
+
+    def test_lifted_ban_resets_failures(self):
+        job = self.job()
+        for n in range(cloudscheduler.config.ban_min_track):
+            self.test_pool.track_failures(job, [self.cloud], False)
+        self.test_pool.check_failures()
+        open(self.ban_file, "w").write("{}")
+        self.test_pool.load_banned_job_resource()
+        self.assertEqual(self.test_pool.banned_pairs, set())
+        self.assertEqual(len(self.test_pool.failures[("ami-1", "cloud")].data), 0)
+
+
+class StateStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.cluster_tools import ICluster, VM
+        from cloudscheduler.state_store import StateStore, StoreJournal
+        self.directory = tempfile.mkdtemp()
+        self.store = StateStore(os.path.join(self.directory, "state.db"))
+        self.journal = StoreJournal(self.store)
+        self.cluster = ICluster(name="cloud", memory=8192, vm_slots=4, storage=100)
+        self.vm = VM(id="vm-1", vmtype="type", user="user", memory=1024)
+        self.cluster.vms.append(self.vm)
+
+    def tearDown(self):
+        import shutil
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def test_vms(self):
+        from cloudscheduler.cluster_tools import VM
+        self.assertFalse(self.store.has_resources())
+        self.journal.save([self.cluster], [])
+        self.vm.status = "Running"
+        self.cluster.vms.append(VM(id="vm-2", user="other"))
+        self.journal.save([self.cluster], [])
+        (resources, retired) = self.store.load_resources()
+        self.assertEqual(retired, [])
+        self.assertEqual(resources[0].name, "cloud")
+        self.assertEqual([(vm.id, vm.status) for vm in resources[0].vms], [("vm-1", "Running"), ("vm-2", "Starting")])
+        self.assertEqual([row['user'] for row in self.store.vm_rows()], ["user", "other"])
+
+    def test_cluster_rows_keep_fit_cache(self):
+        from cloudscheduler.cluster_tools import ICluster
+        self.journal.save([self.cluster], [])
+        self.cluster.enabled = False
+        epoch = ICluster.capacity_epoch
+        self.journal.save([self.cluster], [])
+        self.assertEqual(ICluster.capacity_epoch, epoch)
+        self.assertEqual(len(self.cluster.vms), 1)
+        (resources, retired) = self.store.load_resources()
+        self.assertFalse(resources[0].enabled)
+        self.assertEqual(resources[0].memory, 8192)
+
+    def test_ban_file_imported(self):
+        (fd, configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        (fd, ban_file) = tempfile.mkstemp()
+        os.write(fd, '{"image-a": ["cloud"]}')
+        os.close(fd)
+        old = (cloudscheduler.config.ban_file, cloudscheduler.config.state_store_file)
+        cloudscheduler.config.ban_file = ban_file
+        cloudscheduler.config.state_store_file = os.path.join(self.directory, "pool.db")
+        try:
+            pool = cloudscheduler.cloud_management.ResourcePool(configfilename, "Test Pool")
+            pool.load_banned_job_resource()
+            self.assertEqual(pool.banned_job_resource, {"image-a": ["cloud"]})
+            pool.state_store.flush()
+            self.assertEqual(pool.state_store.load_bans(), {"image-a": ["cloud"]})
+            pool.state_store.close()
+        finally:
+            (cloudscheduler.config.ban_file, cloudscheduler.config.state_store_file) = old
+            os.remove(configfilename)
+            os.remove(ban_file)
+
+    def test_bans(self):
+        self.store.save_bans({"image-a": ["cloud", "other"]})
+        self.store.save_bans({"image-a": ["cloud"], "image-b": ["other"]})
+        self.assertEqual(self.store.load_bans(), {"image-a": ["cloud"], "image-b": ["other"]})
+
+    def test_failures(self):
+        kept = cloudscheduler.config.ban_min_track
+        for n in range(kept + 5):
+            self.store.add_failure("image", "cloud", n % 2)
+        failures = self.store.load_failures()
+        self.assertEqual(failures[("image", "cloud")].name, "cloud")
+        self.assertEqual(len(failures[("image", "cloud")].data), kept)
+        self.assertEqual(len(self.store.query("SELECT id FROM failures")), kept)
+
+
+class ReconcileTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.simulator import DummyCluster
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.test_pool.resources = []
+        self.test_pool.retired_resources = []
+        self.cloud = DummyCluster("cloud", 4, boot_latency=0)
+        self.test_pool.add_resource(self.cloud)
+        for n in range(2):
+            self.cloud.vm_create("image", "type", "user", "image", 1024, 1, 10)
+
+    def tearDown(self):
+        os.remove(self.configfilename)
+
+    def test_vms_matched_by_id(self):
+        (kept, gone) = self.cloud.vms
+        del self.cloud.boots[gone.id]
+        self.assertFalse(self.test_pool.state_ready.is_set())
+        self.test_pool.reconcile_persisted_vms()
+        self.assertTrue(self.test_pool.wait_for_state_ready(0))
+        self.assertEqual(kept.status, "Running")
+        self.assertTrue(kept.lastpoll)
+        self.assertEqual(gone.status, "Error")
+        self.assertEqual(gone.errorcount, cloudscheduler.config.polling_error_threshold)
+
+    def test_startup_destroys(self):
+        vm = self.cloud.vms[0]
+        self.test_pool.startup_destroys.append((self.cloud, vm, True, "test"))
+        self.test_pool.reconcile_persisted_vms()
+        self.assertEqual(len(self.cloud.vms), 1)
+        self.assertFalse(vm in self.cloud.vms)
+        self.assertEqual(self.test_pool.startup_destroys, [])
+
+
+class ReconfigTests(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        self.write_config({'a': 10, 'b': 10})
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+
+    def tearDown(self):
+        os.remove(self.configfilename)
+
+    def write_config(self, clouds):
+        testconfig = ConfigParser.RawConfigParser()
+        for (name, vm_slots) in sorted(clouds.items()):
+            testconfig.add_section(name)
+            for (option, value) in (('host', 'cloud.example.com'), ('cloud_type', 'AmazonEC2'),
+                                    ('vm_slots', vm_slots), ('cpu_cores', 4), ('storage', 1000),
+                                    ('memory', 2048 * vm_slots), ('regions', 'r1'), ('security_group', 'default'),
+                                    ('access_key_id', 'key'), ('secret_access_key', 'secret')):
+                testconfig.set(name, option, value)
+        configfile = open(self.configfilename, 'wb')
+        testconfig.write(configfile)
+        configfile.close()
+
+    def test_diff(self):
+        from cloudscheduler.cluster_tools import VM
+        (a, b) = (self.test_pool.get_cluster('a'), self.test_pool.get_cluster('b'))
+        a.enabled = b.enabled = True
+        vm = VM(id="vm-1", memory=2048)
+        b.resource_checkout(vm)
+        b.vms.append(vm)
+        self.write_config({'a': 10, 'b': 20, 'c': 5})
+        self.test_pool.setup()
+        self.assertEqual([cluster.name for cluster in self.test_pool.resources], ['a', 'b', 'c'])
+        # Unchanged and changed clusters are the same objects, still enabled, with their VMs
+        self.assertTrue(self.test_pool.get_cluster('a') is a)
+        self.assertTrue(self.test_pool.get_cluster('b') is b)
+        self.assertTrue(b.enabled and b.vms == [vm])
+        self.assertEqual((b.max_slots, b.vm_slots, b.max_mem, b.memory), (20, 19, 40960, 38912))
+        self.assertFalse(self.test_pool.get_cluster('c').enabled)
+        b.resource_return(vm)
+        self.assertEqual(b.vm_slots, 20)
+
+    def test_shrink_and_remove(self):
+        from cloudscheduler.cluster_tools import VM
+        (a, b) = (self.test_pool.get_cluster('a'), self.test_pool.get_cluster('b'))
+        for n in range(3):
+            vm = VM(id="vm-%d" % n, memory=2048)
+            b.resource_checkout(vm)
+            b.vms.append(vm)
+        self.write_config({'b': 2})
+        self.test_pool.setup()
+        self.assertEqual([cluster.name for cluster in self.test_pool.resources], ['b'])
+        self.assertTrue(self.test_pool.retired_resources[-1] is a)
+        self.test_pool.retired_resources.remove(a)
+        # Over capacity, but its VMs are left to finish
+        self.assertEqual((b.vm_slots, len(b.vms)), (-1, 3))
+
+
+class CondorControlTests(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.directory = tempfile.mkdtemp()
+        self.runs = os.path.join(self.directory, "runs")
+        # Says it sent the command to each -addr but the bad ones
+        self.command = os.path.join(self.directory, "condor_off")
+        script = open(self.command, "w")
+        script.write("#!/bin/sh\n"
+                     "echo \"$@\" >> %s\n"
+                     "while [ $# -gt 0 ]; do\n"
+                     "  if [ \"$1\" = -addr ]; then\n"
+                     "    case \"$2\" in *bad*) echo \"Can't find address for $2\" >&2 ;;\n"
+                     "      *) echo \"Sent \\\"Set-Peaceful-Shutdown\\\" command to $2\" ;; esac\n"
+                     "    shift\n"
+                     "  fi\n"
+                     "  shift\n"
+                     "done\n" % self.runs)
+        script.close()
+        os.chmod(self.command, 0755)
+        self.old_config = (cloudscheduler.config.condor_off_command, cloudscheduler.config.cloudscheduler_ssh_key,
+                           cloudscheduler.config.condor_control_batch_size, cloudscheduler.config.condor_control_threads)
+        cloudscheduler.config.condor_off_command = self.command
+        cloudscheduler.config.cloudscheduler_ssh_key = ""
+        cloudscheduler.config.condor_control_batch_size = 2
+        cloudscheduler.config.condor_control_threads = 2
+
+    def tearDown(self):
+        import shutil
+        (cloudscheduler.config.condor_off_command, cloudscheduler.config.cloudscheduler_ssh_key,
+         cloudscheduler.config.condor_control_batch_size, cloudscheduler.config.condor_control_threads) = self.old_config
+        shutil.rmtree(self.directory)
+        os.remove(self.configfilename)
+
+    def test_condor_off_batch(self):
+        machines = [("vm%d" % n, "<10.0.0.%d:9618>" % n, "<10.0.0.%d:9620>" % n) for n in range(4)]
+        machines.append(("vm-bad", "<bad:9618>", "<10.0.0.9:9620>"))
+        machines.append(("vm-none", None, "<10.0.0.8:9620>"))
+        self.assertEqual(self.test_pool.do_condor_off_batch(machines), [True] * 4 + [False, False])
+        runs = open(self.runs).read().splitlines()
+        # 5 machines in batches of 2, a startd and a master run each
+        self.assertEqual(len(runs), 6)
+        self.assertTrue("-peaceful -subsystem startd -addr <10.0.0.0:9618> -addr <10.0.0.1:9618>" in runs)
+        self.assertEqual(self.test_pool.do_condor_off("vm1", "<10.0.0.1:9618>", "<10.0.0.1:9620>"), (0, 0, 0, 0))
+
+    def test_ssh_args(self):
+        cloudscheduler.config.cloudscheduler_ssh_key = "/key"
+        old = (cloudscheduler.config.condor_webservice_url, cloudscheduler.config.ssh_control_persist)
+        cloudscheduler.config.condor_webservice_url = "http://cm.example.org:8080"
+        try:
+            cloudscheduler.config.ssh_control_persist = 300
+            args = cloudscheduler.cloud_management.condor_command_args(["condor_off", "-addr", "<10.0.0.1:9618>"])
+            self.assertEqual(args[-2:], ["cm.example.org", "condor_off -addr '<10.0.0.1:9618>'"])
+            self.assertTrue("ControlMaster=auto" in args and "ControlPersist=300" in args)
+            cloudscheduler.config.ssh_control_persist = 0
+            args = cloudscheduler.cloud_management.condor_command_args(["condor_off"])
+            self.assertFalse("ControlMaster=auto" in args)
+        finally:
+            (cloudscheduler.config.condor_webservice_url, cloudscheduler.config.ssh_control_persist) = old
+
+    def test_parallel_map(self):
+        self.assertEqual(utilities.chunks(range(5), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual(utilities.parallel_map(lambda n: 10 / n, [5, 0, 2], 3), [2, None, 5])
+
+
+class CommandRunnerTests(unittest.TestCase):
+
+    def test_run(self):
+        from cloudscheduler import command_runner, metrics
+        runs = metrics.command_seconds.count(command="sh")
+        result = command_runner.run(["sh", "-c", "echo out; echo err >&2; exit 3"])
+        self.assertEqual((result.returncode, result.out, result.err, result.error), (3, "out\n", "err\n", None))
+        self.assertFalse(result.ok())
+        self.assertEqual(metrics.command_seconds.count(command="sh"), runs + 1)
+        result = command_runner.run(["/nonexistent/command"])
+        self.assertEqual((result.returncode, result.error), (-1, 'start'))
+
+    def test_timeout_and_limit(self):
+        import time
+        from cloudscheduler import command_runner, metrics
+        timeouts = metrics.command_failures.get(command="sleep", reason="timeout")
+        start = time.time()
+        result = command_runner.run(["sleep", "30"], timeout=0.2)
+        self.assertEqual(result.error, 'timeout')
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(metrics.command_failures.get(command="sleep", reason="timeout"), timeouts + 1)
+        result = command_runner.run(["head", "-c", "100000", "/dev/zero"], output_limit=1000)
+        self.assertEqual(result.error, 'output_limit')
+        # A background child holding the output open doesn't hold up the result
+        start = time.time()
+        result = command_runner.run(["sh", "-c", "sleep 30 & echo started"])
+        self.assertEqual((result.returncode, result.out), (0, "started\n"))
+        self.assertTrue(time.time() - start < 5)
+
+    def test_futures(self):
+        from cloudscheduler import command_runner
+        futures = [command_runner.submit(["sh", "-c", "sleep 0.2; echo %d" % n]) for n in range(20)]
+        done = []
+        futures[0].add_done_callback(done.append)
+        self.assertEqual([future.result().out for future in futures], ["%d\n" % n for n in range(20)])
+        self.assertEqual(done, [futures[0]])
+        self.assertTrue(futures[-1].done())
+
+
+class JobHoldTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.job_management import Job, JobPool
+        self.job_pool = JobPool("testpool")
+        self.jobs = [Job(GlobalJobId="test#%d.0#1" % n, Owner="a", ClusterId=n) for n in range(5)]
+        self.directory = tempfile.mkdtemp()
+        self.runs = os.path.join(self.directory, "runs")
+        # Holds the jobs given by id but 3.0, and the jobs of a constraint naming "a"
+        self.command = os.path.join(self.directory, "condor_hold")
+        script = open(self.command, "w")
+        script.write("#!/bin/sh\n"
+                     "echo \"$@\" >> %s\n"
+                     "status=0\n"
+                     "for arg in \"$@\"; do\n"
+                     "  case \"$arg\" in\n"
+                     "    *Owner*) case \"$arg\" in *\\\"a\\\"*) exit 0 ;; *) exit 1 ;; esac ;;\n"
+                     "    3.0) echo \"Couldn't find/hold job 3.0.\" >&2; status=1 ;;\n"
+                     "    *.0) echo \"Job $arg held\" ;;\n"
+                     "  esac\n"
+                     "done\n"
+                     "exit $status\n" % self.runs)
+        script.close()
+        os.chmod(self.command, 0755)
+        self.old_config = (cloudscheduler.config.condor_hold_command, cloudscheduler.config.condor_job_batch_size)
+        cloudscheduler.config.condor_hold_command = self.command
+        cloudscheduler.config.condor_job_batch_size = 2
+
+    def tearDown(self):
+        import shutil
+        (cloudscheduler.config.condor_hold_command, cloudscheduler.config.condor_job_batch_size) = self.old_config
+        shutil.rmtree(self.directory)
+
+    def test_hold_by_id(self):
+        failed = self.job_pool.job_hold_local(self.jobs, reason="Testing")
+        self.assertEqual(failed, [self.jobs[3]])
+        runs = open(self.runs).read().splitlines()
+        self.assertEqual(sorted(runs), ["-reason Testing 0.0 1.0", "-reason Testing 2.0 3.0", "-reason Testing 4.0"])
+        self.assertEqual(self.job_pool.job_hold_local([]), [])
+
+    def test_hold_by_constraint(self):
+        from cloudscheduler.job_management import classad_string
+        self.assertEqual(classad_string('a"b\\'), '"a\\"b\\\\"')
+        self.assertEqual(self.job_pool.job_hold_local(self.jobs, constraint="Owner == %s" % classad_string("a")), [])
+        self.assertEqual(len(open(self.runs).read().splitlines()), 1)
+        # A failed constraint falls back to the ids
+        failed = self.job_pool.job_hold_local(self.jobs, constraint="Owner == %s" % classad_string("b"))
+        self.assertEqual(failed, [self.jobs[3]])
+        self.assertEqual(len(open(self.runs).read().splitlines()), 5)
+
+    def test_hold_bad_image(self):
+        import re
+        from cloudscheduler import simulator
+        from cloudscheduler.job_management import JobPool
+        ads = []
+        for (n, ami) in ((10, "cloud:ami-1, default:ami-2"), (11, "ami-3")):
+            ads.append('GlobalJobId = "test#%d.0#1"\nOwner = "a"\nClusterId = %d\nProcId = 0\nJobStatus = 1\n'
+                       'VMAMI = "%s"\nRequirements = ( VMType =?= "t1" )' % (n, n, ami))
+        jobs = JobPool._condor_q_to_job_list("\n\n".join(ads))
+        self.job_pool.update_jobs(jobs)
+        daemon = simulator.load_daemon()
+        daemon.VMPoller(None, self.job_pool).handle_bad_image("a", "ami-2")
+        self.assertEqual([(job.banned, job.override_status) for job in jobs], [(True, "HTTPFail"), (False, None)])
+        (run,) = open(self.runs).read().splitlines()
+        constraint = run.split("-constraint ", 1)[1]
+        self.assertTrue(constraint.startswith('Owner == "a" && JobStatus != 5 && regexp('))
+        # The same jobs by the regular expression the constraint gives condor_hold
+        pattern = re.search(r'regexp\("(.*)", VMAMI\)', constraint).group(1).decode('string_escape')
+        self.assertTrue(re.search(pattern, "cloud:ami-1, default:ami-2"))
+        self.assertTrue(re.search(pattern, "ami-2"))
+        self.assertFalse(re.search(pattern, "ami-3") or re.search(pattern, "ami-2x:ami-1"))
+
+
+class ProxyRefreshTests(unittest.TestCase):
+
+    def setUp(self):
+        import datetime
+        from cloudscheduler.job_management import Job
+        self.directory = tempfile.mkdtemp()
+        self.runs = os.path.join(self.directory, "runs")
+        expiry = (datetime.datetime.utcnow() + datetime.timedelta(seconds=60)).strftime('%b %d %H:%M:%S %Y GMT')
+        self.openssl = self.script("openssl", "echo openssl >> %s\necho 'notAfter=%s'\n" % (self.runs, expiry))
+        # Writes the renewed proxy to the file after -o
+        self.myproxy = self.script("myproxy-logon", "echo myproxy >> %s\n"
+                                   "while [ $# -gt 0 ]; do [ \"$1\" = -o ] && echo renewed > \"$2\"; shift; done\n" % self.runs)
+        self.proxies = []
+        for name in ("a", "b"):
+            proxy = os.path.join(self.directory, "proxy_" + name)
+            open(proxy, "w").write("proxy\n")
+            self.proxies.append(proxy)
+        self.jobs = [Job(GlobalJobId="test#%d.0#1" % n, Owner="a", x509userproxy=self.proxies[0],
+                         CSMyProxyCredsName="creds" if n == 2 else None) for n in range(3)]
+        self.jobs += [Job(GlobalJobId="test#%d.0#1" % n, Owner="b", x509userproxy=self.proxies[1]) for n in range(3, 5)]
+        self.old_config = (cloudscheduler.config.openssl_path, cloudscheduler.config.myproxy_logon_command,
+                           cloudscheduler.config.use_pyopenssl)
+        cloudscheduler.config.openssl_path = self.openssl
+        cloudscheduler.config.myproxy_logon_command = self.myproxy
+        cloudscheduler.config.use_pyopenssl = False
+        utilities._cert_info.clear()
+
+    def tearDown(self):
+        import shutil
+        (cloudscheduler.config.openssl_path, cloudscheduler.config.myproxy_logon_command,
+         cloudscheduler.config.use_pyopenssl) = self.old_config
+        utilities._cert_info.clear()
+        shutil.rmtree(self.directory)
+
+    def script(self, name, body):
+        path = os.path.join(self.directory, name)
+        open(path, "w").write("#!/bin/sh\n" + body)
+        os.chmod(path, 0755)
+        return path
+
+    def runs_of(self, command):
+        if not os.path.exists(self.runs):
+            return 0
+        return open(self.runs).read().split().count(command)
+
+    def test_cert_info_cached(self):
+        first = utilities.get_cert_expiry_time(self.proxies[0])
+        self.assertEqual(utilities.get_cert_expiry_time(self.proxies[0]), first)
+        self.assertEqual(self.runs_of("openssl"), 1)
+        open(self.proxies[0], "a").write("changed\n")
+        utilities.get_cert_expiry_time(self.proxies[0])
+        self.assertEqual(self.runs_of("openssl"), 2)
+
+    def test_renewed_once_per_proxy(self):
+        from cloudscheduler import proxy_refreshers
+        groups = proxy_refreshers.group_by_proxy(self.jobs, lambda job: job.get_x509userproxy())
+        self.assertEqual([(path, len(group)) for (path, group) in groups], [(self.proxies[0], 3), (self.proxies[1], 2)])
+        self.assertEqual(proxy_refreshers.refresh_proxies(self.jobs, lambda job: job.get_x509userproxy(), "job"), 1)
+        # One renewal for the proxy with MyProxy info, none for the other
+        self.assertEqual(self.runs_of("myproxy"), 1)
+        self.assertEqual(open(self.proxies[0]).read(), "renewed\n")
+        self.assertEqual(self.runs_of("openssl"), 2)
+        self.assertEqual([job.x509userproxy_expiry_time for job in self.jobs[:3]], [None] * 3)
+
+
+class UserDataCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.write(fd, "#cloud-config\nmerge_type: 'list(append)'\nwrite_files:\n-   path: /etc/motd\n")
+        os.close(fd)
+        self.old_ttl = cloudscheduler.config.content_cache_ttl
+
+    def tearDown(self):
+        from cloudscheduler import content_cache
+        cloudscheduler.config.content_cache_ttl = self.old_ttl
+        content_cache.contents.forget()
+        os.remove(self.path)
+
+    def test_file_revalidated(self):
+        from cloudscheduler import content_cache
+        first = content_cache.read(self.path)
+        self.assertTrue(content_cache.read(self.path) is first)
+        open(self.path, "a").write("runcmd: []\n")
+        self.assertTrue(content_cache.read(self.path).endswith("runcmd: []\n"))
+
+    def test_size_is_bounded(self):
+        from cloudscheduler import content_cache
+        contents = content_cache.ContentCache(size=2)
+        first = contents.read(self.path)
+        for n in range(2):
+            contents.store("http://example.org/%d" % n, content_cache.Entry("x"))
+        self.assertEqual(len(contents.entries), 2)
+        self.assertFalse(contents.read(self.path) is first)
+
+    def test_is_url(self):
+        from cloudscheduler import content_cache
+        self.assertTrue(content_cache.is_url("https://example.org/user.yaml"))
+        self.assertTrue(content_cache.is_url("HTTP://example.org/user.yaml"))
+        self.assertFalse(content_cache.is_url(self.path))
+        self.assertFalse(content_cache.is_url("httpd.conf"))
+        self.assertFalse(content_cache.is_url("file:///etc/passwd"))
+
+    def test_url_revalidated(self):
+        import threading
+        import BaseHTTPServer
+        from cloudscheduler import content_cache
+        requests = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.headers.getheader('If-None-Match'))
+                if self.headers.getheader('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                self.wfile.write("#cloud-config\n")
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d/user.yaml" % server.server_port
+            cloudscheduler.config.content_cache_ttl = 60
+            first = content_cache.read(url)
+            self.assertTrue(content_cache.read(url) is first)
+            self.assertEqual(requests, [None])
+            cloudscheduler.config.content_cache_ttl = 0
+            self.assertTrue(content_cache.read(url) is first)
+            self.assertEqual(requests, [None, '"v1"'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_rendering_reused(self):
+        from cloudscheduler import cloud_init_util
+        pre = [open(self.path).read()]
+        tasks = [("cert", "/etc/cert"), ("key", "/etc/key", "'0600'"), ("cloud-a", "/var/lib/cloud_name")]
+        user_data = cloud_init_util.inject_customizations(pre, cloud_init_util.build_write_files_cloud_init(tasks))
+        lines = user_data.split("\n")
+        self.assertEqual(lines[:4], ["#cloud-config", "merge_type: 'list(append)'", "write_files:", "-   content: |"])
+        self.assertEqual(lines[-2:], ["-   path: /etc/motd", ""])
+        self.assertTrue("    permissions: '0600'" in lines)
+        other = cloud_init_util.inject_customizations(pre, cloud_init_util.build_write_files_cloud_init(
+                tasks[:2] + [("cloud-b", "/var/lib/cloud_name")]))
+        self.assertEqual(other, user_data.replace("cloud-a", "cloud-b"))
+        self.assertTrue(cloud_init_util.inject_customizations([], ["x"]).startswith("#cloud-config\nwrite_files:\nx"))
+        message = cloud_init_util.build_multi_mime_message([(user_data, 'cloud-config', 'cloud_conf.yaml')],
+                                                           [self.path + ":cloud-config"])
+        self.assertTrue("cloud_conf.yaml" in message)
+        self.assertTrue(cloud_init_util.build_multi_mime_message(
+                [(user_data, 'cloud-config', 'cloud_conf.yaml')], [self.path + ":cloud-config"]) is message)
+        self.assertTrue(utilities.gzip_userdata(message) is utilities.gzip_userdata(message))
+
+
+class SpotPriceTests(unittest.TestCase):
+
+    PAGES = [("page2", [("m3.medium", "us-west-2a", "0.0300"), ("m3.medium", "us-west-2b", "0.0100")]),
+             (None, [("m3.medium", "us-west-2c", "0.0200"), ("c3.large", "us-west-2a", "0.0500")])]
+
+    def setUp(self):
+        import threading
+        import BaseHTTPServer
+        import urlparse
+        self.requests = []
+        pages = self.PAGES
+        requests = self.requests
+
+        class FakeEC2(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                params = urlparse.parse_qs(self.rfile.read(int(self.headers.getheader('Content-Length'))))
+                requests.append(params['Action'][0])
+                (next_token, items) = pages[1 if params.get('NextToken') else 0]
+                body = ['<DescribeSpotPriceHistoryResponse xmlns="http://ec2.amazonaws.com/doc/2014-10-01/">',
+                        '<requestId>1</requestId><spotPriceHistorySet>']
+                for (instance_type, zone, price) in items:
+                    body.append('<item><instanceType>%s</instanceType><productDescription>Linux/UNIX'
+                                '</productDescription><spotPrice>%s</spotPrice><timestamp>2026-10-19T00:00:00.000Z'
+                                '</timestamp><availabilityZone>%s</availabilityZone></item>' % (instance_type, price, zone))
+                body.append('</spotPriceHistorySet>')
+                if next_token:
+                    body.append('<nextToken>%s</nextToken>' % next_token)
+                body.append('</DescribeSpotPriceHistoryResponse>')
+                body = ''.join(body)
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FakeEC2)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        from cloudscheduler import spot_prices
+        self.server.shutdown()
+        self.server.server_close()
+        spot_prices.prices.clear()
+
+    def connection(self):
+        import boto.ec2
+        region = boto.ec2.regioninfo.RegionInfo(name="us-west-2", endpoint="127.0.0.1")
+        return boto.ec2.connection.EC2Connection(aws_access_key_id="key", aws_secret_access_key="secret",
+                                                 is_secure=False, port=self.server.server_port, region=region)
+
+    def cluster(self, name, access_key_id="key"):
+        from cloudscheduler.ec2cluster import EC2Cluster
+        cluster = EC2Cluster(name=name, host="ec2.us-west-2.amazonaws.com", cloud_type="AmazonEC2",
+                             access_key_id=access_key_id, secret_access_key="secret", regions=["us-west-2"])
+        cluster._get_connection = self.connection
+        return cluster
+
+    def test_refresh_and_lookup(self):
+        from cloudscheduler import spot_prices
+
+        class Pool:
+            resources = [self.cluster("a"), self.cluster("b"), self.cluster("c", access_key_id="other")]
+        refresher = spot_prices.SpotPriceRefresher(Pool)
+        # Prices are the same for every account, so the region is fetched once
+        self.assertEqual([cluster.name for (region, cluster) in refresher.sources()], ["a"])
+        refresher.refresh()
+        # One region's worth of fetches, two pages
+        self.assertEqual(self.requests, ["DescribeSpotPriceHistory"] * 2)
+        self.assertEqual(spot_prices.prices.lowest("us-west-2", "m3.medium"), 0.01)
+        self.assertEqual(spot_prices.prices.lowest("us-west-2", "m3.medium", zones=["us-west-2c"]), 0.02)
+        self.assertEqual(spot_prices.prices.lowest("us-west-2", "m3.medium", product="Windows"), None)
+        self.assertAlmostEqual(Pool.resources[0].get_current_us_west_2_spot_price("c3.large"), 0.055)
+        self.assertEqual(len(spot_prices.prices.rows()), 4)
+
+    def test_failed_refresh_keeps_prices(self):
+        from cloudscheduler import spot_prices
+        from cloudscheduler import info_server
+        cluster = self.cluster("a")
+
+        class Pool:
+            resources = [cluster]
+        refresher = spot_prices.SpotPriceRefresher(Pool)
+        refresher.refresh()
+        cluster._get_connection = lambda: None
+        refresher.refresh()
+        self.assertEqual(spot_prices.prices.lowest("us-west-2", "c3.large"), 0.05)
+        (fetched, error) = spot_prices.prices.status()["us-west-2"]
+        self.assertTrue(fetched and error)
+        output = info_server.format_spot_prices(spot_prices.prices)
+        self.assertTrue("last fetch failed" in output and "us-west-2b" in output)
+
+
+class InfoServerJSONTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.simulator import DummyCluster
+        from cloudscheduler.job_management import Job, JobPool
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.test_pool.resources = []
+        self.cloud = DummyCluster("cloud", 4, boot_latency=0)
+        self.test_pool.add_resource(self.cloud)
+        for n in range(2):
+            self.cloud.vm_create("image", "type", "user", "image", 1024, 1, 10)
+        self.job_pool = JobPool("testpool")
+        self.job_pool.job_container.add_job(Job(GlobalJobId="test#1.0#1", Owner="a", VMType="t1"))
+        self.job_pool.job_container.add_job(Job(GlobalJobId="test#2.0#1", Owner="b", VMType="t1", JobStatus=2))
+
+    def tearDown(self):
+        os.remove(self.configfilename)
+
+    def test_clusters_stream_matches_encoder(self):
+        import json
+        from cloudscheduler import info_server
+        streamed = "".join(info_server.buffered(info_server.iter_resource_pool_json(self.test_pool), size=10))
+        encoded = info_server.ResourcePoolJSONEncoder().encode(self.test_pool)
+        self.assertEqual(json.loads(streamed), json.loads(encoded))
+        self.assertEqual(len(json.loads(streamed)['resources'][0]['vms']), 2)
+
+    def test_job_pool_stream_matches_encoder(self):
+        import json
+        from cloudscheduler import info_server
+        streamed = json.loads("".join(info_server.iter_job_pool_json(self.job_pool)))
+        self.assertEqual(streamed, json.loads(info_server.JobPoolJSONEncoder().encode(self.job_pool)))
+        self.assertEqual([json.loads(job)['id'] for job in streamed['new_jobs']], ["test#1.0#1"])
+        self.assertEqual([json.loads(job)['id'] for job in streamed['sched_jobs']], ["test#2.0#1"])
+
+    def test_cache_follows_changes(self):
+        import json
+        from cloudscheduler import info_server
+        vm = self.cloud.vms[0]
+        text = info_server.json_cache.vm_json(vm)
+        self.assertTrue(info_server.json_cache.vm_json(vm) is text)
+        vm.status = "Running"
+        self.assertEqual(json.loads(info_server.json_cache.vm_json(vm))['status'], "Running")
+        vm.job_run_times.append(60)
+        vm.mark_changed()
+        self.assertEqual(json.loads(info_server.json_cache.vm_json(vm))['job_run_times'], [60])
+
+        job = self.job_pool.job_container.get_job_by_id("test#1.0#1")
+        text = info_server.json_cache.job_json(job)
+        self.assertTrue(info_server.json_cache.job_json(job) is text)
+        job.blocked_clouds.append("cloud")
+        self.assertEqual(json.loads(info_server.json_cache.job_json(job))['blocked_clouds'], ["cloud"])
+        job.override_status = "HTTPFail"
+        self.assertEqual(json.loads(info_server.json_cache.job_json(job))['override_status'], "HTTPFail")
+        self.assertEqual(json.loads(info_server.json_cache.job_json(job)), json.loads(
+                info_server.JobJSONEncoder().encode(info_server.job_to_dict(job))))
+
+    def app(self):
+        import web
+        from cloudscheduler import info_server, snapshot
+        web.cloud_resources = self.test_pool
+        web.job_pool = self.job_pool
+        snapshot.publisher.publish_resources(self.test_pool)
+        snapshot.publisher.publish_jobs(self.job_pool)
+        return web.application((r'/jobs()(\.json)', info_server.views.jobs,
+                                r'/vms()()(\.json)', info_server.views.vms), {})
+
+    def test_job_query_pages(self):
+        import json
+        from cloudscheduler.job_management import Job
+        for n in range(3, 8):
+            self.job_pool.job_container.add_job(Job(GlobalJobId="test#%d.0#1" % n, Owner="a", VMType="t1"))
+        self.assertEqual(len(list(self.job_pool.job_container.iter_jobs(user="a", scheduled=False))), 6)
+        app = self.app()
+        ids = []
+        url = '/jobs.json?user=a&state=new&fields=id,user&limit=4'
+        page = json.loads(app.request(url).data)
+        while True:
+            ids.extend(job['id'] for job in page['jobs'])
+            self.assertEqual(set(page['jobs'][0]), set(['id', 'user']))
+            if not page['next']:
+                break
+            page = json.loads(app.request(url + '&cursor=' + page['next']).data)
+        self.assertEqual(ids, sorted("test#%d.0#1" % n for n in [1, 3, 4, 5, 6, 7]))
+        page = json.loads(app.request('/jobs.json?sort=-id&limit=1&fields=id').data)
+        self.assertEqual(page['jobs'], [{'id': "test#7.0#1"}])
+        self.assertEqual(app.request('/jobs.json?sort=x509userproxy').status, "400 Bad Request")
+
+    def test_vm_query_filters(self):
+        import json
+        self.cloud.vms[1].status = "Error"
+        page = json.loads(self.app().request('/vms.json?status=Error&cloud=cloud&fields=id,cloud').data)
+        self.assertEqual(page, {'vms': [{'id': self.cloud.vms[1].id, 'cloud': "cloud"}], 'next': None})
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.simulator import DummyCluster
+        from cloudscheduler.job_management import Job, JobPool
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.test_pool.resources = []
+        self.cloud = DummyCluster("cloud", 4, boot_latency=0)
+        self.test_pool.add_resource(self.cloud)
+        for n in range(2):
+            self.cloud.vm_create("image", "type", "user", "image", 1024, 1, 10)
+        self.job_pool = JobPool("testpool")
+        self.job_pool.job_container.add_job(Job(GlobalJobId="test#1.0#1", Owner="a", VMType="t1"))
+
+    def tearDown(self):
+        os.remove(self.configfilename)
+
+    def test_vms_copied_on_write(self):
+        from cloudscheduler.cluster_tools import ICluster
+        from cloudscheduler.snapshot import SnapshotPublisher
+        publisher = SnapshotPublisher()
+        epoch = ICluster.capacity_epoch
+        first = publisher.publish_resources(self.test_pool)
+        self.assertEqual(ICluster.capacity_epoch, epoch)
+        (changed, unchanged) = first.pool.get_cluster("cloud").vms
+        self.assertFalse(changed is self.cloud.vms[0])
+
+        self.cloud.vms[0].status = "Running"
+        del self.cloud.vms[1]
+        self.assertEqual(first.pool.vm_count(), 2)
+        self.assertEqual(changed.status, "Starting")
+        second = publisher.publish_resources(self.test_pool)
+        self.assertTrue(second.version > first.version)
+        self.assertEqual(second.pool.get_cluster("cloud").vms[0].status, "Running")
+        self.assertEqual(second.pool.vm_count(), 1)
+
+        third = publisher.publish_resources(self.test_pool)
+        self.assertTrue(third.pool.get_cluster("cloud").vms[0] is second.pool.get_cluster("cloud").vms[0])
+
+    def test_jobs_snapshot(self):
+        from cloudscheduler.snapshot import SnapshotPublisher
+        publisher = SnapshotPublisher()
+        jobs = publisher.publish_jobs(self.job_pool)
+        self.job_pool.job_container.remove_job_by_id("test#1.0#1")
+        self.assertTrue(jobs.pool.job_container.has_job("test#1.0#1"))
+        self.assertEqual(len(jobs.pool.job_container.get_unscheduled_jobs()), 1)
+        self.assertFalse(publisher.publish_jobs(self.job_pool).pool.job_container.has_job("test#1.0#1"))
+
+    def test_etag_and_gzip(self):
+        import web
+        import zlib
+        from cloudscheduler import info_server, snapshot
+        web.cloud_resources = self.test_pool
+        web.job_pool = self.job_pool
+        app = web.application((r'/clusters()(\.json)', info_server.views.clusters), {})
+        snapshot.publisher.publish_resources(self.test_pool)
+
+        response = app.request('/clusters.json')
+        etag = response.headers['ETag']
+        self.assertEqual(response.status, "200 OK")
+        self.assertEqual(app.request('/clusters.json', headers={'If-None-Match': etag}).status,
+                         "304 Not Modified")
+        gzipped = app.request('/clusters.json', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(gzipped.data, 16 + zlib.MAX_WBITS), response.data)
+
+        snapshot.publisher.publish_resources(self.test_pool)
+        response = app.request('/clusters.json', headers={'If-None-Match': etag})
+        self.assertEqual(response.status, "200 OK")
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+class EventFeedTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.simulator import DummyCluster
+        from cloudscheduler.job_management import Job, JobPool
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.test_pool.resources = []
+        self.cloud = DummyCluster("cloud", 4, boot_latency=0)
+        self.test_pool.add_resource(self.cloud)
+        self.job_pool = JobPool("testpool")
+        self.job_pool.job_container.add_job(Job(GlobalJobId="test#1.0#1", Owner="a", VMType="t1"))
+
+    def tearDown(self):
+        os.remove(self.configfilename)
+
+    def test_since(self):
+        from cloudscheduler.events import EventFeed
+        feed = EventFeed(size=3)
+        self.assertEqual(feed.since(0), ([], 0, False))
+        for n in range(5):
+            feed.emit('vm' if n % 2 else 'job', n=n)
+        (found, last, missed) = feed.since(0)
+        self.assertEqual(([event['n'] for event in found], last, missed), ([2, 3, 4], 5, True))
+        self.assertEqual([event['id'] for event in feed.since(3)[0]], [4, 5])
+        self.assertEqual([event['n'] for event in feed.since(2, types=['vm'])[0]], [3])
+        self.assertEqual(feed.since(None), ([], 5, False))
+        # From before a restart
+        self.assertTrue(feed.since(50)[2])
+        self.assertEqual(EventFeed(size=0).since(0), ([], 0, False))
+
+    def test_status_changes_fed(self):
+        from cloudscheduler import events, snapshot
+        last = events.feed.since(None)[1]
+        self.cloud.vm_create("image", "type", "user", "image", 1024, 1, 10)
+        vm = self.cloud.vms[0]
+        vm.status = "Running"
+        vm.lastpoll = 1
+        self.job_pool.job_container.schedule_job("test#1.0#1")
+        snapshot.publisher.publish_resources(self.test_pool)
+        del self.cloud.vms[0]
+        snapshot.publisher.publish_resources(self.test_pool)
+        changes = [(event['type'], event.get('vm', event.get('job')), event['old'], event['new'])
+                   for event in events.feed.since(last, types=['vm', 'job'])[0]]
+        self.assertEqual(changes, [('vm', vm.id, None, "Starting"), ('vm', vm.id, "Starting", "Running"),
+                                   ('job', "test#1.0#1", "Unscheduled", "Scheduled"),
+                                   ('vm', vm.id, "Running", "Removed")])
+
+    def test_long_poll_and_stream(self):
+        import json
+        import threading
+        import web
+        from cloudscheduler import events, info_server
+        app = web.application((r'/events(\.json)?', info_server.views.events), {})
+        last = events.feed.since(None)[1]
+        threading.Timer(0.2, events.feed.emit, ['ban'], {'image': "image", 'cloud': "cloud"}).start()
+        result = json.loads(app.request('/events.json?since=%d&timeout=10&types=ban' % last).data)
+        self.assertEqual([(event['type'], event['image']) for event in result['events']], [('ban', "image")])
+        self.assertEqual(result['last'], result['events'][0]['id'])
+        self.assertFalse(result['missed'])
+        self.assertEqual(app.request('/events.json?types=nothing').status, "400 Bad Request")
+
+        info_server.feed_waiters.acquire()
+        stream = "".join(info_server.stream_events(last, None, seconds=0.1))
+        self.assertTrue("id: %d\nevent: ban\ndata: " % result['last'] in stream)
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.simulator import DummyCluster
+        from cloudscheduler.job_management import JobPool
+        (fd, self.configfilename) = tempfile.mkstemp()
+        os.close(fd)
+        self.test_pool = cloudscheduler.cloud_management.ResourcePool(self.configfilename, "Test Pool")
+        self.test_pool.resources = []
+        self.cloud = DummyCluster("metrics-cloud", 4, boot_latency=0, quota=1)
+        self.test_pool.add_resource(self.cloud)
+        self.job_pool = JobPool("testpool")
+
+    def tearDown(self):
+        os.remove(self.configfilename)
+
+    def test_exposition_format(self):
+        from cloudscheduler.metrics import Registry
+        registry = Registry()
+        counter = registry.counter("test_total", "A counter", ('kind',))
+        gauge = registry.gauge("test_gauge", "A gauge")
+        histogram = registry.histogram("test_seconds", "A histogram", buckets=(0.1, 1))
+        counter.inc(kind='a "quoted"\nvalue')
+        counter.inc(2, kind="b")
+        gauge.set(1.5)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertRaises(KeyError, counter.inc)
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP test_total A counter", "# TYPE test_total counter",
+            'test_total{kind="a \\"quoted\\"\\nvalue"} 1', 'test_total{kind="b"} 2',
+            "# HELP test_gauge A gauge", "# TYPE test_gauge gauge", "test_gauge 1.5",
+            "# HELP test_seconds A histogram", "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 2', 'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4', "test_seconds_sum 3.65", "test_seconds_count 4"])
+
+    def test_cloud_api_timed(self):
+        from cloudscheduler import metrics
+        labels = {'cloud': "metrics-cloud", 'operation': "create"}
+        (calls, errors) = (metrics.cloud_api_seconds.count(**labels), metrics.cloud_api_errors.get(**labels))
+        self.assertEqual(self.cloud.vm_create("image", "type", "user", "image", 1024, 1, 10), 0)
+        self.assertNotEqual(self.cloud.vm_create("image", "type", "user", "image", 1024, 1, 10), 0)
+        self.assertEqual(metrics.cloud_api_seconds.count(**labels), calls + 2)
+        self.assertEqual(metrics.cloud_api_errors.get(**labels), errors + 1)
+        self.cloud.vm_destroy(self.cloud.vms[0])
+        self.assertTrue(metrics.cloud_api_seconds.count(cloud="metrics-cloud", operation="destroy") > 0)
+
+    def test_endpoint(self):
+        import web
+        from cloudscheduler import info_server, snapshot
+        self.cloud.vm_create("image", "type", "user", "image", 1024, 1, 10)
+        web.cloud_resources = self.test_pool
+        web.job_pool = self.job_pool
+        snapshot.publisher.publish_resources(self.test_pool)
+        snapshot.publisher.publish_jobs(self.job_pool)
+        response = web.application((r'/metrics', info_server.views.metrics), {}).request('/metrics')
+        self.assertTrue(response.headers['Content-Type'].startswith("text/plain"))
+        self.assertTrue('cloudscheduler_vms{cloud="metrics-cloud",status="Starting"} 1\n' in response.data)
+        self.assertTrue('cloudscheduler_jobs{state="new"} 0\n' in response.data)
+        self.assertTrue("# TYPE cloudscheduler_cloud_api_seconds histogram\n" in response.data)
+
+
+class TracingTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler import tracing
+
+        class Poller:
+            name = "TestPoller"
+
+            @tracing.cycle
+            def run_cycle(self, fail=False):
+                self.poll()
+                with tracing.span("publish"):
+                    tracing.phase("freeze")
+                    tracing.phase("feed")
+                if fail:
+                    raise ValueError("poll failed")
+
+            @tracing.traced
+            def poll(self):
+                for cloud in ("a", "b"):
+                    tracing.phase(cloud)
+
+        self.poller = Poller()
+        self.old_history = cloudscheduler.config.trace_history
+        cloudscheduler.config.trace_history = 2
+        tracing.traces.clear()
+
+    def tearDown(self):
+        from cloudscheduler import tracing
+        cloudscheduler.config.trace_history = self.old_history
+        tracing.traces.clear()
+
+    def test_spans(self):
+        from cloudscheduler import tracing
+        self.poller.poll()
+        self.assertEqual(tracing.traces.recent(), [])
+        self.poller.run_cycle()
+        self.assertRaises(ValueError, self.poller.run_cycle, fail=True)
+        self.poller.run_cycle()
+        traces = tracing.traces.recent()
+        self.assertEqual(len(traces), 2)
+        self.assertEqual(traces[0].error, "ValueError")
+        self.assertEqual(traces[1].error, None)
+        spans = [(span['name'], span['depth']) for span in traces[1].to_dict()['spans']]
+        self.assertEqual(spans, [("poll", 1), ("a", 2), ("b", 2), ("publish", 1), ("freeze", 2), ("feed", 2)])
+        self.assertEqual(tracing.traces.current(), None)
+
+        chrome = tracing.chrome_trace(traces)['traceEvents']
+        self.assertEqual(chrome[0]['ph'], "M")
+        self.assertEqual(chrome[0]['args']['name'], "TestPoller")
+        self.assertEqual([event['name'] for event in chrome if event['ph'] == "X"].count("run_cycle"), 2)
+
+        cloudscheduler.config.trace_history = 0
+        self.poller.run_cycle()
+        self.assertEqual(len(tracing.traces.recent()), 2)
+
+    def test_endpoint(self):
+        import web
+        import json
+        from cloudscheduler import info_server
+        self.poller.run_cycle()
+        app = web.application((r'/traces(\.json|/chrome\.json)?', info_server.views.traces), {})
+        text = app.request('/traces').data
+        self.assertTrue(text.startswith("TestPoller: last run_cycle at "))
+        self.assertTrue("\n     a " in text)
+        traces = json.loads(app.request('/traces.json?thread=TestPoller&count=1').data)['traces']
+        self.assertEqual(len(traces), 1)
+        self.assertEqual(traces[0]['spans'][0]['name'], "poll")
+        chrome = json.loads(app.request('/traces/chrome.json').data)
+        self.assertEqual(len(chrome['traceEvents']), 8)
+        self.assertEqual(app.request('/traces?count=x').status, "400 Bad Request")
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        import time
+        import threading
+        from cloudscheduler import profiler
+
+        class Worker(threading.Thread):
+            def __init__(self):
+                threading.Thread.__init__(self, name="TestWorker")
+                self.daemon = True
+                self.quit = threading.Event()
+
+            def run(self):
+                while not self.quit.is_set():
+                    self.run_cycle()
+
+            @profiler.profiled
+            def run_cycle(self):
+                self.busy_step()
+
+            def busy_step(self):
+                end = time.time() + 0.01
+                while time.time() < end:
+                    pass
+
+        self.worker = Worker()
+        self.worker.start()
+
+    def tearDown(self):
+        self.worker.quit.set()
+        self.worker.join()
+
+    def test_stacks(self):
+        from cloudscheduler import profiler
+        self.assertEqual(profiler.find_thread("TestWorker"), self.worker)
+        stacks = profiler.format_stacks()
+        self.assertTrue("Thread TestWorker (daemon):\n" in stacks)
+        self.assertTrue("Thread MainThread:\n" in stacks)
+        self.assertTrue("in test_stacks\n" in stacks)
+
+    def test_sample_and_profile(self):
+        from cloudscheduler import profiler
+        stacks = profiler.sample_stacks(self.worker, 0.2, interval=0.005)
+        self.assertTrue(sum(stacks.values()) > 10)
+        self.assertTrue(any(stack.endswith("test.py:run_cycle;test.py:busy_step") for stack in stacks))
+        line = profiler.format_collapsed(stacks).splitlines()[0]
+        self.assertEqual(int(line.rsplit(" ", 1)[1]), max(stacks.values()))
+
+        output = profiler.profile_cycles(self.worker, 0.1, sort='tottime', limit=5)
+        self.assertTrue(" TestWorker cycles profiled\n" in output)
+        self.assertTrue("(busy_step)" in output)
+        self.assertEqual(profiler.cycle_profiles, {})
+
+        profiler.capture_lock.acquire()
+        try:
+            self.assertRaises(profiler.CaptureBusy, profiler.sample_stacks, self.worker, 0.1)
+        finally:
+            profiler.capture_lock.release()
+
+    def test_endpoints(self):
+        import web
+        from cloudscheduler import admin_server
+        admin_server.log = utilities.get_cloudscheduler_logger()
+        app = web.application((r'/threads', admin_server.views.threads,
+                               r'/threads/([\w\%-]+)/profile', admin_server.views.profile), {})
+        self.assertTrue("Thread TestWorker" in app.request('/threads').data)
+        response = app.request('/threads/TestWorker/profile', method='POST', data={'seconds': '0.1'})
+        self.assertTrue("busy_step" in response.data)
+        self.assertEqual(app.request('/threads/NoSuchThread/profile', method='POST').status, "404 Not Found")
+        self.assertEqual(app.request('/threads/TestWorker/profile', method='POST',
+                                     data={'mode': 'gprof'}).status, "400 Bad Request")
+        for seconds in ('0', '-1', '301'):
+            self.assertEqual(app.request('/threads/TestWorker/profile', method='POST',
+                                         data={'seconds': seconds, 'mode': 'cprofile'}).status, "400 Bad Request")
+
+
+class WatchdogTests(unittest.TestCase):
+
+    def setUp(self):
+        import time
+        import threading
+        from cloudscheduler import watchdog
+
+        class Poller(threading.Thread):
+            def __init__(self):
+                threading.Thread.__init__(self, name="TestStallPoller")
+                self.daemon = True
+                self.quit = False
+                self.polling_interval = 5
+                self.heart_beat = time.time()
+                self.stuck = threading.Event()
+
+            def stop(self):
+                self.quit = True
+                self.stuck.set()
+
+            def run(self):
+                self.stuck.wait()
+
+        self.Poller = Poller
+        self.threads = [Poller()]
+        self.threads[0].start()
+        self.old_config = (cloudscheduler.config.watchdog_stall_time, cloudscheduler.config.watchdog_restart)
+        cloudscheduler.config.watchdog_stall_time = 10
+        cloudscheduler.config.watchdog_restart = False
+        watchdog.stalls.clear()
+
+    def tearDown(self):
+        from cloudscheduler import watchdog
+        (cloudscheduler.config.watchdog_stall_time, cloudscheduler.config.watchdog_restart) = self.old_config
+        for thread in self.threads:
+            thread.stop()
+        watchdog.stalls.clear()
+
+    def test_stall_and_recover(self):
+        import time
+        from cloudscheduler import events, metrics, watchdog
+        thread = self.threads[0]
+        dog = watchdog.Watchdog(self.threads)
+        self.assertEqual(watchdog.stall_bound(thread), 15)
+        last = events.feed.since(None)[1]
+        dog.check()
+        self.assertEqual(watchdog.stalls, {})
+
+        thread.heart_beat = time.time() - 20
+        dog.check()
+        stall = watchdog.stalls["TestStallPoller"]
+        self.assertTrue(stall.diagnostics.startswith("Thread TestStallPoller (daemon):\n"))
+        self.assertTrue("  Last heart beat 20.0s ago\n" in stall.diagnostics)
+        self.assertEqual(metrics.thread_stalled.get(thread="TestStallPoller"), 1)
+        stalls = metrics.thread_stalls.get(thread="TestStallPoller")
+        dog.check()
+        self.assertEqual(metrics.thread_stalls.get(thread="TestStallPoller"), stalls)
+
+        thread.heart_beat = time.time()
+        dog.check()
+        self.assertEqual(watchdog.stalls, {})
+        self.assertEqual(metrics.thread_stalled.get(thread="TestStallPoller"), 0)
+        kinds = [event['type'] for event in events.feed.since(last, types=('stall', 'recover'))[0]
+                 if event['thread'] == "TestStallPoller"]
+        self.assertEqual(kinds, ['stall', 'recover'])
+
+    def test_restart(self):
+        import time
+        from cloudscheduler import metrics, watchdog
+        cloudscheduler.config.watchdog_restart = True
+        stalled = self.threads[0]
+
+        def restart(thread):
+            replacement = self.Poller()
+            replacement.start()
+            self.threads[self.threads.index(thread)] = replacement
+            return replacement
+
+        restarts = metrics.thread_restarts.get(thread="TestStallPoller")
+        stalled.heart_beat = time.time() - 20
+        watchdog.Watchdog(self.threads, restart).check()
+        self.assertTrue(stalled.abandoned and stalled.quit)
+        self.assertTrue(self.threads[0] is not stalled and self.threads[0].is_alive())
+        self.assertTrue(watchdog.recent_stalls[-1].restarted)
+        self.assertEqual(watchdog.stalls, {})
+        self.assertEqual(metrics.thread_restarts.get(thread="TestStallPoller"), restarts + 1)
+
+
+class LogQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        import logging
+        self.log = logging.getLogger("cloudscheduler.test_log_queue")
+        self.log.propagate = False
+        self.log.setLevel(logging.DEBUG)
+        self.output = StringIO()
+        self.handler = logging.StreamHandler(self.output)
+        self.handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+
+    def tearDown(self):
+        for handler in list(self.log.handlers):
+            self.log.removeHandler(handler)
+
+    def test_written_by_writer(self):
+        from cloudscheduler import log_queue
+        writer = log_queue.start(self.log, [self.handler], 100)
+        items = [1]
+        self.log.info("Job %s has %s", "1.0", items)
+        items.append(2)
+        try:
+            raise ValueError("bad")
+        except ValueError:
+            self.log.exception("Failed")
+        writer.stop()
+        output = self.output.getvalue()
+        self.assertTrue(output.startswith("INFO Job 1.0 has [1]\nERROR Failed\nTraceback"))
+        self.assertTrue("ValueError: bad" in output)
+        self.assertFalse(writer.is_alive())
+        self.log.info("After stop")
+        self.assertTrue(self.output.getvalue().endswith("INFO After stop\n"))
+
+    def test_dropped_when_full(self):
+        from cloudscheduler import log_queue, metrics
+        queue_handler = log_queue.QueueHandler(1)
+        writer = log_queue.QueueWriter(self.log, queue_handler, [self.handler])
+        self.log.addHandler(queue_handler)
+        dropped = metrics.log_records_dropped.get()
+        for i in range(3):
+            self.log.warning("Message %d", i)
+        self.assertEqual(queue_handler.dropped, 2)
+        self.assertEqual(metrics.log_records_dropped.get(), dropped + 2)
+        writer.start()
+        writer.stop()
+        self.assertEqual(self.output.getvalue(), "WARNING Message 0\n"
+                         "WARNING The log fell behind, 2 messages were not written\n")
+
+    def test_lazy(self):
+        import logging
+        calls = []
+        def describe(name):
+            calls.append(name)
+            return name.upper()
+        self.log.addHandler(self.handler)
+        self.log.setLevel(logging.INFO)
+        self.log.debug("Skipped %s", utilities.Lazy(describe, "vm"))
+        self.assertEqual(calls, [])
+        self.log.info("Written %s", utilities.Lazy(describe, "vm"))
+        self.assertEqual(calls, ["vm"])
+        self.assertEqual(self.output.getvalue(), "INFO Written VM\n")
+
+
+class SimulatorTests(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.persistence_file) = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.persistence_file)
+        # Options the other tests' config may point at files that don't exist
+        overrides = {'persistence_file': self.persistence_file, 'cert_file': "", 'key_file': "",
+                     'ca_root_certs': [], 'ca_signing_policies': [], 'default_VMUserData': [],
+                     'default_yaml': ""}
+        self.old_config = {}
+        for name, value in overrides.iteritems():
+            self.old_config[name] = getattr(cloudscheduler.config, name)
+            setattr(cloudscheduler.config, name, value)
+
+    def tearDown(self):
+        for name, value in self.old_config.iteritems():
+            setattr(cloudscheduler.config, name, value)
+        if os.path.exists(self.persistence_file):
+            os.remove(self.persistence_file)
+
+    def test_all_jobs_run(self):
+        import time
+        from cloudscheduler import simulator
+        real_time = time.time
+        clusters = [simulator.DummyCluster("sim-a", 4, boot_latency=60),
+                    simulator.DummyCluster("sim-b", 4, quota=2, boot_latency=120)]
+        trace = [simulator.SimJob(n, "user%d" % (n % 2), "t1", n * 10, 300) for n in range(1, 21)]
+        simulation = simulator.Simulation(simulator.load_daemon(), clusters, trace, duration=6*3600)
+        report = simulation.run()
+        self.assertEqual(time.time, real_time)
+        self.assertEqual(report['jobs']['completed'], 20)
+        self.assertTrue(report['jobs']['wait_seconds']['max'] >= 60)
+        self.assertTrue(report['vms']['created'] > 0)
+        self.assertEqual(report['vms']['created'], report['vms']['destroyed'])
+        self.assertTrue(clusters[1].peak_vms <= 2)
+        self.assertTrue(report['cycle_cpu_seconds']['Scheduler']['count'] > 0)
+
+    def test_dummy_cluster_quota_and_boot(self):
+        from cloudscheduler import simulator
+        cluster = simulator.DummyCluster("sim-q", 4, quota=1, boot_latency=0)
+        args = {'vm_name': "img", 'vm_type': "t1", 'vm_user': "u", 'vm_image': {},
+                'vm_mem': 512, 'vm_cores': 1, 'vm_storage': 0}
+        self.assertEqual(cluster.vm_create(**args), 0)
+        self.assertEqual(cluster.vm_create(**args), simulator.DummyCluster.QUOTA_EXCEEDED)
+        self.assertEqual(cluster.vm_poll(cluster.vms[0]), "Running")
+        self.assertEqual(cluster.vm_destroy(cluster.vms[0]), 0)
+        self.assertEqual(cluster.vm_slots, 4)
+
+    def test_read_trace(self):
+        from cloudscheduler import simulator
+        (fd, path) = tempfile.mkstemp()
+        os.write(fd, "# submit user vmtype runtime\n0 alice t1 600\n\n30 bob t2 60 2048 2\n")
+        os.close(fd)
+        try:
+            trace = simulator.read_trace(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(len(trace), 2)
+        self.assertEqual(trace[1].uservmtype, "bob:t2")
+        self.assertEqual((trace[1].memory, trace[1].cpucores), (2048, 2))
+
+
 class GetOrNoneTests(unittest.TestCase):
 
     def setUp(self):